@@ -4,40 +4,1358 @@ Hoshimi - Complete single-file Discord bot
 Generated: compact, feature-rich single file implementing the requested commands.
 Requirements: discord.py (2.x)
 Run: set environment variable DISCORD_TOKEN, then `python hoshimi_complete.py`
+     (`--export-json [path]` dumps the data as readable json and exits)
 """
 
 import os
+import io
+import sys
 import json
+import pickle
+import time
+import hashlib
 import asyncio
 import datetime
 import random
+import math
 import re
+import bisect
+import heapq
+import itertools
+import weakref
+import contextlib
+import sqlite3
+import logging
+import functools
+import unicodedata
 from pathlib import Path
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
 
 import discord
 from discord.ext import commands, tasks
 
-DATA_FILE = "hoshimi_data.json"
+DATA_FILE = os.environ.get("HOSHIMI_DATA_FILE", "hoshimi_data.json")
+# "json" (single file, default), "sqlite" (WAL database, per-row upserts) or
+# "shards" (one file per guild, loaded on demand, see ShardStore).
+# sqlite only changes how writes reach the disk: like json, every guild is
+# read into memory at startup and stays there, so memory grows with the total
+# number of members. Use "shards" when that matters: guilds are loaded on
+# first access and dropped again when idle.
+STORAGE_BACKEND = os.environ.get("HOSHIMI_STORAGE", "json").lower()
+SQLITE_FILE = os.environ.get("HOSHIMI_SQLITE_FILE", "hoshimi_data.db")
+SHARD_DIR = os.environ.get("HOSHIMI_SHARD_DIR", "hoshimi_shards")
+# resident guilds are dropped after SHARD_IDLE seconds without access, or
+# least recently used first past SHARD_MAX_RESIDENT
+SHARD_IDLE = float(os.environ.get("HOSHIMI_SHARD_IDLE", "900"))
+SHARD_MAX_RESIDENT = int(os.environ.get("HOSHIMI_SHARD_MAX_RESIDENT", "5000"))
+SHARD_MIN_IDLE = 60.0
+# Write-behind: pending changes are flushed every FLUSH_INTERVAL seconds, or
+# as soon as FLUSH_MAX_DIRTY entries are pending. A crash loses at most
+# FLUSH_INTERVAL (+1s loop tick) seconds / FLUSH_MAX_DIRTY entries of changes.
+FLUSH_INTERVAL = float(os.environ.get("HOSHIMI_FLUSH_INTERVAL", "5"))
+FLUSH_MAX_DIRTY = int(os.environ.get("HOSHIMI_FLUSH_MAX_DIRTY", "500"))
+# Prometheus text endpoint (GET /metrics); 0 = disabled. Keep it on localhost
+# or behind a firewall, it is not authenticated.
+METRICS_PORT = int(os.environ.get("HOSHIMI_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("HOSHIMI_METRICS_HOST", "127.0.0.1")
 
-def load_data():
-    if Path(DATA_FILE).exists():
+# Journal (json backend): every flushed change is appended to JOURNAL_FILE as
+# one small record; a compactor folds it into a checksummed DATA_FILE snapshot
+# once it grows past COMPACT_BYTES. Startup = snapshot + journal replay.
+JOURNAL_FILE = DATA_FILE + ".log"
+JOURNAL_FORMAT = "hoshimi-journal"
+COMPACT_BYTES = int(os.environ.get("HOSHIMI_COMPACT_BYTES", str(4 * 1024 * 1024)))
+# Economy ledger: one json line per transaction, written at least once per
+# second and always before the balances it explains. Lines already covered by
+# a committed flush are summed into data["ledger_rollups"] once the file
+# passes LEDGER_ROLLUP_BYTES, or every LEDGER_ROLLUP_INTERVAL seconds.
+LEDGER_FILE = os.environ.get("HOSHIMI_LEDGER_FILE", DATA_FILE + ".ledger")
+LEDGER_ROLLUP_BYTES = int(os.environ.get("HOSHIMI_LEDGER_ROLLUP_BYTES", str(1024 * 1024)))
+LEDGER_ROLLUP_INTERVAL = 3600.0
+SNAPSHOT_FORMAT = "hoshimi-snapshot"
+# Snapshot payload: 0 = plain pretty json (no header), 1 = compact json,
+# 2 = compact pickle (see _encode). SCHEMA_VERSION is the layout of `data`
+# itself; older files are upgraded at load by MIGRATIONS.
+SNAPSHOT_VERSION = 2
+SCHEMA_VERSION = 2
+
+# Compact encoding: digit-string keys (guild/user/message ids) are stored as
+# ints, and a dict of TABLE_MIN+ records sharing the same fields (levels,
+# economy, ...) becomes a (fields, keys, rows) tuple; a RecordTable is stored
+# as its raw columns (5-tuple). Decoded data follows json semantics and never
+# holds tuples, so a tuple always marks a table.
+TABLE_MIN = 8
+_SCALAR_TYPES = {str, int, float, bool, type(None)}
+
+def _enc_key(k):
+    if k.__class__ is str and k.isascii() and k.isdigit() and (len(k) == 1 or k[0] != "0"):
+        return int(k)
+    return k
+
+def _dec_key(k):
+    return str(k) if k.__class__ is int else k
+
+def _as_table(d):
+    if len(d) < TABLE_MIN:
+        return None
+    recs = list(d.values())
+    if set(map(type, recs)) != {dict}:
+        return None
+    shapes = set(map(tuple, recs))
+    if len(shapes) != 1:
+        return None
+    fields = shapes.pop()
+    if not fields or any(f.__class__ is not str or _enc_key(f) is not f for f in fields):
+        return None
+    rows = list(map(tuple, map(dict.values, recs)))
+    if not set(map(type, itertools.chain.from_iterable(rows))) <= _SCALAR_TYPES:
+        return None
+    return (fields, list(map(_enc_key, d)), rows)
+
+def _encode(v):
+    if isinstance(v, RecordTable):
+        return v.encode()
+    if isinstance(v, dict):
+        table = _as_table(v)
+        if table is not None:
+            return table
+        return {_enc_key(k): _encode(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple)):
+        if set(map(type, v)) <= _SCALAR_TYPES:
+            return v if v.__class__ is list else list(v)
+        return [_encode(x) for x in v]
+    return v
+
+def _decode(v):
+    cls = v.__class__
+    if cls is dict:
+        return {_dec_key(k): _decode(x) for k, x in v.items()}
+    if cls is tuple:
+        if len(v) == 5:
+            return RecordTable.decode(*v)
+        fields, keys, rows = v
+        return {_dec_key(k): dict(zip(fields, row)) for k, row in zip(keys, rows)}
+    if cls is list:
+        if set(map(type, v)) <= _SCALAR_TYPES:
+            return v
+        return [_decode(x) for x in v]
+    return v
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    # snapshots only hold builtin containers and scalars: refuse any class
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"type interdit dans le snapshot: {module}.{name}")
+
+def _migrate_invite_tiers(d):
+    """roles_invites {"invites": n, "role": id} -> tiers {"n": id}."""
+    for gid, conf in d.get("roles_invites", {}).items():
+        if "role" in conf and "invites" in conf:
+            d["roles_invites"][gid] = {str(int(conf["invites"])): conf["role"]}
+
+MIGRATIONS = {1: _migrate_invite_tiers}  # schema n -> n + 1
+
+def migrate_schema(d, schema):
+    """Upgrade `d` in place from `schema` to SCHEMA_VERSION; returns the steps run."""
+    if schema > SCHEMA_VERSION:
+        raise RuntimeError(f"Données au schéma {schema}, ce bot ne gère que le schéma {SCHEMA_VERSION}.")
+    steps = 0
+    while schema < SCHEMA_VERSION:
+        MIGRATIONS[schema](d)
+        schema += 1
+        steps += 1
+        print(f"Données migrées vers le schéma {schema}.")
+    return steps
+
+def _read_snapshot(path):
+    """Return (data, seq, schema, version) from a snapshot; raises ValueError if it is damaged."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    first, _, rest = raw.partition(b"\n")
+    try:
+        header = json.loads(first)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+        # pre-journal file: plain (pretty-printed) json
+        return json.loads(raw), 0, 1, 0
+    if len(rest) != header.get("length") or hashlib.sha256(rest).hexdigest() != header.get("sha256"):
+        raise ValueError(f"{path}: checksum invalide")
+    version = header.get("version", 1)
+    if version == 1:
+        d = json.loads(rest)
+    elif version == 2:
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
+            d = _decode(_SnapshotUnpickler(io.BytesIO(rest)).load())
+        except (pickle.UnpicklingError, EOFError, TypeError) as e:
+            raise ValueError(f"{path}: {e}")
+    else:
+        raise ValueError(f"{path}: format {version} inconnu")
+    return d, header.get("seq", 0), header.get("schema", 1), version
+
+def _snapshot_bytes(d, seq):
+    payload = pickle.dumps(_encode(d), protocol=5)
+    header = {"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION, "schema": SCHEMA_VERSION, "seq": seq,
+              "length": len(payload), "sha256": hashlib.sha256(payload).hexdigest()}
+    return json.dumps(header).encode("utf-8") + b"\n" + payload
+
+def _lookup(d, section, gid, key):
+    """(found, value) at the path described by a dirty entry."""
+    cur = d.get(section, {}) if section in d else None
+    found = cur is not None
+    for part in (gid, key):
+        if part is None or not found:
+            continue
+        found = isinstance(cur, Mapping) and part in cur
+        cur = cur.get(part) if found else None
+    return found, cur
+
+def _apply_record(d, rec):
+    section, gid, key = rec["s"], rec.get("g"), rec.get("k")
+    parent, leaf = d, section
+    for part in (gid, key):
+        if part is not None:
+            parent, leaf = parent.setdefault(leaf, {}), part
+    if "v" in rec:
+        parent[leaf] = rec["v"]
+    else:
+        parent.pop(leaf, None)
+
+def _replay_journal(d, seq):
+    """(seq, schema from the journal header or None)."""
+    schema = None
+    if not Path(JOURNAL_FILE).exists():
+        return seq, schema
+    good = 0
+    with open(JOURNAL_FILE, "rb") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break  # torn tail from a crash in the middle of an append
+            good += len(line)
+            if rec.get("format") == JOURNAL_FORMAT:
+                schema = rec.get("schema")
+                continue
+            if rec["n"] > seq:
+                _apply_record(d, rec)
+                seq = rec["n"]
+    if good != os.path.getsize(JOURNAL_FILE):
+        os.truncate(JOURNAL_FILE, good)
+    return seq, schema
+
+def _load_journaled():
+    """(data, seq, stale): stale when the files predate SNAPSHOT_VERSION/SCHEMA_VERSION."""
+    d, seq, snapshot = {}, 0, False
+    schema, version = SCHEMA_VERSION, SNAPSHOT_VERSION
+    path = DATA_FILE
+    if not Path(path).exists() and Path(DATA_FILE + ".bak").exists():
+        path = DATA_FILE + ".bak"  # crashed between the two renames of a compaction
+    if Path(path).exists():
+        try:
+            d, seq, schema, version = _read_snapshot(path)
+        except ValueError as e:
+            if not Path(DATA_FILE + ".bak").exists():
+                raise RuntimeError(f"Fichier de données corrompu ({e}), démarrage annulé.")
+            print(f"Snapshot illisible ({e}), utilisation de {DATA_FILE}.bak")
+            d, seq, schema, version = _read_snapshot(DATA_FILE + ".bak")
+        snapshot = True
+    # journal records are in the snapshot's schema: replay first, then upgrade
+    seq, journal_schema = _replay_journal(d, seq)
+    if not snapshot and Path(JOURNAL_FILE).exists():
+        # journal alone: its header says the schema; none means it predates migrations
+        schema, version = (journal_schema, SNAPSHOT_VERSION) if journal_schema else (1, 0)
+    steps = migrate_schema(d, schema)
+    return d, seq, bool(steps) or version < SNAPSHOT_VERSION
+
+def load_data():
+    return _load_journaled()[0]
 
 def save_data(d):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(d, f, indent=2, ensure_ascii=False)
+    started = time.perf_counter()
+    store.commit(store.prepare(d, None))
+    metrics.observe("hoshimi_persist_seconds", time.perf_counter() - started, op="save")
+
+# -------------------------
+# COLUMNAR RECORDS
+# -------------------------
+# data["levels"][gid] and data["economy"][gid] are RecordTables: user ids in a
+# sorted int64 array with one parallel int64 array per field, ~8 bytes per
+# value instead of a dict per user. They behave as {uid: record} mappings and
+# hand out Row proxies, so `user = levels.setdefault(uid, {...}); user["xp"] += 1`
+# works unchanged. Values that do not fit a column (floats outside `lossy`
+# fields, strings, bools, unknown fields) go to a small per-user overflow dict.
+COLUMNAR = {
+    # section: (fields, fields whose floats are stored truncated to int)
+    "levels": (("xp", "level", "messages"), ()),
+    "economy": (("money", "last_daily", "seq"), ("last_daily",)),
+}
+_MISSING = -(1 << 63)      # field absent from the record
+_NONE = _MISSING + 1       # field present, value None
+
+class Row(MutableMapping):
+    """Live view of one record of a RecordTable."""
+    __slots__ = ("table", "key", "pos", "version")
+
+    def __init__(self, table, key, pos):
+        self.table = table
+        self.key = key
+        self.pos = pos
+        self.version = table.version
+
+    def _pos(self):
+        t = self.table
+        if self.version != t.version:  # rows shifted by an insert/delete
+            self.pos = t._find(self.key)
+            self.version = t.version
+        if self.pos < 0:
+            raise KeyError(str(self.key))
+        return self.pos
+
+    def __getitem__(self, field):
+        t = self.table
+        i = t.index.get(field)
+        if i is not None:
+            v = t.cols[i][self._pos()]
+            if v == _NONE:
+                return None
+            if v != _MISSING:
+                return v
+        else:
+            self._pos()
+        return t.extra[self.key][field]
+
+    def __setitem__(self, field, value):
+        t = self.table
+        pos = self._pos()
+        i = t.index.get(field)
+        if i is not None:
+            packed = t._pack(field, value)
+            if packed is not None:
+                t.cols[i][pos] = packed
+                if field in t.extra.get(self.key, ()):
+                    t._drop_extra(self.key, field)
+                return
+            t.cols[i][pos] = _MISSING
+        t.extra.setdefault(self.key, {})[field] = value
+
+    def __delitem__(self, field):
+        t = self.table
+        pos = self._pos()
+        i = t.index.get(field)
+        if i is not None and t.cols[i][pos] != _MISSING:
+            t.cols[i][pos] = _MISSING
+            return
+        if field not in t.extra.get(self.key, ()):
+            raise KeyError(field)
+        t._drop_extra(self.key, field)
+
+    def __iter__(self):
+        t = self.table
+        pos = self._pos()
+        for i, field in enumerate(t.fields):
+            if t.cols[i][pos] != _MISSING:
+                yield field
+        yield from t.extra.get(self.key, ())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        return {k: self[k] for k in self}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+class RecordTable(MutableMapping):
+    """{str user id: record} for one guild, stored column-wise."""
+    __slots__ = ("fields", "lossy", "index", "ids", "cols", "extra", "version")
+
+    def __init__(self, fields, lossy=()):
+        self.fields = tuple(fields)
+        self.lossy = frozenset(lossy)
+        self.index = {f: i for i, f in enumerate(self.fields)}
+        self.ids = array("q")
+        self.cols = [array("q") for _ in self.fields]
+        self.extra = {}   # user id (int) -> {field: value} overflow
+        self.version = 0
+
+    @classmethod
+    def from_records(cls, fields, lossy, records):
+        t = cls(fields, lossy)
+        for key, rec in sorted(((int(k), v) for k, v in records.items()), key=lambda kv: kv[0]):
+            t.ids.append(key)
+            for col in t.cols:
+                col.append(_MISSING)
+            row = Row(t, key, len(t.ids) - 1)
+            for field, value in rec.items():
+                row[field] = value
+        return t
+
+    def _find(self, key):
+        ids = self.ids
+        i = bisect.bisect_left(ids, key)
+        return i if i < len(ids) and ids[i] == key else -1
+
+    def _pack(self, field, value):
+        """Column value for `value`, or None if it has to overflow."""
+        if value is None:
+            return _NONE
+        if value.__class__ is float and field in self.lossy:
+            value = int(value)
+        if value.__class__ is int and _NONE < value < (1 << 63):
+            return value
+        return None
+
+    def _drop_extra(self, key, field):
+        ext = self.extra[key]
+        del ext[field]
+        if not ext:
+            del self.extra[key]
+
+    @staticmethod
+    def _key(uid):
+        try:
+            return int(uid)
+        except (TypeError, ValueError):
+            raise KeyError(uid)
+
+    def __getitem__(self, uid):
+        key = self._key(uid)
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(uid)
+        return Row(self, key, pos)
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def __contains__(self, uid):
+        try:
+            return self._find(int(uid)) >= 0
+        except (TypeError, ValueError):
+            return False
+
+    def __setitem__(self, uid, record):
+        key = self._key(uid)
+        if not isinstance(record, Mapping):
+            raise TypeError("RecordTable values must be mappings")
+        record = dict(record)  # may be one of our own rows
+        pos = self._find(key)
+        if pos < 0:
+            # O(n) shift of every column; new users are rare next to updates
+            pos = bisect.bisect_left(self.ids, key)
+            self.ids.insert(pos, key)
+            for col in self.cols:
+                col.insert(pos, _MISSING)
+            self.version += 1
+        else:
+            for col in self.cols:
+                col[pos] = _MISSING
+            self.extra.pop(key, None)
+        row = Row(self, key, pos)
+        for field, value in record.items():
+            row[field] = value
+
+    def setdefault(self, uid, default=None):
+        row = self.get(uid)
+        if row is None:
+            self[uid] = default
+            row = self[uid]
+        return row
+
+    def __delitem__(self, uid):
+        key = self._key(uid)
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(uid)
+        del self.ids[pos]
+        for col in self.cols:
+            del col[pos]
+        self.extra.pop(key, None)
+        self.version += 1
+
+    def __iter__(self):
+        return map(str, self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def columns(self, *fields):
+        """(uid, value, ...) for every row, straight from the arrays."""
+        cols = [self.cols[self.index[f]] for f in fields]
+        if not self.ids or min(map(min, cols)) > _NONE:
+            return zip(map(str, self.ids), *cols)
+        return self._columns_slow(fields, cols)
+
+    def _columns_slow(self, fields, cols):
+        for pos, (uid, *vals) in enumerate(zip(self.ids, *cols)):
+            if min(vals) <= _NONE:  # None, missing or overflowed: ask the row
+                row = Row(self, uid, pos)
+                vals = [row.get(f) for f in fields]
+            yield (str(uid), *vals)
+
+    def to_dict(self):
+        return {str(key): Row(self, key, pos).to_dict() for pos, key in enumerate(self.ids)}
+
+    def __repr__(self):
+        return f"<RecordTable {len(self)} rows {self.fields}>"
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.ids, *self.cols))
+
+    # snapshot form: (fields, lossy, ids bytes, [column bytes], overflow), little endian
+    def encode(self):
+        arrays = [self.ids, *self.cols]
+        if sys.byteorder != "little":
+            arrays = [array("q", a) for a in arrays]
+            for a in arrays:
+                a.byteswap()
+        return (list(self.fields), sorted(self.lossy), arrays[0].tobytes(), [a.tobytes() for a in arrays[1:]],
+                {k: _encode(v) for k, v in self.extra.items()})
+
+    @classmethod
+    def decode(cls, fields, lossy, ids, cols, extra):
+        t = cls(fields, lossy)
+        t.ids.frombytes(ids)
+        for col, raw in zip(t.cols, cols):
+            col.frombytes(raw)
+        if sys.byteorder != "little":
+            for a in (t.ids, *t.cols):
+                a.byteswap()
+        if any(len(c) != len(t.ids) for c in t.cols):
+            raise ValueError("colonnes de longueurs différentes")
+        t.extra = {int(k): _decode(v) for k, v in extra.items()}
+        return t
+
+def _plain(obj):
+    # json `default=` hook for the persistence paths
+    if isinstance(obj, (RecordTable, Row)):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def columnarize(d, gids=None):
+    """Turn the per-guild dicts of the COLUMNAR sections into RecordTables."""
+    for section, (fields, lossy) in COLUMNAR.items():
+        sec = d.get(section)
+        if not isinstance(sec, dict):
+            continue
+        for gid in (list(dict.keys(sec)) if gids is None else gids):
+            recs = dict.get(sec, gid)
+            if isinstance(recs, RecordTable) and recs.fields != fields:
+                # stored with an older field list: give new fields a column
+                recs = recs.to_dict()
+            # legacy records that are not dicts (bare numbers) stay as they are
+            if isinstance(recs, dict) and all(isinstance(r, dict) for r in recs.values()):
+                dict.__setitem__(sec, gid, RecordTable.from_records(fields, lossy, recs))
+
+def guild_table(section, gid):
+    """data[section][gid] for a COLUMNAR section, created on first use."""
+    sec = data.setdefault(section, {})
+    gid = str(gid)
+    t = sec.get(gid)
+    if t is None:
+        fields, lossy = COLUMNAR[section]
+        t = sec[gid] = RecordTable(fields, lossy)
+    return t
+
+# -------------------------
+# STORAGE BACKENDS
+# -------------------------
+# A store turns the dirty entries of a flush into a payload (prepare, runs on
+# the event loop so it sees a consistent `data`) and writes it (commit, runs
+# in a worker thread). pending=None means "everything".
+class JournalStore:
+    def __init__(self):
+        self.seq = 0
+        self._log = None
+
+    def load(self):
+        d, self.seq, stale = _load_journaled()
+        if stale:
+            # rewrite right away so the journal never mixes two schemas
+            self.commit(self.prepare(d, None))
+        return d
+
+    def prepare(self, d, pending):
+        if pending is None:
+            return ("snapshot", _snapshot_bytes(d, self.seq))
+        lines = []
+        for section, gid, key in pending:
+            self.seq += 1
+            rec = {"n": self.seq, "s": section, "g": gid, "k": key}
+            found, value = _lookup(d, section, gid, key)
+            if found:
+                rec["v"] = value
+            lines.append(json.dumps(rec, ensure_ascii=False, separators=(",", ":"), default=_plain))
+        return ("log", ("\n".join(lines) + "\n").encode("utf-8"))
+
+    def commit(self, payload):
+        kind, blob = payload
+        if kind == "log":
+            if self._log is None:
+                self._log = open(JOURNAL_FILE, "ab")
+                if not self._log.tell():
+                    header = {"format": JOURNAL_FORMAT, "schema": SCHEMA_VERSION}
+                    self._log.write(json.dumps(header).encode("utf-8") + b"\n")
+            self._log.write(blob)
+            self._log.flush()
+            os.fsync(self._log.fileno())  # one fsync per flush, not per change
+            return
+        tmp = DATA_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        if Path(DATA_FILE).exists():
+            os.replace(DATA_FILE, DATA_FILE + ".bak")
+        os.replace(tmp, DATA_FILE)
+        # the snapshot records the last folded seq, so truncating is safe
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        with open(JOURNAL_FILE, "wb") as f:
+            os.fsync(f.fileno())
+
+    def needs_compaction(self):
+        return Path(JOURNAL_FILE).exists() and os.path.getsize(JOURNAL_FILE) >= COMPACT_BYTES
+
+    def evict(self, busy=()):
+        return 0
+
+# section -> (layout, key column). "dict": data[s][gid][key], one row per key;
+# "list": data[s][gid], one row per guild; "flat": data[s][key] with the guild
+# stored inside the value. Sections not listed are kept whole in `misc`.
+SQL_SECTIONS = {
+    "config": ("dict", "key"),
+    "levels": ("dict", "user_id"),
+    "economy": ("dict", "user_id"),
+    "warnings": ("dict", "user_id"),
+    "suggestions": ("dict", "suggestion_id"),
+    "reaction_roles": ("dict", "message_id"),
+    "tickets": ("dict", "channel_id"),
+    "premium_users": ("dict", "user_id"),
+    "auto_responses": ("dict", "trigger"),
+    "roles_invites": ("dict", "key"),
+    "badges": ("dict", "user_id"),
+    "user_invites": ("dict", "user_id"),
+    "mutes": ("dict", "user_id"),
+    "backups": ("list", None),
+    "allowed_links": ("list", None),
+    "giveaways": ("flat", "message_id"),
+    "giveaway_entrants": ("dict", "entry"),
+    "temp_vocs": ("flat", "channel_id"),
+}
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            for section, (layout, col) in SQL_SECTIONS.items():
+                if layout == "dict":
+                    self.conn.execute(f"CREATE TABLE IF NOT EXISTS {section} (guild_id TEXT NOT NULL, {col} TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (guild_id, {col})) WITHOUT ROWID")
+                elif layout == "list":
+                    self.conn.execute(f"CREATE TABLE IF NOT EXISTS {section} (guild_id TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+                else:
+                    self.conn.execute(f"CREATE TABLE IF NOT EXISTS {section} ({col} TEXT PRIMARY KEY, guild_id TEXT, value TEXT NOT NULL) WITHOUT ROWID")
+                    self.conn.execute(f"CREATE INDEX IF NOT EXISTS {section}_guild ON {section} (guild_id)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS misc (section TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def load(self):
+        d = {}
+        for section, (layout, col) in SQL_SECTIONS.items():
+            sec = d.setdefault(section, {})
+            if layout == "dict":
+                for gid, key, value in self.conn.execute(f"SELECT guild_id, {col}, value FROM {section}"):
+                    sec.setdefault(gid, {})[key] = json.loads(value)
+            elif layout == "list":
+                for gid, value in self.conn.execute(f"SELECT guild_id, value FROM {section}"):
+                    sec[gid] = json.loads(value)
+            else:
+                for key, value in self.conn.execute(f"SELECT {col}, value FROM {section}"):
+                    sec[key] = json.loads(value)
+        for section, value in self.conn.execute("SELECT section, value FROM misc"):
+            d[section] = json.loads(value)
+        return d
+
+    def _rows(self, section, layout, content, gid=None):
+        # full set of row ops for a section (gid=None) or one guild of it
+        dumps = lambda v: json.dumps(v, ensure_ascii=False, default=_plain)
+        col = SQL_SECTIONS[section][1]
+        ops = []
+        if layout == "flat":
+            ops.append((f"DELETE FROM {section}", ()))
+            for key, v in content.items():
+                g = v.get("guild") if isinstance(v, dict) else None
+                ops.append((f"INSERT INTO {section} ({col}, guild_id, value) VALUES (?, ?, ?)", (str(key), g, dumps(v))))
+        elif layout == "list":
+            items = content.items() if gid is None else [(gid, content.get(gid))]
+            ops.append((f"DELETE FROM {section}", ()) if gid is None else (f"DELETE FROM {section} WHERE guild_id=?", (gid,)))
+            for g, v in items:
+                if v is not None:
+                    ops.append((f"INSERT INTO {section} (guild_id, value) VALUES (?, ?)", (str(g), dumps(v))))
+        else:
+            items = content.items() if gid is None else [(gid, content.get(gid) or {})]
+            ops.append((f"DELETE FROM {section}", ()) if gid is None else (f"DELETE FROM {section} WHERE guild_id=?", (gid,)))
+            for g, per in items:
+                for key, v in per.items():
+                    ops.append((f"INSERT INTO {section} (guild_id, {col}, value) VALUES (?, ?, ?)", (str(g), str(key), dumps(v))))
+        return ops
+
+    def prepare(self, d, pending):
+        ops = []
+        if pending is None:
+            pending = {(section, None, None) for section in d}
+        for section, gid, key in pending:
+            content = d.get(section, {})
+            spec = SQL_SECTIONS.get(section)
+            if spec is None:
+                ops.append(("INSERT OR REPLACE INTO misc (section, value) VALUES (?, ?)", (section, json.dumps(content, ensure_ascii=False, default=_plain))))
+                continue
+            layout, col = spec
+            if layout == "flat":
+                if key is None:
+                    ops.extend(self._rows(section, layout, content))
+                elif key in content:
+                    v = content[key]
+                    g = v.get("guild") if isinstance(v, dict) else None
+                    ops.append((f"INSERT OR REPLACE INTO {section} ({col}, guild_id, value) VALUES (?, ?, ?)", (key, g, json.dumps(v, ensure_ascii=False, default=_plain))))
+                else:
+                    ops.append((f"DELETE FROM {section} WHERE {col}=?", (key,)))
+            elif layout == "list" or key is None:
+                ops.extend(self._rows(section, layout, content, gid))
+            else:
+                per = content.get(gid, {})
+                if key in per:
+                    ops.append((f"INSERT OR REPLACE INTO {section} (guild_id, {col}, value) VALUES (?, ?, ?)", (gid, key, json.dumps(per[key], ensure_ascii=False, default=_plain))))
+                else:
+                    ops.append((f"DELETE FROM {section} WHERE guild_id=? AND {col}=?", (gid, key)))
+        return ops
+
+    def commit(self, ops):
+        with self.conn:
+            for sql, params in ops:
+                self.conn.execute(sql, params)
+
+    def needs_compaction(self):
+        return False  # WAL checkpoints are handled by sqlite
+
+    def evict(self, busy=()):
+        return 0
+
+    def migrate_from_json(self):
+        """One-shot import of DATA_FILE (+ journal); the old files are renamed afterwards."""
+        if not (Path(DATA_FILE).exists() or Path(JOURNAL_FILE).exists()):
+            return False
+        if self.conn.execute("SELECT 1 FROM meta WHERE key='migrated_from'").fetchone():
+            return False
+        legacy = load_data()
+        ops = self.prepare(legacy, None)
+        ops.append(("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)", (DATA_FILE,)))
+        self.commit(ops)
+        for path in (DATA_FILE, JOURNAL_FILE):
+            if Path(path).exists():
+                os.replace(path, path + ".migrated")
+        print(f"Données migrées de {DATA_FILE} vers {SQLITE_FILE}.")
+        return True
+
+# Shards backend: one file per guild under SHARD_DIR/guilds, plus global.json
+# for the flat sections and the mute timers (rescheduled at startup, so they
+# must be known without loading every guild). Guild shards are read on first
+# access and dropped again once idle, so startup cost and memory follow the
+# active guilds only.
+SHARD_GLOBAL_SECTIONS = ("giveaways", "temp_vocs", "mutes")
+SHARD_SECTIONS = tuple(s for s, (layout, _) in SQL_SECTIONS.items() if layout != "flat" and s not in SHARD_GLOBAL_SECTIONS)
 
-data = load_data()
+class GuildSection(dict):
+    """data[section] for a sharded store: looking a guild up loads its shard.
+    Iterating only sees the guilds that are currently resident."""
+    __slots__ = ("store",)
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def __getitem__(self, gid):
+        self.store.touch(gid)
+        return dict.__getitem__(self, gid)
+
+    def __setitem__(self, gid, value):
+        self.store.touch(gid)
+        dict.__setitem__(self, gid, value)
+
+    def __delitem__(self, gid):
+        self.store.touch(gid)
+        dict.__delitem__(self, gid)
+
+    def __contains__(self, gid):
+        self.store.touch(gid)
+        return dict.__contains__(self, gid)
+
+    def get(self, gid, default=None):
+        self.store.touch(gid)
+        return dict.get(self, gid, default)
+
+    def setdefault(self, gid, default=None):
+        self.store.touch(gid)
+        return dict.setdefault(self, gid, default)
+
+    def pop(self, gid, *default):
+        self.store.touch(gid)
+        return dict.pop(self, gid, *default)
+
+class ShardStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.guild_dir = self.root / "guilds"
+        self.guild_dir.mkdir(parents=True, exist_ok=True)
+        self.global_path = self.root / "global.json"
+        self.data = None
+        self.last_used = {}  # resident guild -> clock of last access
+        self.clock = time.monotonic()  # coarse, advanced by evict()
+        self.loads = 0
+        self.evictions = 0
+
+    def _guild_path(self, gid):
+        name = gid if gid.isdigit() else hashlib.sha1(gid.encode("utf-8")).hexdigest()
+        return self.guild_dir / f"{name}.json"
+
+    def load(self):
+        self.migrate_from_json()
+        d = {s: GuildSection(self) for s in SHARD_SECTIONS}
+        if self.global_path.exists():
+            with open(self.global_path, "r", encoding="utf-8") as f:
+                for section, value in json.load(f).items():
+                    if section not in d:
+                        d[section] = value
+        self.data = d
+        return d
+
+    def touch(self, gid):
+        gid = str(gid)
+        if gid in self.last_used:
+            self.last_used[gid] = self.clock
+            return
+        self.last_used[gid] = self.clock
+        path = self._guild_path(gid)
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            shard = json.load(f)
+        for section, value in shard.items():
+            dict.__setitem__(self.data.setdefault(section, GuildSection(self)), gid, value)
+        columnarize(self.data, (gid,))
+        self.loads += 1
+
+    def _shard_bytes(self, d, gid):
+        shard = {s: dict.__getitem__(d[s], gid) for s in SHARD_SECTIONS if dict.__contains__(d.get(s, {}), gid)}
+        return json.dumps(shard, ensure_ascii=False, separators=(",", ":"), default=_plain).encode("utf-8")
+
+    def _global_bytes(self, d):
+        glob = {k: v for k, v in d.items() if k not in SHARD_SECTIONS}
+        return json.dumps(glob, ensure_ascii=False, separators=(",", ":"), default=_plain).encode("utf-8")
+
+    def prepare(self, d, pending):
+        if pending is None:
+            gids, glob = set(self.last_used), True
+        else:
+            gids, glob = set(), False
+            for section, gid, _ in pending:
+                if section not in SHARD_SECTIONS:
+                    glob = True
+                elif gid is None:
+                    gids.update(self.last_used)
+                else:
+                    gids.add(gid)
+        files = []
+        for gid in gids:
+            self.touch(gid)
+            files.append((self._guild_path(gid), self._shard_bytes(d, gid)))
+        if glob:
+            files.append((self.global_path, self._global_bytes(d)))
+        return files
+
+    def commit(self, files):
+        for path, blob in files:
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                f.write(blob)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+
+    def needs_compaction(self):
+        return False
+
+    def evict(self, busy=()):
+        """Drop idle guilds (SHARD_IDLE) and the least recently used ones past
+        SHARD_MAX_RESIDENT. Guilds with unflushed changes are kept."""
+        self.clock = now = time.monotonic()
+        victims = {gid for gid, t in self.last_used.items() if now - t >= SHARD_IDLE and gid not in busy}
+        over = len(self.last_used) - len(victims) - SHARD_MAX_RESIDENT
+        if over > 0:
+            # a handler may still hold a reference to a guild it just read, so
+            # even the LRU cap only takes guilds idle for SHARD_MIN_IDLE
+            lru = sorted((t, gid) for gid, t in self.last_used.items()
+                         if gid not in victims and gid not in busy and now - t >= SHARD_MIN_IDLE)
+            victims.update(gid for _, gid in lru[:over])
+        for gid in victims:
+            for s in SHARD_SECTIONS:
+                dict.pop(self.data.get(s, {}), gid, None)
+            del self.last_used[gid]
+            for hook in guild_evict_hooks:
+                hook(gid)
+        self.evictions += len(victims)
+        return len(victims)
+
+    def migrate_from_json(self):
+        """One-shot split of DATA_FILE (+ journal) into shards; the old files are renamed."""
+        if self.global_path.exists() or not (Path(DATA_FILE).exists() or Path(JOURNAL_FILE).exists()):
+            return False
+        legacy = load_data()
+        files = []
+        for gid in {gid for s in SHARD_SECTIONS for gid in legacy.get(s, {})}:
+            shard = {s: legacy[s][gid] for s in SHARD_SECTIONS if gid in legacy.get(s, {})}
+            files.append((self._guild_path(gid), json.dumps(shard, ensure_ascii=False, separators=(",", ":"), default=_plain).encode("utf-8")))
+        files.append((self.global_path, self._global_bytes(legacy)))
+        self.commit(files)
+        for path in (DATA_FILE, JOURNAL_FILE):
+            if Path(path).exists():
+                os.replace(path, path + ".migrated")
+        print(f"Données migrées de {DATA_FILE} vers {self.root} ({len(files) - 1} serveurs).")
+        return True
+
+def open_store():
+    if STORAGE_BACKEND == "sqlite":
+        s = SQLiteStore(SQLITE_FILE)
+        s.migrate_from_json()
+        return s
+    if STORAGE_BACKEND == "shards":
+        return ShardStore(SHARD_DIR)
+    return JournalStore()
+
+store = open_store()
+data = store.load()
+columnarize(data)
 # ensure keys
-for k in ["config","warnings","levels","economy","backups","premium_users","auto_responses","suggestions","giveaways","reaction_roles","allowed_links","tickets","roles_invites","badges"]:
+for k in ["config","warnings","levels","economy","backups","premium_users","auto_responses","suggestions","giveaways","giveaway_entrants","reaction_roles","allowed_links","tickets","roles_invites","badges","mutes","user_invites"]:
     data.setdefault(k, {})
 
+def export_json(path):
+    """Everything as pretty-printed json, for debugging (a plain json file is
+    also accepted as DATA_FILE, so this doubles as a way back)."""
+    if isinstance(store, ShardStore):
+        for p in store.guild_dir.glob("*.json"):
+            store.touch(p.stem)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False, default=_plain)
+
+# -------------------------
+# METRICS
+# -------------------------
+# Counters and fixed-bucket latency histograms keyed by (name, labels), plus
+# gauges read on demand. Exposed by +stats and the optional /metrics endpoint.
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    "hoshimi_event_seconds": "Event handler duration",
+    "hoshimi_event_errors_total": "Event handlers that raised",
+    "hoshimi_command_seconds": "Command duration",
+    "hoshimi_commands_total": "Commands invoked",
+    "hoshimi_persist_seconds": "Persistence call duration",
+    "hoshimi_persist_entries_total": "Dirty entries written",
+    "hoshimi_loop_lag_seconds": "Event loop scheduling lag",
+    "hoshimi_http_request_seconds": "Discord API request duration, rate limit waits included",
+    "hoshimi_http_errors_total": "Discord API requests that failed",
+    "hoshimi_http_ratelimited_total": "429 responses seen by discord.py",
+    "hoshimi_ledger_transactions_total": "Economy transactions recorded",
+}
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate, interpolated inside the bucket like histogram_quantile()."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(METRIC_BUCKETS):
+                    return METRIC_BUCKETS[-1]
+                lo = METRIC_BUCKETS[i - 1] if i else 0.0
+                return lo + (METRIC_BUCKETS[i] - lo) * (rank - seen) / n
+            seen += n
+        return METRIC_BUCKETS[-1]
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.gauges = {}   # name -> (help, fn returning a number or [(labels, value)])
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.observe(seconds)
+
+    def gauge(self, name, help, fn):
+        self.gauges[name] = (help, fn)
+
+    def series(self, name):
+        """{labels dict as tuple: Histogram} for one histogram name."""
+        return {labels: h for (n, labels), h in self.histograms.items() if n == name}
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+        out = []
+        seen = set()
+        for (name, labels), v in sorted(self.counters.items()):
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                out.append(f"# TYPE {name} counter")
+            out.append(f"{name}{fmt(labels)} {v:g}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                out.append(f"# TYPE {name} histogram")
+            cum = 0
+            for bound, n in zip(METRIC_BUCKETS, h.counts):
+                cum += n
+                out.append(f"{name}_bucket{fmt(labels, [('le', f'{bound:g}')])} {cum}")
+            out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h.count}")
+            out.append(f"{name}_sum{fmt(labels)} {h.sum:.6f}")
+            out.append(f"{name}_count{fmt(labels)} {h.count}")
+        for name, (help, fn) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} gauge")
+            if isinstance(value, list):
+                for labels, v in value:
+                    out.append(f"{name}{fmt(sorted(labels.items()))} {v:g}")
+            else:
+                out.append(f"{name} {value:g}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+# -------------------------
+# PERSISTENCE (write-behind)
+# -------------------------
+# Handlers mutate `data` in place and call mark_dirty() with what they touched:
+# (section, guild id, key inside the guild). Flat sections such as giveaways or
+# temp_vocs pass gid=None. The flush task coalesces everything into one write.
+_dirty = set()
+_dirty_since = None
+_flush_lock = asyncio.Lock()
+persist_stats = {"flushes": 0, "entries": 0, "compactions": 0, "last_flush": None, "last_duration": 0.0}
+guild_evict_hooks = []  # fn(gid) run when a sharded store drops a guild from memory
+
+def mark_dirty(section, gid=None, key=None):
+    global _dirty_since
+    _dirty.add((section, None if gid is None else str(gid), None if key is None else str(key)))
+    if _dirty_since is None:
+        _dirty_since = time.monotonic()
+
+def pending_changes():
+    """Number of dirty entries and age (seconds) of the oldest one."""
+    age = time.monotonic() - _dirty_since if _dirty_since is not None else 0.0
+    return len(_dirty), age
+
+def _take_dirty():
+    global _dirty_since
+    pending = set(_dirty)
+    _dirty.clear()
+    _dirty_since = None
+    return pending
+
+def _record_flush(pending, started):
+    persist_stats["flushes"] += 1
+    persist_stats["entries"] += len(pending)
+    persist_stats["last_flush"] = time.time()
+    persist_stats["last_duration"] = time.perf_counter() - started
+    metrics.observe("hoshimi_persist_seconds", persist_stats["last_duration"], op="flush")
+    metrics.inc("hoshimi_persist_entries_total", len(pending))
+
+def flush_data():
+    """Synchronous flush, used at shutdown."""
+    if not _dirty:
+        return 0
+    started = time.perf_counter()
+    pending = _take_dirty()
+    seq = ledger.seq
+    ledger.append(ledger.take())
+    store.commit(store.prepare(data, pending))
+    ledger.durable = seq
+    _record_flush(pending, started)
+    return len(pending)
+
+async def flush_data_async():
+    # Prepare on the loop so the snapshot is consistent, commit in a thread.
+    async with _flush_lock:
+        if not _dirty:
+            return 0
+        started = time.perf_counter()
+        pending = _take_dirty()
+        seq, lines = ledger.seq, ledger.take()
+        payload = store.prepare(data, pending)
+        try:
+            # ledger first: the file is never behind the balances it explains
+            await asyncio.to_thread(ledger.append, lines)
+            lines = ()
+            await asyncio.to_thread(store.commit, payload)
+        except Exception:
+            # keep the entries so the next tick retries them
+            ledger.requeue(lines)
+            for entry in pending:
+                mark_dirty(*entry)
+            raise
+        ledger.durable = seq
+        _record_flush(pending, started)
+        return len(pending)
+
+async def compact_data_async():
+    """Fold the journal into a fresh snapshot (also covers pending entries)."""
+    async with _flush_lock:
+        started = time.perf_counter()
+        pending = _take_dirty()
+        seq, lines = ledger.seq, ledger.take()
+        payload = store.prepare(data, None)
+        try:
+            await asyncio.to_thread(ledger.append, lines)
+            lines = ()
+            await asyncio.to_thread(store.commit, payload)
+        except Exception:
+            ledger.requeue(lines)
+            for entry in pending:
+                mark_dirty(*entry)
+            raise
+        ledger.durable = seq
+        persist_stats["compactions"] += 1
+        metrics.observe("hoshimi_persist_seconds", time.perf_counter() - started, op="compact")
+
+@tasks.loop(seconds=1.0)
+async def flush_dirty_data():
+    count, age = pending_changes()
+    try:
+        if count and (count >= FLUSH_MAX_DIRTY or age >= FLUSH_INTERVAL):
+            await flush_data_async()
+        else:
+            await flush_ledger_async()
+    except Exception as e:
+        print("Erreur de sauvegarde:", e)
+    store.evict({gid for _, gid, _ in _dirty})
+
+@tasks.loop(seconds=60.0)
+async def compact_journal():
+    if store.needs_compaction():
+        try:
+            await compact_data_async()
+        except Exception as e:
+            print("Erreur de compaction:", e)
+
+# -------------------------
+# ECONOMY LEDGER
+# -------------------------
+# Every balance change is a transaction {seq, t, g, kind, amount, from, to}
+# applied to data["economy"] (the money column doubles as the balance cache)
+# and appended to LEDGER_FILE. Each account row keeps the seq of the last
+# transaction applied to it, so it is saved atomically with its balance. At
+# startup every line still in the file is replayed against the rows whose seq
+# is older; the stores may commit rows and data["ledger"] in any order.
+class Ledger:
+    def __init__(self, path):
+        self.path = path
+        self.buf = []       # json lines not written yet
+        self.seq = 0        # last transaction applied to `data`
+        self.durable = 0    # last transaction covered by a committed flush
+        self.rolled_at = time.monotonic()
+
+    def load(self, d):
+        self.seq = self.durable = base = d.setdefault("ledger", {}).get("seq", 0)
+        if not Path(self.path).exists():
+            return 0
+        self.durable = 0  # until a flush commits whatever the replay fixes
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        if raw and not raw.endswith(b"\n"):
+            # torn last line: drop it so the next append starts clean
+            raw = raw[:raw.rfind(b"\n") + 1]
+            with open(self.path, "r+b") as f:
+                f.truncate(len(raw))
+        replayed = 0
+        for line in raw.splitlines():
+            try:
+                tx = json.loads(line)
+            except ValueError:
+                continue
+            self.seq = max(self.seq, tx["seq"])
+            if _apply_tx(tx, base):
+                replayed += 1
+        if d["ledger"].get("seq", 0) != self.seq:
+            d["ledger"]["seq"] = self.seq
+            mark_dirty("ledger", None, "seq")
+        if replayed:
+            print(f"Registre: {replayed} transaction(s) rejouée(s).")
+        else:
+            self.durable = self.seq
+        return replayed
+
+    def record(self, gid, kind, amount, src=None, dst=None, **extra):
+        self.seq += 1
+        tx = {"seq": self.seq, "t": time.time(), "g": str(gid), "kind": kind, "amount": amount,
+              "from": None if src is None else str(src), "to": None if dst is None else str(dst), **extra}
+        _apply_tx(tx)
+        data.setdefault("ledger", {})["seq"] = self.seq
+        mark_dirty("ledger", None, "seq")
+        self.buf.append(json.dumps(tx, ensure_ascii=False, separators=(",", ":")))
+        metrics.inc("hoshimi_ledger_transactions_total", kind=kind)
+        return tx
+
+    def take(self):
+        lines, self.buf = self.buf, []
+        return lines
+
+    def requeue(self, lines):
+        if lines:
+            self.buf[:0] = lines
+
+    def append(self, lines):
+        if not lines:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def needs_rollup(self):
+        if not Path(self.path).exists():
+            return False
+        return os.path.getsize(self.path) >= LEDGER_ROLLUP_BYTES or \
+            time.monotonic() - self.rolled_at >= LEDGER_ROLLUP_INTERVAL
+
+    def rollup(self):
+        """Drop the lines covered by a committed flush; returns their totals per guild."""
+        keep, summary = [], {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    tx = json.loads(line)
+                except ValueError:
+                    continue
+                if tx["seq"] > self.durable:
+                    keep.append(line)
+                    continue
+                s = summary.setdefault(tx["g"], {"count": 0, "volume": {}, "seq": 0})
+                s["count"] += 1
+                s["volume"][tx["kind"]] = s["volume"].get(tx["kind"], 0) + tx["amount"]
+                s["seq"] = max(s["seq"], tx["seq"])
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(keep)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.rolled_at = time.monotonic()
+        return summary
+
+ECONOMY_DEFAULT = {"money": 0, "last_daily": None, "seq": 0}
+
+def _apply_tx(tx, legacy_seq=0):
+    """Apply a transaction to the accounts that have not seen it yet.
+    Rows saved before accounts had a seq are taken as up to `legacy_seq`."""
+    table = guild_table("economy", tx["g"])
+    applied = False
+    for uid, sign in ((tx.get("from"), -1), (tx.get("to"), 1)):
+        if uid is None:
+            continue
+        row = table.setdefault(uid, dict(ECONOMY_DEFAULT))
+        seen = row.get("seq")
+        if (legacy_seq if seen is None else seen) >= tx["seq"]:
+            continue
+        row["money"] = (row.get("money") or 0) + sign * tx["amount"]
+        if tx["kind"] == "daily":
+            row["last_daily"] = tx["t"]
+        row["seq"] = tx["seq"]
+        mark_dirty("economy", tx["g"], uid)
+        applied = True
+    return applied
+
+async def flush_ledger_async():
+    if not ledger.buf:
+        return 0
+    async with _flush_lock:
+        lines = ledger.take()
+        try:
+            await asyncio.to_thread(ledger.append, lines)
+        except Exception:
+            ledger.requeue(lines)
+            raise
+        return len(lines)
+
+async def rollup_ledger_async():
+    async with _flush_lock:
+        summary = await asyncio.to_thread(ledger.rollup)
+    rollups = data.setdefault("ledger_rollups", {})
+    for gid, s in summary.items():
+        cur = rollups.setdefault(gid, {"count": 0, "volume": {}, "seq": 0})
+        cur["count"] += s["count"]
+        for kind, amount in s["volume"].items():
+            cur["volume"][kind] = cur["volume"].get(kind, 0) + amount
+        cur["seq"] = max(cur["seq"], s["seq"])
+        mark_dirty("ledger_rollups", gid)
+    return summary
+
+@tasks.loop(seconds=60.0)
+async def ledger_rollup():
+    if ledger.durable and ledger.needs_rollup():
+        try:
+            await rollup_ledger_async()
+        except Exception as e:
+            print("Erreur de cumul du registre:", e)
+
+ledger = Ledger(LEDGER_FILE)
+ledger.load(data)
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
@@ -50,15 +1368,15 @@ def get_conf(gid, key, default=None):
 
 def set_conf(gid, key, value):
     data.setdefault("config", {}).setdefault(str(gid), {})[key] = value
-    save_data(data)
+    mark_dirty("config", gid, key)
 
 # Utilities
 def ensure_guild(gid):
     gid = str(gid)
     data.setdefault("config", {}).setdefault(gid, {})
     data.setdefault("warnings", {}).setdefault(gid, {})
-    data.setdefault("levels", {}).setdefault(gid, {})
-    data.setdefault("economy", {}).setdefault(gid, {})
+    guild_table("levels", gid)
+    guild_table("economy", gid)
     data.setdefault("backups", {}).setdefault(gid, [])
     data.setdefault("premium_users", {}).setdefault(gid, {})
     data.setdefault("auto_responses", {}).setdefault(gid, {})
@@ -68,6 +1386,7 @@ def ensure_guild(gid):
     data.setdefault("tickets", {}).setdefault(gid, {})
     data.setdefault("roles_invites", {}).setdefault(gid, {})
     data.setdefault("badges", {}).setdefault(gid, {})
+    data.setdefault("user_invites", {}).setdefault(gid, {})
 
 async def safe_send(channel, content=None, embed=None, delete_after=None):
     try:
@@ -75,6 +1394,86 @@ async def safe_send(channel, content=None, embed=None, delete_after=None):
     except Exception:
         return None
 
+# Log dispatcher: embeds are queued per logs channel and sent up to LOG_BATCH
+# (and LOG_BATCH_CHARS characters, Discord's limit across a message's embeds)
+# per message, after LOG_FLUSH_DELAY seconds or as soon as a batch is full.
+# A send waits on discord.py's rate limiter, so a backlog builds up in the
+# queue; past LOG_QUEUE_MAX, low-priority events are dropped first.
+LOG_BATCH = 10
+LOG_BATCH_CHARS = 6000
+LOG_FLUSH_DELAY = 2.0
+LOG_QUEUE_MAX = 500
+LOW_PRIORITY_LOGS = {"member_join", "automod", "antispam", "link"}
+
+class LogDispatcher:
+    def __init__(self):
+        self.queues = {}   # channel id -> (high deque, low deque)
+        self.workers = {}
+        self.wakeups = {}
+        self.sent_messages = 0
+        self.sent_embeds = 0
+        self.dropped = 0
+
+    def depth(self, channel_id=None):
+        if channel_id is not None:
+            return sum(len(q) for q in self.queues.get(channel_id, ()))
+        return sum(len(h) + len(l) for h, l in self.queues.values())
+
+    def enqueue(self, channel, embed, low=False):
+        high_q, low_q = self.queues.setdefault(channel.id, (deque(), deque()))
+        if len(high_q) + len(low_q) >= LOG_QUEUE_MAX:
+            if low_q:
+                low_q.popleft()
+            elif low:
+                self.dropped += 1
+                return
+            else:
+                high_q.popleft()
+            self.dropped += 1
+        (low_q if low else high_q).append(embed)
+        worker = self.workers.get(channel.id)
+        if worker is None or worker.done():
+            self.wakeups[channel.id] = asyncio.Event()
+            self.workers[channel.id] = asyncio.create_task(self._drain(channel))
+        elif len(high_q) + len(low_q) >= LOG_BATCH:
+            self.wakeups[channel.id].set()
+
+    async def _drain(self, channel):
+        high_q, low_q = self.queues[channel.id]
+        wake = self.wakeups[channel.id]
+        while high_q or low_q:
+            if len(high_q) + len(low_q) < LOG_BATCH:
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=LOG_FLUSH_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+            wake.clear()
+            batch, size = [], 0
+            while len(batch) < LOG_BATCH and (high_q or low_q):
+                q = high_q or low_q
+                if batch and size + len(q[0]) > LOG_BATCH_CHARS:
+                    break
+                size += len(q[0])
+                batch.append(q.popleft())
+            if not await self._send(channel, batch) and len(batch) > 1:
+                # rejected batch: one embed per message so only a bad one is lost
+                for embed in batch:
+                    await self._send(channel, [embed])
+
+    async def _send(self, channel, batch):
+        try:
+            await channel.send(embeds=batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self.dropped += 1
+                print(f"Log non envoyé dans #{getattr(channel, 'name', channel.id)}:", e)
+            return False
+        self.sent_messages += 1
+        self.sent_embeds += len(batch)
+        return True
+
+log_dispatcher = LogDispatcher()
+
 # Basic logging helper
 async def log_action(guild, action_type, **kwargs):
     log_ch = get_conf(guild.id, "logs_channel")
@@ -86,10 +1485,1127 @@ async def log_action(guild, action_type, **kwargs):
     e = discord.Embed(title=f"Log: {action_type}", color=0xff69b4, timestamp=datetime.datetime.utcnow())
     for k,v in kwargs.items():
         e.add_field(name=str(k), value=str(v), inline=True)
+    log_dispatcher.enqueue(ch, e, low=action_type in LOW_PRIORITY_LOGS)
+
+# -------------------------
+# AUTOMOD MATCHING
+# -------------------------
+# Messages and bad words go through the same normalization (case folding,
+# accent stripping, leetspeak), then one Aho-Corasick pass finds any word.
+_LEET = str.maketrans({"0":"o", "1":"i", "3":"e", "4":"a", "5":"s", "7":"t", "8":"b", "@":"a", "$":"s", "!":"i", "|":"i"})
+_COMBINING = re.compile(r"[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]")
+
+def normalize_text(text):
+    text = text.casefold()
+    if not text.isascii():
+        text = _COMBINING.sub("", unicodedata.normalize("NFKD", text))
+    return text.translate(_LEET)
+
+class BadWordMatcher:
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [None]
+        for w in words:
+            w_norm = normalize_text(w)
+            if not w_norm:
+                continue
+            node = 0
+            for c in w_norm:
+                nxt = self.goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][c] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(None)
+                node = nxt
+            if self.out[node] is None:
+                self.out[node] = w
+        # breadth-first failure links; out[] inherits the shortest suffix match
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for c, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                if self.out[nxt] is None:
+                    self.out[nxt] = self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def search(self, text):
+        """Return the first configured word found in text, or None."""
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for c in normalize_text(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node] is not None:
+                return out[node]
+        return None
+
+_badword_matchers = {}
+
+def get_badword_matcher(gid):
+    gid = str(gid)
+    m = _badword_matchers.get(gid)
+    if m is None:
+        m = _badword_matchers[gid] = BadWordMatcher(get_conf(gid, "bad_words", []) or [])
+    return m
+
+def invalidate_badwords(gid):
+    _badword_matchers.pop(str(gid), None)
+
+guild_evict_hooks.append(invalidate_badwords)
+
+# -------------------------
+# AUTO-RESPONSE ENGINE
+# -------------------------
+# Stored as auto_responses[gid][trigger] = {"response", "mode", "cooldown"}
+# (a bare string is the legacy "contains" form). "exact" triggers are a dict
+# lookup; contains/word/prefix triggers share one Aho-Corasick automaton (one
+# pass over the message, then the mode's position rule is checked on each
+# hit); only regex triggers are compiled and tried individually.
+AR_MODES = ("contains", "exact", "word", "prefix", "regex")
+AR_TRIGGER_COOLDOWN = 10.0  # seconds, same trigger in the same channel
+AR_CHANNEL_COOLDOWN = 3.0   # seconds, any auto-response in the same channel
+AR_COOLDOWN_SLOTS = 10000
+
+def _ar_entry(value):
+    if isinstance(value, str):
+        return {"response": value, "mode": "contains"}
+    return value
+
+def _is_word_char(c):
+    return c.isalnum() or c == "_"
+
+class ResponseEngine:
+    def __init__(self, responses):
+        self.entries = {}
+        self.exact = {}
+        self.regexes = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]  # (trigger, mode, length) of every trigger ending at a node
+        for trigger, value in responses.items():
+            entry = _ar_entry(value)
+            mode = entry.get("mode", "contains")
+            if mode == "regex":
+                try:
+                    self.regexes.append((re.compile(trigger, re.IGNORECASE), trigger))
+                except re.error:
+                    continue
+            elif mode == "exact":
+                self.exact.setdefault(trigger.strip().casefold(), trigger)
+            else:
+                key = trigger.casefold()
+                if not key:
+                    continue
+                self._add(key, (trigger, mode, len(key)))
+            self.entries[trigger] = entry
+        # breadth-first failure links; a node also reports its suffixes' triggers
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for c, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def _add(self, key, hit):
+        node = 0
+        for c in key:
+            nxt = self.goto[node].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][c] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            node = nxt
+        self.out[node] += (hit,)
+
+    def match(self, content):
+        """(trigger, entry) of the matching auto-response, or None."""
+        text = content.casefold()
+        if self.exact:
+            trigger = self.exact.get(text.strip())
+            if trigger is not None:
+                return trigger, self.entries[trigger]
+        if len(self.goto) > 1:
+            goto, fail, out = self.goto, self.fail, self.out
+            node = 0
+            for end, c in enumerate(text, 1):
+                while node and c not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(c, 0)
+                if not out[node]:
+                    continue
+                for trigger, mode, n in out[node]:
+                    start = end - n
+                    if mode == "prefix" and start:
+                        continue
+                    if mode == "word" and ((start and _is_word_char(text[start-1])) or (end < len(text) and _is_word_char(text[end]))):
+                        continue
+                    return trigger, self.entries[trigger]
+        for rx, trigger in self.regexes:
+            if rx.search(content):
+                return trigger, self.entries[trigger]
+        return None
+
+_response_engines = {}
+_ar_cooldowns = OrderedDict()  # key -> last fire (monotonic), bounded LRU
+
+def get_response_engine(gid):
+    gid = str(gid)
+    eng = _response_engines.get(gid)
+    if eng is None:
+        eng = _response_engines[gid] = ResponseEngine(data.get("auto_responses", {}).get(gid, {}))
+    return eng
+
+def invalidate_responses(gid):
+    _response_engines.pop(str(gid), None)
+
+guild_evict_hooks.append(invalidate_responses)
+
+def _cooldown_ready(key, cooldown, now):
+    last = _ar_cooldowns.get(key)
+    return last is None or now - last >= cooldown
+
+def _cooldown_touch(key, now):
+    _ar_cooldowns[key] = now
+    _ar_cooldowns.move_to_end(key)
+    while len(_ar_cooldowns) > AR_COOLDOWN_SLOTS:
+        _ar_cooldowns.popitem(last=False)
+
+def response_allowed(gid, channel_id, trigger, entry):
+    now = time.monotonic()
+    tkey = (gid, channel_id, trigger)
+    ckey = (gid, channel_id)
+    channel_cd = get_conf(gid, "ar_channel_cooldown", AR_CHANNEL_COOLDOWN)
+    if not (_cooldown_ready(tkey, entry.get("cooldown", AR_TRIGGER_COOLDOWN), now) and _cooldown_ready(ckey, channel_cd, now)):
+        return False
+    _cooldown_touch(tkey, now)
+    _cooldown_touch(ckey, now)
+    return True
+
+# -------------------------
+# LEADERBOARD INDEX
+# -------------------------
+class SortedKeyList:
+    """Sorted list split in buckets of ~LOAD keys (insert/remove in O(log n + LOAD))."""
+    LOAD = 512
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self.buckets = [keys[i:i+self.LOAD] for i in range(0, len(keys), self.LOAD)]
+        self.maxes = [b[-1] for b in self.buckets]
+        self.size = len(keys)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key):
+        self.size += 1
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self.maxes, key), len(self.buckets) - 1)
+        b = self.buckets[i]
+        bisect.insort(b, key)
+        self.maxes[i] = b[-1]
+        if len(b) > 2 * self.LOAD:
+            self.buckets[i:i+1] = [b[:self.LOAD], b[self.LOAD:]]
+            self.maxes[i:i+1] = [b[self.LOAD-1], b[-1]]
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        b = self.buckets[i]
+        del b[bisect.bisect_left(b, key)]
+        self.size -= 1
+        if b:
+            self.maxes[i] = b[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def index(self, key):
+        i = bisect.bisect_left(self.maxes, key)
+        if i == len(self.buckets):
+            return self.size
+        return sum(len(b) for b in self.buckets[:i]) + bisect.bisect_left(self.buckets[i], key)
+
+    def islice(self, start, stop):
+        for b in self.buckets:
+            if start >= len(b):
+                start -= len(b)
+                stop -= len(b)
+                continue
+            for key in b[start:stop]:
+                yield key
+            stop -= len(b)
+            start = 0
+            if stop <= 0:
+                return
+
+class LevelIndex:
+    """Per-guild ranking, best first: keys are (-level, -xp, uid)."""
+    def __init__(self, levels):
+        rows = levels.columns("level", "xp") if isinstance(levels, RecordTable) else \
+            ((uid, u["level"], u["xp"]) for uid, u in levels.items())
+        self.keys_by_uid = {uid: (-level, -xp, uid) for uid, level, xp in rows}
+        self.ranked = SortedKeyList(self.keys_by_uid.values())
+
+    def update(self, uid, user):
+        key = (-user["level"], -user["xp"], uid)
+        old = self.keys_by_uid.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            self.ranked.remove(old)
+        self.ranked.add(key)
+        self.keys_by_uid[uid] = key
+
+    def position(self, uid):
+        """1-based rank of uid, or None if not tracked."""
+        key = self.keys_by_uid.get(uid)
+        return None if key is None else self.ranked.index(key) + 1
+
+    def page(self, start, count):
+        return [k[2] for k in self.ranked.islice(start, start + count)]
+
+_level_indexes = {}
+
+def get_level_index(gid):
+    gid = str(gid)
+    idx = _level_indexes.get(gid)
+    if idx is None:
+        idx = _level_indexes[gid] = LevelIndex(data.get("levels", {}).get(gid, {}))
+    return idx
+
+def level_index_update(gid, uid, user):
+    # indexes are built on first use; until then there is nothing to maintain
+    idx = _level_indexes.get(str(gid))
+    if idx is not None:
+        idx.update(str(uid), user)
+
+def drop_level_index(gid):
+    _level_indexes.pop(str(gid), None)
+
+guild_evict_hooks.append(drop_level_index)
+
+# -------------------------
+# XP ENGINE
+# -------------------------
+# Messages only earn XP once per XP_COOLDOWN per user; gains are summed in
+# memory and applied every XP_FLUSH_INTERVAL seconds (one row update and one
+# dirty entry per user per flush). Level L -> L+1 costs 100*L XP, so reaching
+# level L takes 50*L*(L-1) XP in total; `xp` stays the progress inside the
+# current level, as before.
+XP_COOLDOWN = float(os.environ.get("HOSHIMI_XP_COOLDOWN", "60"))
+XP_FLUSH_INTERVAL = 5.0
+XP_GAIN = (10, 20)
+XP_MAX_LEVEL = 1000
+XP_THRESHOLDS = [50 * lvl * (lvl - 1) for lvl in range(1, XP_MAX_LEVEL + 1)]
+
+def level_threshold(level):
+    """Total XP needed to reach `level`."""
+    return 50 * level * (level - 1)
+
+def level_from_total(total):
+    """(level, xp inside that level) for a total XP amount."""
+    total = max(0, int(total))
+    if total < XP_THRESHOLDS[-1]:
+        level = bisect.bisect_right(XP_THRESHOLDS, total)
+    else:
+        # closed form of 50*L*(L-1) <= total, then fix the isqrt rounding
+        level = (1 + math.isqrt(1 + 2 * total // 25)) // 2
+        while level_threshold(level + 1) <= total:
+            level += 1
+        while level_threshold(level) > total:
+            level -= 1
+    return level, total - level_threshold(level)
+
+def total_xp(user):
+    return level_threshold(max(1, user.get("level", 1))) + max(0, user.get("xp", 0))
+
+_xp_pending = {}   # (gid, uid) -> [xp gained, messages]
+_xp_last = {}      # (gid, uid) -> monotonic time of the last XP award
+_levelups = deque()  # (gid, uid, new level) waiting to be announced
+_reward_tasks = set()  # running grant_level_rewards() tasks
+
+def award_xp(gid, uid, now):
+    """Count a message; grants XP unless the author is on cooldown."""
+    key = (gid, uid)
+    pending = _xp_pending.get(key)
+    if pending is None:
+        pending = _xp_pending[key] = [0, 0]
+    pending[1] += 1
+    last = _xp_last.get(key)
+    if last is None or now - last >= get_conf(gid, "xp_cooldown", XP_COOLDOWN):
+        _xp_last[key] = now
+        pending[0] += random.randint(*XP_GAIN)
+
+def apply_xp(gid, uid, gained=0, messages=0, announce=True):
+    """Add XP to a user, cascading through as many levels as needed."""
+    user = guild_table("levels", gid).setdefault(uid, {"xp":0,"level":1,"messages":0})
+    old = user["level"]
+    level, xp = level_from_total(total_xp(user) + gained)
+    user["level"] = level
+    user["xp"] = xp
+    if messages:
+        user["messages"] += messages
+    level_index_update(gid, uid, user)
+    mark_dirty("levels", gid, uid)
+    if announce and level > old:
+        _levelups.append((gid, uid, level))
+    return user
+
+def apply_pending_xp(only=None):
+    """Fold pending gains into the level table (all users, or only one key)."""
+    if only is not None:
+        batch = {only: _xp_pending.pop(only)} if only in _xp_pending else {}
+    else:
+        batch = dict(_xp_pending)
+        _xp_pending.clear()
+    for (gid, uid), (gained, messages) in batch.items():
+        apply_xp(gid, uid, gained, messages)
+    return len(batch)
+
+async def announce_levelups():
+    # one message per guild per flush, each user once at their final level
+    per_guild = {}
+    while _levelups:
+        gid, uid, level = _levelups.popleft()
+        per_guild.setdefault(gid, {})[uid] = level
+    for gid, ups in per_guild.items():
+        guild = bot.get_guild(int(gid))
+        if not guild:
+            continue
+        # rate-limited role edits run on their own, the XP flush goes on
+        task = asyncio.create_task(grant_level_rewards(guild, ups))
+        _reward_tasks.add(task)
+        task.add_done_callback(_reward_tasks.discard)
+        lc = get_conf(gid, "level_channel")
+        ch = guild.get_channel(lc) if lc else None
+        if not ch:
+            continue
+        lines = [f"<@{uid}> est maintenant niveau {level}" for uid, level in ups.items()]
+        if len(lines) > 20:
+            lines = lines[:20] + [f"… et {len(lines) - 20} autres"]
+        await safe_send(ch, embed=discord.Embed(title="Level Up !", description="\n".join(lines)))
+
+@tasks.loop(seconds=XP_FLUSH_INTERVAL)
+async def xp_flush():
+    apply_pending_xp()
+    now = time.monotonic()
+    for key in [k for k, t in _xp_last.items() if now - t >= max(XP_COOLDOWN, 3600)]:
+        del _xp_last[key]
+    await announce_levelups()
+
+# -------------------------
+# SCHEDULER
+# -------------------------
+class Scheduler:
+    """Min-heap of (due timestamp, key); sleeps until the earliest entry is due.
+
+    Rescheduling or cancelling only updates `due`; stale heap entries are
+    skipped when they reach the top. Callbacks run as separate tasks."""
+    def __init__(self, name, callback):
+        self.name = name
+        self.callback = callback
+        self.heap = []
+        self.due = {}
+        self.fired = 0
+        self._wake = asyncio.Event()
+        self._task = None
+        self._running = set()
+
+    def schedule(self, key, when):
+        self.due[key] = when
+        heapq.heappush(self.heap, (when, key))
+        self._wake.set()
+
+    def cancel(self, key):
+        if self.due.pop(key, None) is not None:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def lag(self):
+        """Seconds the earliest entry is overdue (0 when on time)."""
+        self._drop_stale()
+        return max(0.0, time.time() - self.heap[0][0]) if self.heap else 0.0
+
+    def _drop_stale(self):
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            self._drop_stale()
+            if not self.heap:
+                await self._wake.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, key = heapq.heappop(self.heap)
+            del self.due[key]
+            self.fired += 1
+            task = asyncio.create_task(self._fire(key))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _fire(self, key):
+        try:
+            await self.callback(key)
+        except Exception as e:
+            print(f"Erreur {self.name} ({key}):", e)
+
+def utc_timestamp(iso):
+    """Timestamp of a naive-UTC isoformat string as stored in data."""
+    return datetime.datetime.fromisoformat(iso).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+# -------------------------
+# ANTI-SPAM
+# -------------------------
+# One SpamState per (guild, user): a ring buffer of the last max_messages
+# timestamps (rate = buffer full and its oldest entry inside the window) plus
+# a run counter of identical content hashes, so each message is an O(1)
+# check. States live in an LRU ordered by last message and are evicted once
+# idle for ANTISPAM_IDLE seconds or past ANTISPAM_MAX_TRACKED entries.
+ANTISPAM_DEFAULTS = {"max_messages": 5, "window": 5.0, "max_duplicates": 3, "max_mentions": 5,
+                     "max_emojis": 10, "timeout": 300, "ladder": ["delete", "timeout", "kick"]}
+ANTISPAM_IDLE = 120.0
+ANTISPAM_MAX_TRACKED = 200000
+ANTISPAM_STRIKE_RESET = 600.0
+_EMOJI = re.compile(r"<a?:\w+:\d+>|[\U0001F300-\U0001FAFF\u2600-\u27BF]")
+
+class SpamState:
+    __slots__ = ("stamps", "last_hash", "dup_count", "dup_start", "strikes", "last_strike", "seen")
+
+    def __init__(self, size):
+        self.stamps = deque(maxlen=size)
+        self.last_hash = None
+        self.dup_count = 0
+        self.dup_start = 0.0
+        self.strikes = 0
+        self.last_strike = 0.0
+        self.seen = 0.0
+
+_spam_states = OrderedDict()
+
+def antispam_conf(gid):
+    return {**ANTISPAM_DEFAULTS, **(get_conf(gid, "antispam") or {})}
+
+def _spam_state(key, size, now):
+    st = _spam_states.get(key)
+    if st is None or st.stamps.maxlen != size:
+        st = _spam_states[key] = SpamState(size)
+    else:
+        _spam_states.move_to_end(key)
+    st.seen = now
+    while _spam_states:
+        oldest = next(iter(_spam_states.values()))
+        if now - oldest.seen < ANTISPAM_IDLE and len(_spam_states) <= ANTISPAM_MAX_TRACKED:
+            break
+        _spam_states.popitem(last=False)
+    return st
+
+def check_spam(message, conf, now):
+    """Return (state, reason) where reason is None if the message is fine."""
+    st = _spam_state((message.guild.id, message.author.id), conf["max_messages"], now)
+    window = conf["window"]
+    st.stamps.append(now)
+    h = hash(message.content)
+    if h == st.last_hash and now - st.dup_start <= window * 6:
+        st.dup_count += 1
+    else:
+        st.last_hash, st.dup_count, st.dup_start = h, 1, now
+    if len(st.stamps) == st.stamps.maxlen and now - st.stamps[0] < window:
+        return st, "rate"
+    if message.content and st.dup_count >= conf["max_duplicates"]:
+        return st, "duplicate"
+    if len(message.raw_mentions) + len(message.raw_role_mentions) >= conf["max_mentions"]:
+        return st, "mentions"
+    if not message.content.isascii() or "<" in message.content:
+        if len(_EMOJI.findall(message.content)) >= conf["max_emojis"]:
+            return st, "emojis"
+    return st, None
+
+async def punish_spam(message, st, conf, reason, now):
+    if now - st.last_strike > ANTISPAM_STRIKE_RESET:
+        st.strikes = 0
+    st.strikes += 1
+    st.last_strike = now
+    ladder = conf["ladder"] or ["delete"]
+    action = ladder[min(st.strikes, len(ladder)) - 1]
+    member = message.author
     try:
-        await ch.send(embed=e)
-    except Exception:
+        await message.delete()
+    except:
         pass
+    try:
+        if action == "timeout":
+            await member.timeout(datetime.timedelta(seconds=conf["timeout"]), reason=f"Anti-spam ({reason})")
+        elif action == "kick":
+            await member.kick(reason=f"Anti-spam ({reason})")
+    except:
+        pass
+    await log_action(message.guild, "antispam", member=member.mention, reason=reason, action=action, strikes=st.strikes)
+
+# -------------------------
+# ANTI-RAID
+# -------------------------
+# Joins feed a per-guild ring of one-second buckets, weighted by suspicion
+# (+1 for an account younger than RAID_MIN_ACCOUNT_AGE, +1 for no avatar).
+# When the weighted joins over RAID_WINDOW seconds reach raid_score, the
+# guild enters raid mode: verification goes to highest, welcome/log/auto-role
+# fan-out stops, and suspicious joiners are queued for a batched action.
+# Raid mode ends after RAID_CALM seconds without joins, or with +raidoff.
+RAID_WINDOW = 10
+RAID_SCORE = 20
+RAID_MIN_ACCOUNT_AGE = 7*86400
+RAID_CALM = 300.0
+RAID_TICK = 2.0
+
+class JoinRateCounter:
+    def __init__(self, size=RAID_WINDOW):
+        self.stamps = [0]*size
+        self.counts = [0]*size
+
+    def add(self, now, weight=1):
+        sec = int(now)
+        i = sec % len(self.stamps)
+        if self.stamps[i] != sec:
+            self.stamps[i] = sec
+            self.counts[i] = 0
+        self.counts[i] += weight
+
+    def total(self, now):
+        sec = int(now)
+        n = len(self.stamps)
+        return sum(c for st, c in zip(self.stamps, self.counts) if sec - st < n)
+
+class RaidState:
+    def __init__(self):
+        self.counter = JoinRateCounter()
+        self.recent = deque(maxlen=500)  # (monotonic time, member): suspicious joins before the trip
+        self.flagged = deque()
+        self.active = False
+        self.since = 0.0
+        self.last_join = 0.0
+        self.joins = 0
+        self.handled = 0
+        self.prev_verification = None
+        self.worker = None
+
+_raid_states = {}
+
+def join_suspicion(member):
+    score = 0
+    age = (discord.utils.utcnow() - member.created_at).total_seconds()
+    if age < RAID_MIN_ACCOUNT_AGE:
+        score += 1
+    if member.avatar is None:
+        score += 1
+    return score
+
+async def raid_check(member):
+    """Account for a join; True when the guild is in raid mode."""
+    guild = member.guild
+    st = _raid_states.setdefault(guild.id, RaidState())
+    now = time.monotonic()
+    suspicion = join_suspicion(member)
+    st.counter.add(now, 1 + suspicion)
+    st.last_join = now
+    if st.active:
+        st.joins += 1
+        if suspicion:
+            st.flagged.append(member)
+        return True
+    while st.recent and now - st.recent[0][0] >= RAID_WINDOW:
+        st.recent.popleft()
+    if suspicion:
+        st.recent.append((now, member))
+    if st.counter.total(now) >= get_conf(guild.id, "raid_score", RAID_SCORE):
+        await start_raid(guild, st, now)
+        return True
+    return False
+
+async def start_raid(guild, st, now):
+    st.active = True
+    st.since = now
+    st.joins = st.handled = 0
+    # only joins inside the window that tripped the counter: older
+    # suspicious-looking joiners (new accounts, no avatar) are ordinary members
+    st.flagged.extend(m for t, m in st.recent if now - t < RAID_WINDOW)
+    st.recent.clear()
+    st.prev_verification = guild.verification_level
+    try:
+        await guild.edit(verification_level=discord.VerificationLevel.highest, reason="Anti-raid")
+    except Exception:
+        st.prev_verification = None
+    await log_action(guild, "raid_start", suspects=len(st.flagged), action=get_conf(guild.id, "raid_action", "kick"))
+    st.worker = asyncio.create_task(_raid_worker(guild, st))
+
+async def end_raid(guild, st):
+    st.active = False
+    if st.prev_verification is not None:
+        try:
+            await guild.edit(verification_level=st.prev_verification, reason="Fin du raid")
+        except Exception:
+            pass
+    duration = int(time.monotonic() - st.since)
+    await log_action(guild, "raid_end", durée=f"{duration}s", arrivées=st.joins, traités=st.handled)
+
+async def handle_raiders(guild, st, members, action):
+    reason = "Anti-raid"
+    if action == "ban":
+        job = ban_job(guild, members, reason)
+    elif action == "kick":
+        job = BulkJob("raid", members, lambda m: m.kick(reason=reason), bucket=lambda m: guild.id)
+    else:
+        job = BulkJob("raid", members, lambda m: m.timeout(datetime.timedelta(hours=1), reason=reason))
+    st.handled += (await job.run()).ok
+
+async def _raid_worker(guild, st):
+    while st.active:
+        await asyncio.sleep(RAID_TICK)
+        action = get_conf(guild.id, "raid_action", "kick")
+        batch = []
+        while st.flagged:
+            batch.append(st.flagged.popleft())
+        if batch and action != "none":
+            await handle_raiders(guild, st, batch, action)
+        if st.active and time.monotonic() - st.last_join > RAID_CALM:
+            await end_raid(guild, st)
+
+# -------------------------
+# LINK FILTER
+# -------------------------
+# Messages without any link token are rejected by plain substring checks;
+# only the rest go through the URL/invite regex. Channel and domain lists
+# are mirrored into per-guild sets. In allowed channels, only denied domains
+# are removed; elsewhere, any link outside the allowed domains is removed.
+_LINK_TOKENS = ("http", "www", "discord.gg", "discord.com/invite", "discordapp.com/invite")
+_URL = re.compile(r"(?:https?://|www\.)([^\s/<>?#:]+)|(discord(?:app)?\.com/invite|discord\.gg)/\S+", re.IGNORECASE)
+
+class LinkFilter:
+    def __init__(self, gid):
+        self.channels = set(data.get("allowed_links", {}).get(gid, []))
+        self.allow = set(get_conf(gid, "link_allow_domains", []) or [])
+        self.deny = set(get_conf(gid, "link_deny_domains", []) or [])
+
+    @staticmethod
+    def _in(host, domains):
+        # example.com also covers any subdomain of it
+        parts = host.split(".")
+        return any(".".join(parts[i:]) in domains for i in range(len(parts) - 1))
+
+    def blocked_link(self, channel_id, content):
+        """Return the offending host/invite, or None."""
+        lc = content.lower()
+        if not any(t in lc for t in _LINK_TOKENS):
+            return None
+        allowed_channel = channel_id in self.channels
+        for m in _URL.finditer(lc):
+            host = "discord.gg" if m.group(2) else m.group(1).rstrip(".")
+            if host.startswith("www."):
+                host = host[4:]
+            if allowed_channel:
+                if self.deny and self._in(host, self.deny):
+                    return host
+            elif not self._in(host, self.allow):
+                return host
+        return None
+
+_link_filters = {}
+
+def get_link_filter(gid):
+    gid = str(gid)
+    f = _link_filters.get(gid)
+    if f is None:
+        f = _link_filters[gid] = LinkFilter(gid)
+    return f
+
+def invalidate_links(gid):
+    _link_filters.pop(str(gid), None)
+
+guild_evict_hooks.append(invalidate_links)
+
+# -------------------------
+# BULK ACTIONS
+# -------------------------
+# BulkJob runs one coroutine per item with at most `concurrency` in flight
+# overall and `per_bucket` per rate-limit bucket (e.g. channel id for
+# permission edits, guild id for bans; discord.py still enforces the
+# buckets themselves, this just avoids queueing behind them). Failures are
+# collected instead of swallowed, and a job can be cancelled mid-way. Items
+# may be batches (e.g. 200 members per bulk ban): `size` then gives the number
+# of targets in each, so counts and progress stay per target.
+BULK_CONCURRENCY = int(os.environ.get("HOSHIMI_BULK_CONCURRENCY", "8"))
+BULK_PER_BUCKET = 2
+BULK_PROGRESS_INTERVAL = 2.0
+BULK_REPORT_FAILURES = 5
+
+def _bulk_target(t):
+    if hasattr(t, "mention"):
+        return t.mention
+    if hasattr(t, "id"):
+        return f"<@{t.id}>"
+    return str(t)[:80]
+
+class BulkReport:
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.ok = 0
+        self.failed = []
+        self.done = 0
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def progress(self):
+        return f"{self.name}: {self.done}/{self.total} ({len(self.failed)} échec(s))"
+
+    def summary(self):
+        text = f"{self.name}: {self.ok}/{self.total} réussi(s)"
+        if self.failed:
+            text += f", {len(self.failed)} échec(s)"
+        if self.cancelled:
+            text += " — annulé"
+        text += f" en {self.elapsed:.1f}s"
+        for target, err in self.failed[:BULK_REPORT_FAILURES]:
+            text += f"\n• {target}: {err}"
+        if len(self.failed) > BULK_REPORT_FAILURES:
+            text += f"\n… et {len(self.failed) - BULK_REPORT_FAILURES} autre(s)"
+        return text
+
+class BulkJob:
+    def __init__(self, name, items, action, bucket=None, concurrency=BULK_CONCURRENCY, per_bucket=BULK_PER_BUCKET, size=None):
+        self.items = list(items)
+        self.action = action
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.per_bucket = per_bucket
+        self.size = size
+        self.report = BulkReport(name, sum(map(size, self.items)) if size else len(self.items))
+        self._buckets = defaultdict(lambda: asyncio.Semaphore(self.per_bucket))
+
+    def cancel(self):
+        self.report.cancelled = True
+
+    async def _worker(self, it):
+        for item in it:
+            if self.report.cancelled:
+                return
+            sem = self._buckets[self.bucket(item)] if self.bucket else None
+            try:
+                if sem:
+                    async with sem:
+                        res = await self.action(item)
+                else:
+                    res = await self.action(item)
+                # an action may report (successes, failed targets) for a whole batch
+                if isinstance(res, tuple):
+                    self.report.ok += res[0]
+                    self.report.failed.extend((_bulk_target(t), "échec") for t in res[1])
+                else:
+                    self.report.ok += 1
+            except Exception as e:
+                err = e.__class__.__name__ if not str(e) else str(e)[:80]
+                targets = item if self.size else (item,)
+                self.report.failed.extend((_bulk_target(t), err) for t in targets)
+            self.report.done += self.size(item) if self.size else 1
+
+    async def run(self):
+        it = iter(self.items)
+        await asyncio.gather(*(self._worker(it) for _ in range(max(1, min(self.concurrency, len(self.items))))))
+        self.report.elapsed = time.monotonic() - self.report.started
+        return self.report
+
+_bulk_jobs = defaultdict(set)  # guild id -> running jobs
+
+async def run_bulk(ctx, job):
+    """Run a BulkJob for a command, with a live progress message."""
+    jobs = _bulk_jobs[ctx.guild.id]
+    jobs.add(job)
+    msg = await safe_send(ctx.channel, job.report.progress())
+    async def ticker():
+        while True:
+            await asyncio.sleep(BULK_PROGRESS_INTERVAL)
+            try:
+                await msg.edit(content=job.report.progress())
+            except Exception:
+                pass
+    tick = asyncio.create_task(ticker()) if msg else None
+    try:
+        report = await job.run()
+    finally:
+        jobs.discard(job)
+        if tick:
+            tick.cancel()
+    if msg:
+        try:
+            await msg.edit(content=report.summary())
+        except Exception:
+            await safe_send(ctx.channel, report.summary())
+    return report
+
+async def _ban_each(guild, members, reason):
+    ok, failed = 0, []
+    for m in members:
+        try:
+            await guild.ban(m, reason=reason)
+            ok += 1
+        except Exception:
+            failed.append(m)
+    return ok, failed
+
+def ban_job(guild, members, reason):
+    """BulkJob using the bulk-ban endpoint (200 per call) when available.
+    Guild.bulk_ban also needs manage_guild: without it, or if a chunk is
+    refused, members are banned one by one."""
+    perms = guild.me.guild_permissions if getattr(guild, "me", None) else None
+    if hasattr(guild, "bulk_ban") and perms and perms.manage_guild and perms.ban_members:
+        async def ban_chunk(chunk):
+            try:
+                res = await guild.bulk_ban(chunk, reason=reason)
+            except discord.Forbidden:
+                return await _ban_each(guild, chunk, reason)
+            return len(res.banned), res.failed
+        chunks = [members[i:i+200] for i in range(0, len(members), 200)]
+        return BulkJob("Bannissements", chunks, ban_chunk, concurrency=1, size=len)
+    return BulkJob("Bannissements", members, lambda m: m.ban(reason=reason), bucket=lambda m: guild.id)
+
+# -------------------------
+# LEVEL REWARDS
+# -------------------------
+# level_roles = {level: role id} in the guild config. In "stack" mode a
+# member keeps every reward reached, in "replace" only the highest one. Only
+# reward roles are ever added or removed: the new role list is built from the
+# member's roles at the moment of the edit (so a long +syncroles never reverts
+# roles changed while it runs) and sent in one member.edit(roles=...), where
+# add_roles/remove_roles would cost one call per role. Members already in
+# sync cost nothing.
+LEVEL_ROLE_MODES = ("stack", "replace")
+LEVEL_ROLE_REASON = "Récompenses de niveau"
+
+class LevelRewards:
+    """A guild's reward table, resolved against its current roles."""
+    def __init__(self, guild):
+        self.guild = guild
+        self.mode = get_conf(guild.id, "level_roles_mode", "stack")
+        self.rewards = sorted((int(lvl), rid) for lvl, rid in (get_conf(guild.id, "level_roles") or {}).items())
+        self.managed = {rid for _, rid in self.rewards}
+        # roles the bot can actually hand out; others are left untouched
+        self.editable = {}
+        top = guild.me.top_role if self.rewards and guild.me else None
+        for rid in self.managed:
+            role = guild.get_role(rid)
+            if role and top and role < top and not role.managed:
+                self.editable[rid] = role
+
+    def __bool__(self):
+        return bool(self.rewards)
+
+    def target(self, level):
+        reached = [rid for lvl, rid in self.rewards if lvl <= level]
+        return set(reached[-1:] if self.mode == "replace" else reached)
+
+    def diff(self, member, level):
+        """(roles to add, roles to remove) against the member's current roles."""
+        have = {r.id for r in member.roles}
+        want = self.target(level)
+        add = [self.editable[rid] for rid in want - have if rid in self.editable]
+        remove = [self.editable[rid] for rid in (have & self.managed) - want if rid in self.editable]
+        return add, remove
+
+    async def apply(self, member, level):
+        """Bring the member's reward roles in line; False if nothing to do."""
+        add, remove = self.diff(member, level)
+        if not add and not remove:
+            return False
+        drop = {r.id for r in remove}
+        roles = [r for r in member.roles[1:] if r.id not in drop] + add  # [1:]: without @everyone
+        await member.edit(roles=roles, reason=LEVEL_ROLE_REASON)
+        return True
+
+def member_level(gid, uid, default=1):
+    user = data.get("levels", {}).get(str(gid), {}).get(str(uid))
+    return user["level"] if user else default
+
+async def level_role_job(guild, rewards, pairs, name="Rôles de niveau"):
+    """BulkJob over the (member, level) pairs out of sync right now; each edit
+    re-reads the member's roles and level when it runs."""
+    todo = []
+    for i, (member, level) in enumerate(pairs, 1):
+        if any(rewards.diff(member, level)):
+            todo.append(member)
+        if i % 5000 == 0:
+            await asyncio.sleep(0)  # big guilds: don't hold the loop while planning
+    return BulkJob(name, todo, lambda m: rewards.apply(m, member_level(guild.id, m.id)),
+                   bucket=lambda m: guild.id)
+
+async def grant_level_rewards(guild, ups):
+    """Apply rewards after level-ups ({uid: new level})."""
+    rewards = LevelRewards(guild)
+    if not rewards:
+        return
+    pairs = []
+    for uid, level in ups.items():
+        member = guild.get_member(int(uid))
+        if member:
+            pairs.append((member, level))
+    job = await level_role_job(guild, rewards, pairs)
+    if not job.items:
+        return
+    jobs = _bulk_jobs[guild.id]  # visible to +cancelbulk
+    jobs.add(job)
+    try:
+        await job.run()
+    finally:
+        jobs.discard(job)
+
+async def sync_level_roles(member, level):
+    rewards = LevelRewards(member.guild)
+    if rewards:
+        try:
+            await rewards.apply(member, level)
+        except:
+            pass
+
+# -------------------------
+# DM DELIVERY
+# -------------------------
+# Mass notifications go through a shared queue drained by DM_WORKERS tasks.
+# A recipient already queued with the same text is not queued twice; users
+# whose DMs are closed (403) are remembered for DM_CLOSED_TTL and skipped;
+# 429/5xx answers are retried with exponential backoff and jitter.
+DM_WORKERS = 4
+DM_MAX_RETRIES = 5
+DM_BACKOFF = 2.0
+DM_CLOSED_TTL = 86400.0
+DM_CLOSED_MAX = 100000
+
+class DMBatch:
+    def __init__(self, name, on_done=None):
+        self.name = name
+        self.on_done = on_done
+        self.queued = 0
+        self.sent = 0
+        self.closed = 0
+        self.failed = 0
+        self.retried = 0
+        self.duplicates = 0
+        self.sealed = False
+
+    @property
+    def finished(self):
+        return self.sealed and self.sent + self.closed + self.failed >= self.queued
+
+    def summary(self):
+        return (f"{self.name}: {self.sent} envoyé(s), {self.closed} DM fermé(s), {self.failed} échec(s), "
+                f"{self.duplicates} doublon(s), {self.retried} nouvel(s) essai(s)")
+
+class DMQueue:
+    def __init__(self):
+        self.queue = None
+        self.pending = set()
+        self.closed = OrderedDict()  # user id -> time the 403 was seen
+        self.workers = []
+        self.delivered = 0
+
+    def depth(self):
+        return self.queue.qsize() if self.queue else 0
+
+    def _is_closed(self, uid, now):
+        ts = self.closed.get(uid)
+        if ts is None:
+            return False
+        if now - ts > DM_CLOSED_TTL:
+            del self.closed[uid]
+            return False
+        return True
+
+    def _mark_closed(self, uid):
+        self.closed[uid] = time.monotonic()
+        self.closed.move_to_end(uid)
+        while len(self.closed) > DM_CLOSED_MAX:
+            self.closed.popitem(last=False)
+
+    def submit(self, users, content, batch):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(DM_WORKERS)]
+        now = time.monotonic()
+        for user in users:
+            key = (user.id, content)
+            if key in self.pending:
+                batch.duplicates += 1
+                continue
+            if self._is_closed(user.id, now):
+                batch.closed += 1
+                batch.queued += 1
+                continue
+            self.pending.add(key)
+            batch.queued += 1
+            self.queue.put_nowait((user, content, batch, 0))
+        batch.sealed = True
+        self._check_done(batch)
+        return batch
+
+    def _check_done(self, batch):
+        if batch.finished and batch.on_done:
+            cb, batch.on_done = batch.on_done, None
+            asyncio.create_task(cb(batch))
+
+    def _retry(self, item):
+        self.queue.put_nowait(item)
+
+    async def _worker(self):
+        while True:
+            user, content, batch, attempt = await self.queue.get()
+            try:
+                await user.send(content)
+                batch.sent += 1
+                self.delivered += 1
+            except discord.Forbidden:
+                self._mark_closed(user.id)
+                batch.closed += 1
+            except discord.HTTPException as e:
+                if (e.status == 429 or e.status >= 500) and attempt < DM_MAX_RETRIES:
+                    batch.retried += 1
+                    delay = DM_BACKOFF * 2**attempt + random.uniform(0, 1)
+                    asyncio.get_running_loop().call_later(delay, self._retry, (user, content, batch, attempt+1))
+                    continue
+                batch.failed += 1
+            except Exception:
+                batch.failed += 1
+            finally:
+                self.queue.task_done()
+            self.pending.discard((user.id, content))
+            self._check_done(batch)
+
+dm_queue = DMQueue()
 
 # -------------------------
 # EVENTS
@@ -97,12 +2613,36 @@ async def log_action(guild, action_type, **kwargs):
 @bot.event
 async def on_ready():
     print(f"Bot connecté: {bot.user} (ID: {bot.user.id})")
-    check_giveaway_expiry.start()
+    await start_monitoring()
+    if not flush_dirty_data.is_running():
+        flush_dirty_data.start()
+    if not compact_journal.is_running():
+        compact_journal.start()
+    if not xp_flush.is_running():
+        xp_flush.start()
+    if not ledger_rollup.is_running():
+        ledger_rollup.start()
+    if giveaway_scheduler._task is None:
+        for mid, g in data.get("giveaways", {}).items():
+            giveaway_scheduler.schedule(mid, giveaway_due(g))
+    giveaway_scheduler.start()
+    if mute_scheduler._task is None:
+        for gid, recs in data.get("mutes", {}).items():
+            for uid, rec in recs.items():
+                due = rec.get("renew") or rec.get("until")
+                if due:
+                    mute_scheduler.schedule(f"{gid}:{uid}", due)
+    mute_scheduler.start()
+    if not _invite_uses:
+        await BulkJob("invites", bot.guilds, refresh_invites, concurrency=4).run()
 
 @bot.event
 async def on_member_join(member):
     gid = str(member.guild.id)
     ensure_guild(gid)
+    # during a raid, skip auto-role / welcome / per-join logs entirely
+    if get_conf(member.guild.id, "antiraid_enabled") and await raid_check(member):
+        return
     # auto role
     auto_role = get_conf(member.guild.id, "auto_role")
     if auto_role:
@@ -120,7 +2660,10 @@ async def on_member_join(member):
             e = discord.Embed(title=f"Bienvenue {member.display_name} !", description=f"{member.mention} a rejoint le serveur.", color=0xff69b4)
             e.set_thumbnail(url=str(member.display_avatar.url))
             await safe_send(ch, embed=e)
-    await log_action(member.guild, "member_join", member=member.mention)
+    inviter = await attribute_join(member)
+    if inviter:
+        await credit_inviter(member.guild, inviter, member)
+    await log_action(member.guild, "member_join", member=member.mention, invité_par=f"<@{inviter}>" if inviter else "?")
 
 @bot.event
 async def on_message(message):
@@ -131,37 +2674,38 @@ async def on_message(message):
     ensure_guild(gid)
     # automod bad words
     if get_conf(message.guild.id, "automod_enabled"):
-        bad_words = get_conf(message.guild.id, "bad_words", [])
-        for w in bad_words:
-            if w.lower() in message.content.lower():
-                try:
-                    await message.delete()
-                except:
-                    pass
-                await log_action(message.guild, "automod", member=message.author.mention, reason="badword")
-                return
+        if get_badword_matcher(gid).search(message.content):
+            try:
+                await message.delete()
+            except:
+                pass
+            await log_action(message.guild, "automod", member=message.author.mention, reason="badword")
+            return
+    # anti-spam (moderators are exempt)
+    if get_conf(message.guild.id, "antispam_enabled") and not message.author.guild_permissions.manage_messages:
+        conf = antispam_conf(gid)
+        now = time.monotonic()
+        st, reason = check_spam(message, conf, now)
+        if reason:
+            await punish_spam(message, st, conf, reason, now)
+            return
+    # link filter
+    if get_conf(message.guild.id, "antilink_enabled") and not message.author.guild_permissions.manage_messages:
+        host = get_link_filter(gid).blocked_link(message.channel.id, message.content)
+        if host:
+            try:
+                await message.delete()
+            except:
+                pass
+            await log_action(message.guild, "link", member=message.author.mention, lien=host, salon=message.channel.mention)
+            return
     # auto_responses
-    ars = data.get("auto_responses", {}).get(gid, {})
-    for trigger, resp in ars.items():
-        if trigger.lower() in message.content.lower():
-            await message.channel.send(resp)
-            break
-    # level xp
+    hit = get_response_engine(gid).match(message.content)
+    if hit and response_allowed(gid, message.channel.id, *hit):
+        await safe_send(message.channel, hit[1]["response"])
+    # level xp (applied and announced by xp_flush)
     if get_conf(message.guild.id, "level_system_enabled"):
-        uid = str(message.author.id)
-        user = data["levels"][gid].setdefault(uid, {"xp":0,"level":1,"messages":0})
-        user["xp"] += random.randint(10,20)
-        user["messages"] += 1
-        lvl = user["level"]
-        if user["xp"] >= lvl*100:
-            user["level"] += 1
-            user["xp"] = 0
-            lc = get_conf(message.guild.id, "level_channel")
-            if lc:
-                ch = message.guild.get_channel(lc)
-                if ch:
-                    await safe_send(ch, embed=discord.Embed(title="Level Up !", description=f"{message.author.mention} est maintenant niveau {user['level']}"))
-        save_data(data)
+        award_xp(gid, str(message.author.id), time.monotonic())
     await bot.process_commands(message)
 
 # -------------------------
@@ -206,6 +2750,14 @@ async def set_logs(ctx, channel: discord.TextChannel):
     set_conf(ctx.guild.id, "logs_channel", channel.id)
     await ctx.send("Salon de logs configuré.")
 
+@bot.command(name="logqueue")
+@commands.has_permissions(manage_guild=True)
+async def logqueue_cmd(ctx):
+    log_ch = get_conf(ctx.guild.id, "logs_channel")
+    d = log_dispatcher
+    await ctx.send(f"File de logs: {d.depth(log_ch) if log_ch else 0} en attente ({d.depth()} au total), "
+                   f"{d.sent_embeds} envoyés en {d.sent_messages} messages, {d.dropped} ignorés.")
+
 @bot.command(name="setinvitation")
 @commands.has_permissions(manage_guild=True)
 async def set_invitation(ctx, channel: discord.TextChannel):
@@ -227,12 +2779,92 @@ async def role_join(ctx, role: discord.Role):
 # -------------------------
 # INVITES
 # -------------------------
+# Invite tracking: _invite_uses[guild id] = {code: (uses, inviter id)} is
+# filled on startup and kept current by invite create/delete events. A join
+# costs a single guild.invites() call: the code whose uses went up (or that
+# vanished after hitting max_uses) identifies the inviter.
+_invite_uses = {}
+_invite_locks = defaultdict(asyncio.Lock)
+
+def _invite_snapshot(invites):
+    return {i.code: (i.uses or 0, i.max_uses or 0, i.inviter.id if i.inviter else None) for i in invites}
+
+async def refresh_invites(guild):
+    try:
+        _invite_uses[guild.id] = _invite_snapshot(await guild.invites())
+    except Exception:
+        _invite_uses.pop(guild.id, None)  # missing manage_guild: tracking off
+
+async def attribute_join(member):
+    """Return the inviter id for a new member, or None."""
+    guild = member.guild
+    async with _invite_locks[guild.id]:
+        before = _invite_uses.get(guild.id)
+        if before is None:
+            return None
+        try:
+            after = _invite_snapshot(await guild.invites())
+        except Exception:
+            return None
+        _invite_uses[guild.id] = after
+    used = [v[2] for code, v in after.items() if v[0] > before.get(code, (0,))[0]]
+    if not used:
+        # single-use / max_uses invites are deleted once consumed
+        used = [v[2] for code, v in before.items() if code not in after and v[1] and v[0] + 1 >= v[1]]
+    return used[0] if len(used) == 1 else None
+
+def invite_tiers(gid):
+    """{needed invites: role id}, including the legacy single-role format."""
+    conf = data.get("roles_invites", {}).get(str(gid), {})
+    if "role" in conf and "invites" in conf:
+        return {int(conf["invites"]): conf["role"]}
+    return {int(n): rid for n, rid in conf.items()}
+
+async def credit_inviter(guild, inviter_id, member):
+    gid = str(guild.id); uid = str(inviter_id)
+    counts = data.setdefault("user_invites", {}).setdefault(gid, {})
+    counts[uid] = counts.get(uid, 0) + 1
+    mark_dirty("user_invites", gid, uid)
+    inviter = guild.get_member(inviter_id)
+    if inviter:
+        earned = [guild.get_role(rid) for n, rid in invite_tiers(gid).items() if counts[uid] >= n]
+        missing = [r for r in earned if r and r not in inviter.roles]
+        if missing:
+            try:
+                await inviter.add_roles(*missing, reason="Récompense d'invitations")
+            except Exception:
+                pass
+    ic = get_conf(guild.id, "invitation_channel")
+    ch = guild.get_channel(ic) if ic else None
+    if ch:
+        await safe_send(ch, f"{member.mention} a été invité par <@{inviter_id}> ({counts[uid]} invite(s)).")
+
+@bot.event
+async def on_invite_create(invite):
+    if invite.guild and invite.guild.id in _invite_uses:
+        _invite_uses[invite.guild.id][invite.code] = (invite.uses or 0, invite.max_uses or 0, invite.inviter.id if invite.inviter else None)
+
+@bot.event
+async def on_invite_delete(invite):
+    # kept when it was one use away from max_uses: the join diff still needs it
+    snap = _invite_uses.get(invite.guild.id) if invite.guild else None
+    if snap and invite.code in snap:
+        uses, max_uses, _ = snap[invite.code]
+        if not (max_uses and uses + 1 >= max_uses):
+            del snap[invite.code]
+
+@bot.event
+async def on_guild_join(guild):
+    await refresh_invites(guild)
+
 @bot.command(name="roleinvite")
 @commands.has_permissions(manage_guild=True)
 async def role_invite(ctx, invites_needed: int, role: discord.Role):
     gid = str(ctx.guild.id)
-    data.setdefault("roles_invites", {})[gid] = {"invites": invites_needed, "role": role.id}
-    save_data(data)
+    tiers = {str(n): rid for n, rid in invite_tiers(gid).items()}
+    tiers[str(invites_needed)] = role.id
+    data.setdefault("roles_invites", {})[gid] = tiers
+    mark_dirty("roles_invites", gid)
     await ctx.send(f"Role d'invite configuré: {role.name} pour {invites_needed} invites")
 
 @bot.command(name="invites")
@@ -252,7 +2884,7 @@ async def warn_cmd(ctx, member: discord.Member, *, reason: str="Aucune raison"):
     uid = str(member.id)
     data.setdefault("warnings", {}).setdefault(gid, {}).setdefault(uid, [])
     data["warnings"][gid][uid].append({"reason":reason, "moderator":str(ctx.author.id), "date": datetime.datetime.utcnow().isoformat()})
-    save_data(data)
+    mark_dirty("warnings", gid, uid)
     await ctx.send(f"{member.mention} averti. Raison: {reason}")
     await log_action(ctx.guild, "warning", membre=member.mention, raison=reason, modérateur=ctx.author.mention)
 
@@ -276,7 +2908,7 @@ async def clear_warns(ctx, member: discord.Member):
     uid = str(member.id)
     if uid in data.get("warnings", {}).get(gid, {}):
         del data["warnings"][gid][uid]
-        save_data(data)
+        mark_dirty("warnings", gid, uid)
     await ctx.send("Avertissements effacés.")
 
 @bot.command(name="kick")
@@ -299,11 +2931,19 @@ async def ban_cmd(ctx, member: discord.Member, *, reason: str="Aucune raison"):
     except Exception as e:
         await ctx.send(f"Erreur: {e}")
 
-@bot.command(name="mute")
-@commands.has_permissions(manage_roles=True)
-async def mute_cmd(ctx, member: discord.Member, duration: int=0):
-    # Simple mute: create role "Muted" if needed and remove send_messages perms
-    guild = ctx.guild
+# Mutes use Discord's native timeout (one API call, expiry handled
+# server-side). Indefinite mutes and mutes longer than the 28-day timeout cap
+# are stored in data["mutes"] with a "renew" time: mute_scheduler extends the
+# timeout MUTE_RENEW_MARGIN before it runs out. The legacy "Muted" role is
+# only used by guilds set to mutemode role; its channel overwrites are set up
+# once, when the role is created.
+MAX_TIMEOUT = 28*86400
+MUTE_RENEW_MARGIN = 3600
+MUTE_RETRY = 900  # renewal failed (API error): try again after
+# the bot does the timeout, so +mute/+unmute check the caller can do it too
+MODERATE_MEMBERS_REQUIRED = "Il te faut la permission « Exclure temporairement des membres »."
+
+async def get_muted_role(guild):
     muted = discord.utils.get(guild.roles, name="Muted")
     if not muted:
         perms = discord.Permissions(send_messages=False, speak=False)
@@ -313,31 +2953,161 @@ async def mute_cmd(ctx, member: discord.Member, duration: int=0):
                 await ch.set_permissions(muted, send_messages=False, speak=False)
             except:
                 pass
+    return muted
+
+async def timeout_mute(member, until, reason):
+    """Time the member out until `until` (None = indefinite), 28 days at most;
+    returns when the timeout has to be renewed, or None if it covers it all."""
+    now = time.time()
+    if until is not None and until - now <= MAX_TIMEOUT:
+        if until > now:
+            await member.timeout(datetime.timedelta(seconds=until-now), reason=reason)
+        return None
+    await member.timeout(datetime.timedelta(seconds=MAX_TIMEOUT), reason=reason)
+    return now + MAX_TIMEOUT - MUTE_RENEW_MARGIN
+
+def store_timeout_mute(gid, uid, until, channel_id, renew):
+    recs = data.setdefault("mutes", {}).setdefault(gid, {})
+    key = f"{gid}:{uid}"
+    if renew is None:
+        if recs.pop(uid, None) is not None:
+            mark_dirty("mutes", gid, uid)
+        mute_scheduler.cancel(key)
+        return
+    recs[uid] = {"until": until, "channel": channel_id, "renew": renew}
+    mark_dirty("mutes", gid, uid)
+    mute_scheduler.schedule(key, renew)
+
+async def expire_mute(key):
+    gid, uid = key.split(":")
+    rec = data.get("mutes", {}).get(gid, {}).get(uid)
+    if rec is None:
+        return
+    guild = bot.get_guild(int(gid))
+    if "renew" in rec:
+        member = guild.get_member(int(uid)) if guild else None
+        if member is None:
+            # bot removed from the guild or member gone: nothing left to renew
+            data["mutes"][gid].pop(uid, None)
+            mark_dirty("mutes", gid, uid)
+            return
+        try:
+            renew = await timeout_mute(member, rec.get("until"), "Mute (renouvellement)")
+        except Exception:
+            renew = time.time() + MUTE_RETRY
+        store_timeout_mute(gid, uid, rec.get("until"), rec.get("channel"), renew)
+        return
+    data["mutes"][gid].pop(uid, None)
+    mark_dirty("mutes", gid, uid)
+    if not guild:
+        return
+    member = guild.get_member(int(uid))
+    muted = discord.utils.get(guild.roles, name="Muted")
+    if member and muted:
+        try:
+            await member.remove_roles(muted)
+        except:
+            return
+        ch = guild.get_channel(rec.get("channel") or 0)
+        if ch:
+            await safe_send(ch, f"{member.mention} a été unmuted automatique.")
+
+mute_scheduler = Scheduler("mute", expire_mute)
+
+@bot.command(name="mute")
+@commands.has_permissions(manage_roles=True)
+async def mute_cmd(ctx, member: discord.Member, duration: int=0):
+    guild = ctx.guild
+    gid=str(guild.id); uid=str(member.id)
     try:
+        if get_conf(guild.id, "mute_mode", "timeout") == "timeout":
+            if not ctx.author.guild_permissions.moderate_members:
+                await ctx.send(MODERATE_MEMBERS_REQUIRED)
+                return
+            until = time.time()+duration if duration>0 else None
+            renew = await timeout_mute(member, until, f"Mute par {ctx.author}")
+            store_timeout_mute(gid, uid, until, ctx.channel.id, renew)
+            await ctx.send(f"{member.mention} mis en sourdine" + (f" ({duration}s)." if duration>0 else "."))
+            return
+        muted = await get_muted_role(guild)
         await member.add_roles(muted)
+        until = time.time()+duration if duration>0 else None
+        data.setdefault("mutes", {}).setdefault(gid, {})[uid] = {"until": until, "channel": ctx.channel.id}
+        mark_dirty("mutes", gid, uid)
+        if until:
+            mute_scheduler.schedule(f"{gid}:{uid}", until)
         await ctx.send(f"{member.mention} mis en sourdine.")
-        if duration>0:
-            await asyncio.sleep(duration)
-            try:
-                await member.remove_roles(muted)
-                await ctx.send(f"{member.mention} a été unmuted automatique.")
-            except:
-                pass
     except Exception as e:
         await ctx.send(f"Erreur: {e}")
 
 @bot.command(name="unmute")
 @commands.has_permissions(manage_roles=True)
 async def unmute_cmd(ctx, member: discord.Member):
+    gid=str(ctx.guild.id); uid=str(member.id)
     muted = discord.utils.get(ctx.guild.roles, name="Muted")
-    if muted:
-        try:
+    if not member.is_timed_out() and not (muted and muted in member.roles):
+        await ctx.send(f"{member.mention} n'est pas en sourdine.")
+        return
+    if member.is_timed_out() and not ctx.author.guild_permissions.moderate_members:
+        await ctx.send(MODERATE_MEMBERS_REQUIRED)
+        return
+    try:
+        if member.is_timed_out():
+            await member.timeout(None)
+        if muted and muted in member.roles:
             await member.remove_roles(muted)
-            await ctx.send(f"{member.mention} a été unmute.")
-        except Exception as e:
-            await ctx.send(f"Erreur: {e}")
-    else:
+        if data.get("mutes", {}).get(gid, {}).pop(uid, None) is not None:
+            mark_dirty("mutes", gid, uid)
+        mute_scheduler.cancel(f"{gid}:{uid}")
+        await ctx.send(f"{member.mention} a été unmute.")
+    except Exception as e:
+        await ctx.send(f"Erreur: {e}")
+
+@bot.command(name="mutemode")
+@commands.has_permissions(manage_guild=True)
+async def mutemode_cmd(ctx, mode: str):
+    mode = mode.lower()
+    if mode not in ("timeout", "role"):
+        await ctx.send("Modes: timeout, role")
+        return
+    set_conf(ctx.guild.id, "mute_mode", mode)
+    await ctx.send(f"Mode de mute: {mode}")
+
+@bot.command(name="migratemutes")
+@commands.has_permissions(administrator=True)
+async def migratemutes_cmd(ctx):
+    # Convert role mutes to native timeouts (renewed when indefinite or past
+    # 28 days); drop the Muted role, and with it every channel overwrite,
+    # once nobody holds it anymore.
+    guild = ctx.guild
+    gid = str(guild.id)
+    muted = discord.utils.get(guild.roles, name="Muted")
+    if not muted:
         await ctx.send("Aucun rôle Muted trouvé.")
+        return
+    recs = data.setdefault("mutes", {}).setdefault(gid, {})
+    converted = kept = 0
+    now = time.time()
+    for member in list(muted.members):
+        uid = str(member.id)
+        rec = recs.get(uid) or {}
+        until = rec.get("until")
+        try:
+            renew = await timeout_mute(member, until, "Migration mute") if until is None or until > now else None
+            await member.remove_roles(muted)
+        except Exception:
+            kept += 1
+            continue
+        store_timeout_mute(gid, uid, until, rec.get("channel"), renew)
+        converted += 1
+    msg = f"{converted} mute(s) convertis en timeout, {kept} conservés."
+    if not kept and get_conf(guild.id, "mute_mode", "timeout") == "timeout":
+        try:
+            await muted.delete(reason="Migration vers les timeouts")
+            msg += " Rôle Muted supprimé."
+        except Exception:
+            pass
+    await ctx.send(msg)
 
 @bot.command(name="clear")
 @commands.has_permissions(manage_messages=True)
@@ -375,31 +3145,33 @@ async def slowmode_cmd(ctx, seconds: int=5):
 @bot.command(name="masswarn")
 @commands.has_permissions(administrator=True)
 async def masswarn_cmd(ctx, role: discord.Role, *, reason: str):
-    warned=0
-    for m in role.members:
-        gid=str(ctx.guild.id)
+    gid=str(ctx.guild.id)
+    members = list(role.members)
+    for m in members:
         uid=str(m.id)
         data.setdefault("warnings", {}).setdefault(gid, {}).setdefault(uid, [])
         data["warnings"][gid][uid].append({"reason":reason,"moderator":str(ctx.author.id),"date":datetime.datetime.utcnow().isoformat()})
-        warned+=1
-        try:
-            await m.send(f"Avertissement: {reason}")
-        except:
-            pass
-    save_data(data)
-    await ctx.send(f"{warned} membres avertis.")
+        mark_dirty("warnings", gid, uid)
+    await ctx.send(f"{len(members)} membres avertis. Envoi des DM en arrière-plan…")
+    async def report(batch):
+        await safe_send(ctx.channel, batch.summary())
+    dm_queue.submit(members, f"Avertissement: {reason}", DMBatch("DM avertissements", on_done=report))
 
 @bot.command(name="massban")
 @commands.has_permissions(administrator=True)
 async def massban_cmd(ctx, *members: discord.Member):
-    banned=0
-    for m in members:
-        try:
-            await m.ban(reason=f"Mass ban par {ctx.author}")
-            banned+=1
-        except:
-            pass
-    await ctx.send(f"{banned} bannis.")
+    await run_bulk(ctx, ban_job(ctx.guild, list(members), f"Mass ban par {ctx.author}"))
+
+@bot.command(name="cancelbulk")
+@commands.has_permissions(administrator=True)
+async def cancelbulk_cmd(ctx):
+    jobs = _bulk_jobs.get(ctx.guild.id)
+    if not jobs:
+        await ctx.send("Aucune action en cours.")
+        return
+    for job in jobs:
+        job.cancel()
+    await ctx.send(f"{len(jobs)} action(s) annulée(s).")
 
 @bot.command(name="nuke")
 @commands.has_permissions(administrator=True)
@@ -421,26 +3193,16 @@ async def nuke_cmd(ctx):
 @bot.command(name="lockall")
 @commands.has_permissions(administrator=True)
 async def lockall_cmd(ctx):
-    count=0
-    for ch in ctx.guild.text_channels:
-        try:
-            await ch.set_permissions(ctx.guild.default_role, send_messages=False)
-            count+=1
-        except:
-            pass
-    await ctx.send(f"{count} salons verrouillés.")
+    role = ctx.guild.default_role
+    await run_bulk(ctx, BulkJob("Salons verrouillés", ctx.guild.text_channels,
+                                lambda ch: ch.set_permissions(role, send_messages=False), bucket=lambda ch: ch.id))
 
 @bot.command(name="unlockall")
 @commands.has_permissions(administrator=True)
 async def unlockall_cmd(ctx):
-    count=0
-    for ch in ctx.guild.text_channels:
-        try:
-            await ch.set_permissions(ctx.guild.default_role, send_messages=True)
-            count+=1
-        except:
-            pass
-    await ctx.send(f"{count} salons déverrouillés.")
+    role = ctx.guild.default_role
+    await run_bulk(ctx, BulkJob("Salons déverrouillés", ctx.guild.text_channels,
+                                lambda ch: ch.set_permissions(role, send_messages=True), bucket=lambda ch: ch.id))
 
 # -------------------------
 # PROTECTION
@@ -452,6 +3214,33 @@ async def toggle_antispam(ctx):
     set_conf(ctx.guild.id, "antispam_enabled", not cur)
     await ctx.send(f"Anti-spam {'activé' if not cur else 'désactivé'}.")
 
+@bot.command(name="antispamset")
+@commands.has_permissions(manage_guild=True)
+async def antispamset_cmd(ctx, key: str=None, *values: str):
+    # +antispamset max_messages 5 | +antispamset ladder delete timeout kick
+    conf = dict(get_conf(ctx.guild.id, "antispam") or {})
+    if key is None or key not in ANTISPAM_DEFAULTS or not values:
+        cur = {**ANTISPAM_DEFAULTS, **conf}
+        await ctx.send("Anti-spam: " + ", ".join(f"{k}={v}" for k,v in cur.items()))
+        return
+    if key == "ladder":
+        ladder = [v.lower() for v in values]
+        if any(v not in ("delete", "timeout", "kick") for v in ladder):
+            await ctx.send("Actions: delete, timeout, kick")
+            return
+        conf[key] = ladder
+    else:
+        try:
+            conf[key] = type(ANTISPAM_DEFAULTS[key])(values[0])
+        except ValueError:
+            await ctx.send("Valeur invalide.")
+            return
+        if conf[key] <= 0:
+            await ctx.send("Valeur invalide.")
+            return
+    set_conf(ctx.guild.id, "antispam", conf)
+    await ctx.send(f"Anti-spam: {key} = {conf[key]}")
+
 @bot.command(name="toggleantiraid")
 @commands.has_permissions(manage_guild=True)
 async def toggle_antiraid(ctx):
@@ -459,6 +3248,30 @@ async def toggle_antiraid(ctx):
     set_conf(ctx.guild.id, "antiraid_enabled", not cur)
     await ctx.send(f"Anti-raid {'activé' if not cur else 'désactivé'}.")
 
+@bot.command(name="raidset")
+@commands.has_permissions(manage_guild=True)
+async def raidset_cmd(ctx, key: str, value: str):
+    # +raidset score 20 | +raidset action kick|ban|timeout|none
+    key = key.lower()
+    if key == "score" and value.isdigit() and int(value) > 0:
+        set_conf(ctx.guild.id, "raid_score", int(value))
+    elif key == "action" and value.lower() in ("kick", "ban", "timeout", "none"):
+        set_conf(ctx.guild.id, "raid_action", value.lower())
+    else:
+        await ctx.send("Usage: +raidset score <n> | +raidset action kick|ban|timeout|none")
+        return
+    await ctx.send(f"Anti-raid: {key} = {value}")
+
+@bot.command(name="raidoff")
+@commands.has_permissions(manage_guild=True)
+async def raidoff_cmd(ctx):
+    st = _raid_states.get(ctx.guild.id)
+    if not st or not st.active:
+        await ctx.send("Aucun raid en cours.")
+        return
+    await end_raid(ctx.guild, st)
+    await ctx.send("Mode raid désactivé.")
+
 @bot.command(name="toggleautomod")
 @commands.has_permissions(manage_guild=True)
 async def toggle_automod(ctx):
@@ -475,6 +3288,7 @@ async def add_badword(ctx, *, word: str):
     if word.lower() not in [w.lower() for w in bl]:
         bl.append(word)
         set_conf(ctx.guild.id, "bad_words", bl)
+        invalidate_badwords(gid)
         await ctx.send("Mot ajouté.")
     else:
         await ctx.send("Déjà présent.")
@@ -491,6 +3305,7 @@ async def remove_badword(ctx, *, word: str):
     bl = get_conf(ctx.guild.id, "bad_words", []) or []
     bl = [w for w in bl if w.lower()!=word.lower()]
     set_conf(ctx.guild.id, "bad_words", bl)
+    invalidate_badwords(ctx.guild.id)
     await ctx.send("Retiré si existait.")
 
 # -------------------------
@@ -508,42 +3323,127 @@ async def rank_cmd(ctx, member: discord.Member=None):
     member = member or ctx.author
     gid=str(ctx.guild.id)
     uid=str(member.id)
+    apply_pending_xp((gid, uid))
     u = data.get("levels", {}).get(gid, {}).get(uid, {"xp":0,"level":1,"messages":0})
+    idx = get_level_index(gid)
+    pos = idx.position(uid)
     e = discord.Embed(title=f"Rang de {member.display_name}", color=0xff69b4)
+    e.add_field(name="Position", value=f"#{pos}/{len(idx.ranked)}" if pos else "Non classé")
     e.add_field(name="Niveau", value=u["level"])
-    e.add_field(name="XP", value=u["xp"])
+    e.add_field(name="XP", value=f"{u['xp']}/{u['level']*100}")
     e.add_field(name="Messages", value=u["messages"])
     await ctx.send(embed=e)
 
+LEADERBOARD_PAGE = 10
+
 @bot.command(name="leaderboard", aliases=["lb","top"])
-async def leaderboard_cmd(ctx):
+async def leaderboard_cmd(ctx, page: int=1):
     gid=str(ctx.guild.id)
     allu = data.get("levels", {}).get(gid, {})
-    ranking = sorted(allu.items(), key=lambda x: (x[1]["level"], x[1]["xp"]), reverse=True)[:10]
+    idx = get_level_index(gid)
+    pages = max(1, -(-len(idx.ranked) // LEADERBOARD_PAGE))
+    page = min(max(page, 1), pages)
+    start = (page-1)*LEADERBOARD_PAGE
     e = discord.Embed(title="Classement", color=0xff69b4)
-    for i,(uid,ud) in enumerate(ranking,1):
+    for i,uid in enumerate(idx.page(start, LEADERBOARD_PAGE), start+1):
+        ud = allu[uid]
         m = ctx.guild.get_member(int(uid))
         name = m.display_name if m else uid
         e.add_field(name=f"#{i} {name}", value=f"Lvl {ud['level']} • {ud['xp']} XP", inline=False)
+    e.set_footer(text=f"Page {page}/{pages}")
+    await ctx.send(embed=e)
+
+@bot.command(name="xpcooldown")
+@commands.has_permissions(manage_guild=True)
+async def xpcooldown_cmd(ctx, seconds: float):
+    set_conf(ctx.guild.id, "xp_cooldown", max(0.0, seconds))
+    await ctx.send(f"XP gagnée au plus une fois toutes les {max(0.0, seconds):g}s par membre.")
+
+@bot.command(name="setlevelchannel")
+@commands.has_permissions(manage_guild=True)
+async def setlevelchannel_cmd(ctx, channel: discord.TextChannel):
+    set_conf(ctx.guild.id, "level_channel", channel.id)
+    await ctx.send(f"Annonces de niveau dans {channel.mention}.")
+
+@bot.command(name="levelrole")
+@commands.has_permissions(manage_roles=True)
+async def levelrole_cmd(ctx, level: int, role: discord.Role=None):
+    rewards = dict(get_conf(ctx.guild.id, "level_roles") or {})
+    if role is None:
+        if rewards.pop(str(level), None) is None:
+            return await ctx.send(f"Aucune récompense au niveau {level}.")
+        set_conf(ctx.guild.id, "level_roles", rewards)
+        return await ctx.send(f"Récompense du niveau {level} supprimée.")
+    if role >= ctx.guild.me.top_role or role.managed:
+        return await ctx.send("Je ne peux pas attribuer ce rôle.")
+    rewards[str(max(1, level))] = role.id
+    set_conf(ctx.guild.id, "level_roles", rewards)
+    await ctx.send(f"{role.mention} attribué au niveau {max(1, level)}. `+syncroles` pour l'appliquer aux membres existants.")
+
+@bot.command(name="levelroles")
+async def levelroles_cmd(ctx):
+    rewards = LevelRewards(ctx.guild)
+    if not rewards:
+        return await ctx.send("Aucune récompense de niveau.")
+    lines = []
+    for lvl, rid in rewards.rewards:
+        role = ctx.guild.get_role(rid)
+        lines.append(f"Niveau {lvl}: {role.mention if role else f'rôle supprimé ({rid})'}" + ("" if rid in rewards.editable else " ⚠️"))
+    e = discord.Embed(title=f"Récompenses de niveau ({rewards.mode})", description="\n".join(lines), color=0xff69b4)
     await ctx.send(embed=e)
 
+@bot.command(name="levelrolemode")
+@commands.has_permissions(manage_roles=True)
+async def levelrolemode_cmd(ctx, mode: str):
+    mode = mode.lower()
+    if mode not in LEVEL_ROLE_MODES:
+        return await ctx.send(f"Mode inconnu. Choix: {', '.join(LEVEL_ROLE_MODES)}")
+    set_conf(ctx.guild.id, "level_roles_mode", mode)
+    await ctx.send(f"Mode des récompenses: {mode}. `+syncroles` pour l'appliquer aux membres existants.")
+
+@bot.command(name="syncroles")
+@commands.has_permissions(manage_roles=True)
+async def syncroles_cmd(ctx):
+    rewards = LevelRewards(ctx.guild)
+    if not rewards:
+        return await ctx.send("Aucune récompense de niveau.")
+    apply_pending_xp()
+    levels = data.get("levels", {}).get(str(ctx.guild.id), {})
+    rows = levels.columns("level") if isinstance(levels, RecordTable) else \
+        ((uid, u["level"]) for uid, u in levels.items())
+    pairs = []
+    for uid, level in rows:
+        member = ctx.guild.get_member(int(uid))
+        if member:
+            pairs.append((member, level))
+    job = await level_role_job(ctx.guild, rewards, pairs)
+    if not job.items:
+        return await ctx.send(f"{len(pairs)} membre(s) vérifié(s), aucun changement.")
+    await run_bulk(ctx, job)
+
 @bot.command(name="setxp")
 @commands.has_permissions(administrator=True)
 async def set_xp(ctx, member: discord.Member, xp: int):
     gid=str(ctx.guild.id); uid=str(member.id)
-    data.setdefault("levels", {}).setdefault(gid, {}).setdefault(uid, {"xp":0,"level":1,"messages":0})
-    data["levels"][gid][uid]["xp"]=xp
-    save_data(data)
-    await ctx.send("XP définie.")
+    apply_pending_xp((gid, uid))
+    user = guild_table("levels", gid).setdefault(uid, {"xp":0,"level":1,"messages":0})
+    user["xp"]=max(0, xp)
+    user = apply_xp(gid, uid, announce=False)  # cascades an xp value past the level cost
+    await sync_level_roles(member, user["level"])
+    await ctx.send(f"XP définie (niveau {user['level']}, {user['xp']} XP).")
 
 @bot.command(name="setlevel")
 @commands.has_permissions(administrator=True)
 async def set_level_cmd(ctx, member: discord.Member, level: int):
     gid=str(ctx.guild.id); uid=str(member.id)
-    data.setdefault("levels", {}).setdefault(gid, {}).setdefault(uid, {"xp":0,"level":1,"messages":0})
-    data["levels"][gid][uid]["level"]=level
-    save_data(data)
-    await ctx.send("Niveau défini.")
+    apply_pending_xp((gid, uid))
+    user = guild_table("levels", gid).setdefault(uid, {"xp":0,"level":1,"messages":0})
+    user["level"]=max(1, level)
+    user["xp"]=0
+    level_index_update(gid, uid, user)
+    mark_dirty("levels", gid, uid)
+    await sync_level_roles(member, user["level"])
+    await ctx.send(f"Niveau défini (niveau {user['level']}, {user['xp']} XP).")
 
 # -------------------------
 # BACKUPS
@@ -561,7 +3461,7 @@ async def backup_cmd(ctx):
     data["backups"][gid].append(backup)
     # keep last 10
     data["backups"][gid]=data["backups"][gid][-10:]
-    save_data(data)
+    mark_dirty("backups", gid)
     await ctx.send("Backup effectué.")
 
 @bot.command(name="listbackups")
@@ -599,7 +3499,7 @@ async def premium_cmd(ctx, member: discord.Member=None):
 async def set_premium_cmd(ctx, member: discord.Member, status: bool=True):
     gid=str(ctx.guild.id); uid=str(member.id)
     data.setdefault("premium_users", {}).setdefault(gid, {})[uid]=status
-    save_data(data)
+    mark_dirty("premium_users", gid, uid)
     await ctx.send("Statut premium mis.")
 
 @bot.command(name="badges")
@@ -616,7 +3516,7 @@ async def give_badge_cmd(ctx, member: discord.Member, badge_id: str):
     data.setdefault("badges", {}).setdefault(gid, {}).setdefault(uid, [])
     if badge_id not in data["badges"][gid][uid]:
         data["badges"][gid][uid].append(badge_id)
-        save_data(data)
+        mark_dirty("badges", gid, uid)
     await ctx.send("Badge donné.")
 
 # -------------------------
@@ -630,7 +3530,7 @@ async def reaction_role_cmd(ctx, message_id: int, emoji: str, role: discord.Role
         msg = await ctx.channel.fetch_message(message_id)
         await msg.add_reaction(emoji)
         data.setdefault("reaction_roles", {}).setdefault(gid, {})[str(message_id)] = {"channel":ctx.channel.id, "roles": {emoji: role.id}}
-        save_data(data)
+        mark_dirty("reaction_roles", gid, message_id)
         await ctx.send("Rôle réaction configuré.")
     except Exception as e:
         await ctx.send(f"Erreur: {e}")
@@ -641,6 +3541,9 @@ async def on_raw_reaction_add(payload):
         return
     gid=str(payload.guild_id)
     msg_id=str(payload.message_id)
+    if str(payload.emoji) == GIVEAWAY_EMOJI and msg_id in data.get("giveaways", {}):
+        giveaway_add_entrant(msg_id, payload.user_id)
+        return
     rr = data.get("reaction_roles", {}).get(gid, {}).get(msg_id, {})
     if not rr:
         return
@@ -660,6 +3563,9 @@ async def on_raw_reaction_add(payload):
 async def on_raw_reaction_remove(payload):
     gid=str(payload.guild_id)
     msg_id=str(payload.message_id)
+    if str(payload.emoji) == GIVEAWAY_EMOJI and msg_id in data.get("giveaways", {}):
+        giveaway_remove_entrant(msg_id, payload.user_id)
+        return
     rr = data.get("reaction_roles", {}).get(gid, {}).get(msg_id, {})
     if not rr:
         return
@@ -690,7 +3596,7 @@ async def ticket_cmd(ctx):
     await ch.set_permissions(ctx.guild.default_role, read_messages=False)
     await ch.set_permissions(ctx.author, read_messages=True, send_messages=True)
     tickets[str(ch.id)] = {"owner":str(ctx.author.id), "created": datetime.datetime.utcnow().isoformat()}
-    save_data(data)
+    mark_dirty("tickets", gid, ch.id)
     await ctx.send(f"Ticket créé: {ch.mention}")
 
 @bot.command(name="close")
@@ -703,7 +3609,7 @@ async def close_cmd(ctx):
             tickets = data.get("tickets", {}).get(gid, {})
             if str(ctx.channel.id) in tickets:
                 del tickets[str(ctx.channel.id)]
-                save_data(data)
+                mark_dirty("tickets", gid, ctx.channel.id)
             await ctx.channel.delete()
         except Exception:
             pass
@@ -759,7 +3665,7 @@ async def on_voice_state_update(member, before, after):
         except:
             pass
         data.setdefault("temp_vocs", {})[str(new.id)] = {"owner": str(member.id), "guild": str(member.guild.id)}
-        save_data(data)
+        mark_dirty("temp_vocs", None, new.id)
     # cleanup
     if before.channel and str(before.channel.id) in data.get("temp_vocs", {}):
         if len(before.channel.members)==0:
@@ -768,39 +3674,100 @@ async def on_voice_state_update(member, before, after):
             except:
                 pass
             del data["temp_vocs"][str(before.channel.id)]
-            save_data(data)
+            mark_dirty("temp_vocs", None, before.channel.id)
 
 # -------------------------
 # LINKS
 # -------------------------
+@bot.command(name="togglelinks")
+@commands.has_permissions(manage_guild=True)
+async def toggle_links(ctx):
+    cur = get_conf(ctx.guild.id, "antilink_enabled") or False
+    set_conf(ctx.guild.id, "antilink_enabled", not cur)
+    await ctx.send(f"Filtre de liens {'activé' if not cur else 'désactivé'}.")
+
 @bot.command(name="allowlink")
 @commands.has_permissions(manage_channels=True)
 async def allowlink_cmd(ctx, channel: discord.TextChannel):
     gid=str(ctx.guild.id)
     data.setdefault("allowed_links", {}).setdefault(gid, [])
-    if channel.id not in data["allowed_links"][gid]:
+    if channel.id not in get_link_filter(gid).channels:
         data["allowed_links"][gid].append(channel.id)
-        save_data(data)
+        mark_dirty("allowed_links", gid)
+        invalidate_links(gid)
     await ctx.send("Liens autorisés dans le salon.")
 
 @bot.command(name="disallowlink")
 @commands.has_permissions(manage_channels=True)
 async def disallowlink_cmd(ctx, channel: discord.TextChannel):
     gid=str(ctx.guild.id)
-    if channel.id in data.get("allowed_links", {}).get(gid, []):
+    if channel.id in get_link_filter(gid).channels:
         data["allowed_links"][gid].remove(channel.id)
-        save_data(data)
+        mark_dirty("allowed_links", gid)
+        invalidate_links(gid)
     await ctx.send("Liens désactivés dans le salon.")
 
+def _domain_arg(domain):
+    domain = domain.lower().strip()
+    domain = re.sub(r"^(?:https?://)?(?:www\.)?", "", domain)
+    return domain.split("/")[0].rstrip(".")
+
+async def _edit_domains(ctx, key, domain, add):
+    domain = _domain_arg(domain)
+    if "." not in domain:
+        await ctx.send("Domaine invalide.")
+        return
+    cur = list(get_conf(ctx.guild.id, key, []) or [])
+    if add and domain not in cur:
+        cur.append(domain)
+    elif not add and domain in cur:
+        cur.remove(domain)
+    set_conf(ctx.guild.id, key, cur)
+    invalidate_links(ctx.guild.id)
+    await ctx.send(f"{domain}: {'ajouté' if add else 'retiré'}.")
+
+@bot.command(name="allowdomain")
+@commands.has_permissions(manage_guild=True)
+async def allowdomain_cmd(ctx, domain: str):
+    await _edit_domains(ctx, "link_allow_domains", domain, True)
+
+@bot.command(name="denydomain")
+@commands.has_permissions(manage_guild=True)
+async def denydomain_cmd(ctx, domain: str):
+    await _edit_domains(ctx, "link_deny_domains", domain, True)
+
+@bot.command(name="removedomain")
+@commands.has_permissions(manage_guild=True)
+async def removedomain_cmd(ctx, domain: str):
+    await _edit_domains(ctx, "link_allow_domains", domain, False)
+    await _edit_domains(ctx, "link_deny_domains", domain, False)
+
 # -------------------------
 # AUTO-RESPONSES
 # -------------------------
 @bot.command(name="addresponse")
 @commands.has_permissions(manage_guild=True)
 async def addresponse_cmd(ctx, trigger: str, *, response: str):
+    # optional mode prefix: exact:, word:, prefix:, regex: (default contains)
     gid=str(ctx.guild.id)
-    data.setdefault("auto_responses", {}).setdefault(gid, {})[trigger]=response
-    save_data(data)
+    mode, sep, rest = trigger.partition(":")
+    if sep and mode.lower() in AR_MODES and rest:
+        mode, trigger = mode.lower(), rest
+    else:
+        mode = "contains"
+    if mode == "regex":
+        try:
+            re.compile(trigger)
+        except re.error as e:
+            await ctx.send(f"Regex invalide: {e}")
+            return
+    old = _ar_entry(data.setdefault("auto_responses", {}).setdefault(gid, {}).get(trigger) or {})
+    entry = {"response": response, "mode": mode}
+    if "cooldown" in old:
+        entry["cooldown"] = old["cooldown"]
+    data["auto_responses"][gid][trigger]=entry
+    mark_dirty("auto_responses", gid, trigger)
+    invalidate_responses(gid)
     await ctx.send("Auto-response ajouté.")
 
 @bot.command(name="listresponses")
@@ -812,8 +3779,10 @@ async def listresponses_cmd(ctx):
         await ctx.send("Aucune auto-response.")
         return
     e=discord.Embed(title="Auto-responses", color=0xff69b4)
-    for t,r in ars.items():
-        e.add_field(name=t, value=(r[:50]+"...") if len(r)>50 else r, inline=False)
+    for t,v in list(ars.items())[:25]:
+        entry = _ar_entry(v)
+        r = entry["response"]
+        e.add_field(name=f"{t} ({entry.get('mode', 'contains')})", value=(r[:50]+"...") if len(r)>50 else r, inline=False)
     await ctx.send(embed=e)
 
 @bot.command(name="delresponse")
@@ -822,9 +3791,31 @@ async def delresponse_cmd(ctx, trigger: str):
     gid=str(ctx.guild.id)
     if trigger in data.get("auto_responses", {}).get(gid, {}):
         del data["auto_responses"][gid][trigger]
-        save_data(data)
+        mark_dirty("auto_responses", gid, trigger)
+        invalidate_responses(gid)
     await ctx.send("Supprimé si existait.")
 
+@bot.command(name="responsecooldown")
+@commands.has_permissions(manage_guild=True)
+async def responsecooldown_cmd(ctx, trigger: str, seconds: float):
+    gid=str(ctx.guild.id)
+    ars = data.get("auto_responses", {}).get(gid, {})
+    if trigger not in ars:
+        await ctx.send("Auto-response introuvable.")
+        return
+    entry = _ar_entry(ars[trigger])
+    entry["cooldown"] = max(0.0, seconds)
+    ars[trigger] = entry
+    mark_dirty("auto_responses", gid, trigger)
+    invalidate_responses(gid)
+    await ctx.send(f"Cooldown de {trigger}: {seconds}s.")
+
+@bot.command(name="channelcooldown")
+@commands.has_permissions(manage_guild=True)
+async def channelcooldown_cmd(ctx, seconds: float):
+    set_conf(ctx.guild.id, "ar_channel_cooldown", max(0.0, seconds))
+    await ctx.send(f"Cooldown des auto-responses par salon: {seconds}s.")
+
 # -------------------------
 # SUGGESTIONS
 # -------------------------
@@ -833,7 +3824,7 @@ async def suggest_cmd(ctx, *, suggestion: str):
     gid=str(ctx.guild.id)
     sid = str(int(datetime.datetime.utcnow().timestamp()))
     data.setdefault("suggestions", {}).setdefault(gid, {})[sid] = {"author": str(ctx.author.id), "text": suggestion, "status":"pending"}
-    save_data(data)
+    mark_dirty("suggestions", gid, sid)
     await ctx.send("Suggestion enregistrée.")
 
 @bot.command(name="acceptsugg")
@@ -843,7 +3834,7 @@ async def acceptsugg_cmd(ctx, sid: str):
     sugg = data.get("suggestions", {}).get(gid, {}).get(sid)
     if sugg:
         sugg["status"]="accepted"
-        save_data(data)
+        mark_dirty("suggestions", gid, sid)
         await ctx.send("Suggestion acceptée.")
 
 @bot.command(name="denysugg")
@@ -853,159 +3844,380 @@ async def denysugg_cmd(ctx, sid: str):
     sugg = data.get("suggestions", {}).get(gid, {}).get(sid)
     if sugg:
         sugg["status"]="denied"
-        save_data(data)
+        mark_dirty("suggestions", gid, sid)
         await ctx.send("Suggestion refusée.")
 
 # -------------------------
 # ECONOMY
 # -------------------------
-@bot.command(name="balance")
+# All balance changes go through ledger.record(). Commands that check a
+# balance and then await (e.g. giving a shop role) hold the account locks for
+# the whole operation; locks are always taken in uid order, so transfers
+# between the same two accounts in opposite directions cannot deadlock.
+DAILY_AMOUNT = 100
+DAILY_COOLDOWN = 24*3600
+DEFAULT_SHOP_ITEMS = {"badge": {"price": 500}, "fleur": {"price": 300}, "coeur": {"price": 1000}}
+_account_locks = weakref.WeakValueDictionary()  # (gid, uid) -> asyncio.Lock, dropped once unused
+
+def account_lock(gid, uid):
+    key = (str(gid), str(uid))
+    lock = _account_locks.get(key)
+    if lock is None:
+        lock = _account_locks[key] = asyncio.Lock()
+    return lock
+
+@contextlib.asynccontextmanager
+async def locked_accounts(gid, *uids):
+    locks = [account_lock(gid, uid) for uid in sorted({str(u) for u in uids if u is not None})]
+    async with contextlib.AsyncExitStack() as stack:
+        for lock in locks:
+            await stack.enter_async_context(lock)
+        yield
+
+def account(gid, uid):
+    return data.get("economy", {}).get(str(gid), {}).get(str(uid))
+
+def balance(gid, uid):
+    acc = account(gid, uid)
+    return (acc.get("money") or 0) if acc else 0
+
+async def transfer(gid, src, dst, amount, kind="pay", **extra):
+    """Move money between two accounts; None if `src` can't afford it."""
+    async with locked_accounts(gid, src, dst):
+        if balance(gid, src) < amount:
+            return None
+        return ledger.record(gid, kind, amount, src=src, dst=dst, **extra)
+
+def shop_items(gid):
+    items = get_conf(gid, "shop_items")  # {} is an emptied catalog, not a missing one
+    return DEFAULT_SHOP_ITEMS if items is None else items
+
+@bot.command(name="balance", aliases=["bal"])
 async def balance_cmd(ctx, member: discord.Member=None):
     member = member or ctx.author
-    gid=str(ctx.guild.id)
-    bal = data.get("economy", {}).get(gid, {}).get(str(member.id), 0)
-    await ctx.send(f"{member.mention} a {bal} 💵")
+    await ctx.send(f"{member.mention} a {balance(ctx.guild.id, member.id)} 💵")
 
 @bot.command(name="daily")
 async def daily_cmd(ctx):
     gid=str(ctx.guild.id)
     uid=str(ctx.author.id)
-    user = data.setdefault("economy", {}).setdefault(gid, {}).setdefault(uid, {"money":0,"last_daily":None})
-    last = user.get("last_daily")
-    now = datetime.datetime.utcnow().timestamp()
-    if last and now - last < 24*3600:
-        await ctx.send("Tu as déjà pris ton daily.")
-        return
-    user["last_daily"] = now
-    user["money"] = user.get("money",0) + 100
-    save_data(data)
-    await ctx.send("Daily récupéré: 100 💵")
+    async with locked_accounts(gid, uid):
+        last = (account(gid, uid) or {}).get("last_daily")
+        now = time.time()
+        if last and now - last < DAILY_COOLDOWN:
+            left = int(DAILY_COOLDOWN - (now - last))
+            await ctx.send(f"Tu as déjà pris ton daily (encore {left//3600}h{left%3600//60:02d}).")
+            return
+        ledger.record(gid, "daily", DAILY_AMOUNT, dst=uid)
+    await ctx.send(f"Daily récupéré: {DAILY_AMOUNT} 💵")
 
 @bot.command(name="pay")
 async def pay_cmd(ctx, member: discord.Member, amount: int):
-    if amount<=0:
+    if amount<=0 or member.id == ctx.author.id:
         await ctx.send("Montant invalide.")
         return
-    gid=str(ctx.guild.id)
-    uid=str(ctx.author.id); vid=str(member.id)
-    em = data.setdefault("economy", {}).setdefault(gid, {}).setdefault(uid, {"money":0})
-    rm = data.setdefault("economy", {}).setdefault(gid, {}).setdefault(vid, {"money":0})
-    if em.get("money",0) < amount:
+    if not await transfer(ctx.guild.id, ctx.author.id, member.id, amount):
         await ctx.send("Pas assez d'argent.")
         return
-    em["money"] -= amount
-    rm["money"] = rm.get("money",0) + amount
-    save_data(data)
-    await ctx.send("Payé.")
+    await ctx.send(f"Payé: {amount} 💵 à {member.mention}.")
+
+@bot.command(name="addmoney")
+@commands.has_permissions(administrator=True)
+async def addmoney_cmd(ctx, member: discord.Member, amount: int):
+    gid=str(ctx.guild.id); uid=str(member.id)
+    async with locked_accounts(gid, uid):
+        if amount >= 0:
+            ledger.record(gid, "admin", amount, dst=uid, by=str(ctx.author.id))
+        else:
+            ledger.record(gid, "admin", min(-amount, balance(gid, uid)), src=uid, by=str(ctx.author.id))
+    await ctx.send(f"{member.mention} a maintenant {balance(gid, uid)} 💵")
 
 @bot.command(name="shop")
 async def shop_cmd(ctx):
-    items = {"badge":500, "fleur":300, "coeur":1000}
+    items = shop_items(ctx.guild.id)
+    if not items:
+        await ctx.send("La boutique est vide.")
+        return
     e=discord.Embed(title="Boutique", color=0xff69b4)
-    for k,v in items.items():
-        e.add_field(name=k, value=f"{v} 💵", inline=False)
+    for name, item in sorted(items.items(), key=lambda kv: kv[1]["price"]):
+        role = ctx.guild.get_role(item["role"]) if item.get("role") else None
+        e.add_field(name=name, value=f"{item['price']} 💵" + (f" • {role.mention}" if role else ""), inline=False)
     await ctx.send(embed=e)
 
+@bot.command(name="shopadd")
+@commands.has_permissions(manage_guild=True)
+async def shopadd_cmd(ctx, name: str, price: int, role: discord.Role=None):
+    if price < 0:
+        return await ctx.send("Prix invalide.")
+    if role and (role >= ctx.guild.me.top_role or role.managed):
+        return await ctx.send("Je ne peux pas attribuer ce rôle.")
+    items = dict(shop_items(ctx.guild.id))
+    items[name.lower()] = {"price": price, "role": role.id if role else None}
+    set_conf(ctx.guild.id, "shop_items", items)
+    await ctx.send(f"Article `{name.lower()}` ajouté ({price} 💵).")
+
+@bot.command(name="shopremove")
+@commands.has_permissions(manage_guild=True)
+async def shopremove_cmd(ctx, name: str):
+    items = dict(shop_items(ctx.guild.id))
+    if items.pop(name.lower(), None) is None:
+        return await ctx.send("Item inconnu.")
+    set_conf(ctx.guild.id, "shop_items", items)
+    await ctx.send(f"Article `{name.lower()}` retiré.")
+
 @bot.command(name="buy")
 async def buy_cmd(ctx, item: str):
-    items = {"badge":500, "fleur":300, "coeur":1000}
     item = item.lower()
-    if item not in items:
+    entry = shop_items(ctx.guild.id).get(item)
+    if entry is None:
         await ctx.send("Item inconnu.")
         return
     gid=str(ctx.guild.id); uid=str(ctx.author.id)
-    user = data.setdefault("economy", {}).setdefault(gid, {}).setdefault(uid, {"money":0})
-    price = items[item]
-    if user.get("money",0) < price:
-        await ctx.send("Pas assez d'argent.")
-        return
-    user["money"] -= price
-    save_data(data)
+    role = ctx.guild.get_role(entry["role"]) if entry.get("role") else None
+    async with locked_accounts(gid, uid):
+        if role and role in ctx.author.roles:
+            await ctx.send("Tu as déjà cet article.")
+            return
+        if balance(gid, uid) < entry["price"]:
+            await ctx.send("Pas assez d'argent.")
+            return
+        if role:
+            # the role first: a failed grant costs nothing
+            try:
+                await ctx.author.add_roles(role, reason=f"Achat: {item}")
+            except Exception:
+                await ctx.send("Impossible de donner le rôle, achat annulé.")
+                return
+        ledger.record(gid, "buy", entry["price"], src=uid, item=item)
     await ctx.send("Achat effectué.")
 
 # -------------------------
 # GIVEAWAYS (simple)
 # -------------------------
+GIVEAWAY_EMOJI = "🎉"
+GIVEAWAY_RETENTION = 7*86400  # ended giveaways stay rerollable this long
+_GIVEAWAY_OPT = re.compile(r"(winners|role|level)=(\S+)\s*", re.IGNORECASE)
+
 @bot.command(name="gstart")
 @commands.has_permissions(manage_guild=True)
 async def gstart_cmd(ctx, duration: str, *, prize: str):
     # duration format: 1h, 30m, 1d
+    # leading options: winners=N role=@Role level=N
     m = re.match(r"(\d+)([smhd])", duration)
     if not m:
         await ctx.send("Format durée invalide. Ex: 10s 5m 1h 1d")
         return
     num, unit = int(m.group(1)), m.group(2)
     mult = {"s":1,"m":60,"h":3600,"d":86400}[unit]
+    winners, req = 1, {}
+    while (opt := _GIVEAWAY_OPT.match(prize)):
+        key, value = opt.group(1).lower(), opt.group(2)
+        if key == "role":
+            rid = re.sub(r"\D", "", value)
+            role = ctx.guild.get_role(int(rid)) if rid else discord.utils.get(ctx.guild.roles, name=value)
+            if not role:
+                await ctx.send(f"Rôle introuvable: {value}")
+                return
+            req["role"] = role.id
+        elif value.isdigit():
+            if key == "winners":
+                winners = max(1, int(value))
+            else:
+                req["level"] = int(value)
+        prize = prize[opt.end():]
+    if not prize:
+        await ctx.send("Précise un lot.")
+        return
     end = datetime.datetime.utcnow() + datetime.timedelta(seconds=num*mult)
-    msg = await ctx.send(embed=discord.Embed(title="Giveaway", description=f"{prize}\nReact 🎉 to join\nEnds: {end.isoformat()}"))
-    await msg.add_reaction("🎉")
+    desc = f"{prize}\nReact {GIVEAWAY_EMOJI} to join\nWinners: {winners}\nEnds: {end.isoformat()}"
+    if "role" in req:
+        desc += f"\nRôle requis: <@&{req['role']}>"
+    if "level" in req:
+        desc += f"\nNiveau requis: {req['level']}"
+    msg = await ctx.send(embed=discord.Embed(title="Giveaway", description=desc))
+    await msg.add_reaction(GIVEAWAY_EMOJI)
     gid=str(ctx.guild.id)
-    data.setdefault("giveaways", {})[str(msg.id)] = {"guild":gid, "channel":str(ctx.channel.id), "end_time": end.isoformat(), "prize":prize}
-    save_data(data)
+    data.setdefault("giveaways", {})[str(msg.id)] = {"guild":gid, "channel":str(ctx.channel.id), "end_time": end.isoformat(), "prize":prize,
+                                                     "winners": winners, "requirements": req,
+                                                     "entrants_complete": True}
+    mark_dirty("giveaways", None, msg.id)
+    giveaway_scheduler.schedule(str(msg.id), utc_timestamp(end.isoformat()))
     await ctx.send("Giveaway lancé.")
 
-@tasks.loop(seconds=20.0)
-async def check_giveaway_expiry():
-    now = datetime.datetime.utcnow()
-    to_end=[]
-    for mid,g in list(data.get("giveaways", {}).items()):
-        end = datetime.datetime.fromisoformat(g["end_time"])
-        if now >= end:
-            to_end.append(mid)
-    for mid in to_end:
-        g = data["giveaways"].get(mid)
-        if not g:
+# Entrants are recorded from raw reaction events, one entry per entrant in
+# data["giveaway_entrants"][gid]["<mid>:<uid>"], so a reaction only dirties its
+# own entry instead of the whole list. _entrants[mid] = (uids, uid -> index)
+# mirrors them for O(1) swap-removal and random draws; it is rebuilt lazily
+# after a restart. Giveaways started before entrant tracking lack
+# "entrants_complete": their reactors are merged in once, at the draw.
+_entrants = {}
+
+def _entrant_key(mid, uid):
+    return f"{mid}:{uid}"
+
+def _entrant_store(g):
+    return data.setdefault("giveaway_entrants", {}).setdefault(g["guild"], {})
+
+def _entrant_state(mid):
+    st = _entrants.get(mid)
+    if st is None:
+        g = data["giveaways"][mid]
+        stored = _entrant_store(g)
+        prefix = f"{mid}:"
+        uids = [int(k[len(prefix):]) for k in stored if k.startswith(prefix)]
+        st = _entrants[mid] = (uids, {uid: i for i, uid in enumerate(uids)})
+        legacy = g.pop("entrants", None)
+        if legacy is not None:
+            # list kept inside the giveaway record by older versions
+            for uid in legacy:
+                _add_entrant(mid, g, uid)
+            mark_dirty("giveaways", None, mid)
+    return st
+
+def _add_entrant(mid, g, uid):
+    uids, pos = _entrant_state(mid)
+    if uid in pos:
+        return
+    pos[uid] = len(uids)
+    uids.append(uid)
+    key = _entrant_key(mid, uid)
+    _entrant_store(g)[key] = 1
+    mark_dirty("giveaway_entrants", g["guild"], key)
+
+def giveaway_add_entrant(mid, uid):
+    g = data["giveaways"][mid]
+    if not g.get("ended"):
+        _add_entrant(mid, g, uid)
+
+def giveaway_remove_entrant(mid, uid):
+    g = data["giveaways"][mid]
+    if g.get("ended"):
+        return
+    uids, pos = _entrant_state(mid)
+    i = pos.pop(uid, None)
+    if i is None:
+        return
+    last = uids.pop()
+    if i < len(uids):
+        uids[i] = last
+        pos[last] = i
+    key = _entrant_key(mid, uid)
+    _entrant_store(g).pop(key, None)
+    mark_dirty("giveaway_entrants", g["guild"], key)
+
+def drop_entrants(mid, g):
+    uids, pos = _entrant_state(mid)
+    stored = _entrant_store(g)
+    for uid in uids:
+        key = _entrant_key(mid, uid)
+        stored.pop(key, None)
+        mark_dirty("giveaway_entrants", g["guild"], key)
+    _entrants.pop(mid, None)
+
+def giveaway_eligible(guild, g, uid):
+    req = g.get("requirements") or {}
+    if "role" in req:
+        member = guild.get_member(uid) if guild else None
+        if not member or not any(r.id == req["role"] for r in member.roles):
+            return False
+    if "level" in req:
+        u = data.get("levels", {}).get(g["guild"], {}).get(str(uid))
+        if not u or u["level"] < req["level"]:
+            return False
+    return True
+
+def draw_winners(guild, g, entrants, count, exclude=()):
+    """Pick up to count distinct eligible entrants by random probing (no copy of the list)."""
+    exclude = set(exclude)
+    picked, winners = set(), []
+    while len(winners) < count and len(picked) < len(entrants):
+        i = random.randrange(len(entrants))
+        if i in picked:
             continue
-        guild = bot.get_guild(int(g["guild"]))
-        channel = guild.get_channel(int(g["channel"])) if guild else None
-        if channel:
-            try:
-                msg = await channel.fetch_message(int(mid))
-                reaction = discord.utils.get(msg.reactions, emoji="🎉")
-                users = []
-                if reaction:
-                    users = [u async for u in reaction.users() if not u.bot]
-                if users:
-                    winner = random.choice(users)
-                    await channel.send(f"Winner: {winner.mention} - Prize: {g['prize']}")
-                else:
-                    await channel.send("Aucun participant.")
-            except:
-                pass
-        del data["giveaways"][mid]
-        save_data(data)
+        picked.add(i)
+        uid = entrants[i]
+        if uid not in exclude and giveaway_eligible(guild, g, uid):
+            winners.append(uid)
+    return winners
+
+async def _legacy_entrants(channel, mid):
+    # giveaways started before entrant tracking: page the reactors once
+    msg = await channel.fetch_message(int(mid))
+    reaction = discord.utils.get(msg.reactions, emoji=GIVEAWAY_EMOJI)
+    return [u.id async for u in reaction.users() if not u.bot] if reaction else []
+
+async def complete_entrants(mid, g, channel):
+    if g.get("entrants_complete") or not channel:
+        return
+    try:
+        reactors = await _legacy_entrants(channel, mid)
+    except Exception:
+        return  # retried at the next reroll
+    for uid in reactors:
+        _add_entrant(mid, g, uid)
+    g["entrants_complete"] = True
+    mark_dirty("giveaways", None, mid)
+
+async def end_giveaway(mid):
+    g = data.get("giveaways", {}).get(mid)
+    if not g:
+        return
+    if g.get("ended"):
+        # retention expired, nothing left to reroll
+        drop_entrants(mid, g)
+        data["giveaways"].pop(mid, None)
+        mark_dirty("giveaways", None, mid)
+        return
+    guild = bot.get_guild(int(g["guild"]))
+    channel = guild.get_channel(int(g["channel"])) if guild else None
+    await complete_entrants(mid, g, channel)
+    winners = draw_winners(guild, g, _entrant_state(mid)[0], g.get("winners", 1))
+    g["ended"] = True
+    g["drawn"] = winners
+    mark_dirty("giveaways", None, mid)
+    giveaway_scheduler.schedule(mid, time.time() + GIVEAWAY_RETENTION)
+    if channel:
+        if winners:
+            await safe_send(channel, f"Winner: {', '.join(f'<@{u}>' for u in winners)} - Prize: {g['prize']}")
+        else:
+            await safe_send(channel, "Aucun participant.")
+
+def giveaway_due(g):
+    end = utc_timestamp(g["end_time"])
+    return end + GIVEAWAY_RETENTION if g.get("ended") else end
+
+# one heap for every giveaway of every guild, rebuilt from data in on_ready
+giveaway_scheduler = Scheduler("giveaway", end_giveaway)
 
 @bot.command(name="gend")
 @commands.has_permissions(manage_guild=True)
 async def gend_cmd(ctx, message_id: int):
     mid=str(message_id)
-    if mid in data.get("giveaways", {}):
-        del data["giveaways"][mid]
-        save_data(data)
+    g = data.get("giveaways", {}).get(mid)
+    if g and not g.get("ended"):
+        # due now: the scheduler wakes up and draws immediately
+        giveaway_scheduler.schedule(mid, time.time())
         await ctx.send("Giveaway terminé.")
 
 @bot.command(name="greroll")
 @commands.has_permissions(manage_guild=True)
-async def greroll_cmd(ctx, message_id: int):
+async def greroll_cmd(ctx, message_id: int, count: int=1):
     mid=str(message_id)
     g = data.get("giveaways", {}).get(mid)
     if not g:
         await ctx.send("Giveaway introuvable.")
         return
-    guild = bot.get_guild(int(g["guild"]))
-    channel = guild.get_channel(int(g["channel"])) if guild else None
-    if channel:
-        try:
-            msg = await channel.fetch_message(int(mid))
-            reaction = discord.utils.get(msg.reactions, emoji="🎉")
-            users = [u async for u in reaction.users() if not u.bot] if reaction else []
-            if users:
-                winner = random.choice(users)
-                await ctx.send(f"New winner: {winner.mention}")
-            else:
-                await ctx.send("Aucun participant.")
-        except:
-            await ctx.send("Erreur.")
+    if not g.get("ended"):
+        await ctx.send("Le giveaway n'est pas encore terminé.")
+        return
+    await complete_entrants(mid, g, ctx.guild.get_channel(int(g["channel"])))
+    winners = draw_winners(ctx.guild, g, _entrant_state(mid)[0], max(1, count), exclude=g.get("drawn", []))
+    if winners:
+        g["drawn"] = g.get("drawn", []) + winners
+        mark_dirty("giveaways", None, mid)
+        await ctx.send(f"New winner: {', '.join(f'<@{u}>' for u in winners)}")
+    else:
+        await ctx.send("Aucun participant.")
 
 # -------------------------
 # FUN & UTIL
@@ -1132,8 +4344,166 @@ async def config2(ctx):
     )
     await ctx.send(embed=embed, view=view)
 
+# -------------------------
+# MONITORING
+# -------------------------
+# Registered last so every @bot.event handler above gets wrapped.
+LAG_INTERVAL = 0.5
+
+def _instrument_event(name, fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            metrics.inc("hoshimi_event_errors_total", event=name)
+            raise
+        finally:
+            metrics.observe("hoshimi_event_seconds", time.perf_counter() - started, event=name)
+    return wrapper
+
+def instrument_events():
+    for name, fn in list(vars(bot).items()):
+        if name.startswith("on_") and asyncio.iscoroutinefunction(fn) and not hasattr(fn, "__wrapped__"):
+            setattr(bot, name, _instrument_event(name, fn))
+
+@bot.before_invoke
+async def _command_started(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+@bot.after_invoke
+async def _command_finished(ctx):
+    name = ctx.command.qualified_name if ctx.command else "?"
+    metrics.observe("hoshimi_command_seconds", time.perf_counter() - getattr(ctx, "metrics_started", time.perf_counter()), command=name)
+    metrics.inc("hoshimi_commands_total", command=name, status="error" if ctx.command_failed else "ok")
+
+def instrument_http():
+    """Time every Discord API call by route template (low cardinality)."""
+    request = bot.http.request
+    if hasattr(request, "__wrapped__"):
+        return
+
+    @functools.wraps(request)
+    async def timed_request(route, **kwargs):
+        started = time.perf_counter()
+        labels = {"method": route.method, "route": getattr(route, "path", "?")}
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            metrics.inc("hoshimi_http_errors_total", status=e.status)
+            raise
+        except Exception:
+            metrics.inc("hoshimi_http_errors_total", status="network")
+            raise
+        finally:
+            metrics.observe("hoshimi_http_request_seconds", time.perf_counter() - started, **labels)
+    bot.http.request = timed_request
+
+class RateLimitCounter(logging.Handler):
+    """discord.py retries 429s itself and only logs them; count those lines."""
+    def emit(self, record):
+        try:
+            if "rate limited" in record.getMessage():
+                metrics.inc("hoshimi_http_ratelimited_total")
+        except Exception:
+            pass
+
+async def _loop_lag_monitor():
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - t - LAG_INTERVAL)
+        metrics.last_lag = lag
+        metrics.observe("hoshimi_loop_lag_seconds", lag)
+
+async def _metrics_client(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+_monitor_tasks = {}
+
+async def start_monitoring():
+    if "lag" not in _monitor_tasks:
+        _monitor_tasks["lag"] = asyncio.create_task(_loop_lag_monitor())
+    if METRICS_PORT and "server" not in _monitor_tasks:
+        try:
+            _monitor_tasks["server"] = await asyncio.start_server(_metrics_client, METRICS_HOST, METRICS_PORT)
+            print(f"Métriques sur http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print("Erreur serveur de métriques:", e)
+
+metrics.last_lag = 0.0
+metrics.gauge("hoshimi_guilds", "Guilds the bot is in", lambda: len(bot.guilds))
+metrics.gauge("hoshimi_gateway_latency_seconds", "Heartbeat latency", lambda: bot.latency if bot.latency == bot.latency else 0.0)
+metrics.gauge("hoshimi_dirty_entries", "Changes waiting for the next flush", lambda: pending_changes()[0])
+metrics.gauge("hoshimi_log_queue_depth", "Queued log embeds", lambda: log_dispatcher.depth())
+metrics.gauge("hoshimi_log_dropped", "Log embeds dropped since start", lambda: log_dispatcher.dropped)
+metrics.gauge("hoshimi_dm_queue_depth", "Queued DMs", lambda: dm_queue.depth())
+metrics.gauge("hoshimi_scheduler_lag_seconds", "How late the next due timer is",
+              lambda: [({"scheduler": s.name}, s.lag()) for s in (giveaway_scheduler, mute_scheduler)])
+metrics.gauge("hoshimi_scheduler_fired", "Timers fired since start",
+              lambda: [({"scheduler": s.name}, s.fired) for s in (giveaway_scheduler, mute_scheduler)])
+metrics.gauge("hoshimi_resident_guilds", "Guilds loaded in memory (shards backend)",
+              lambda: len(store.last_used) if isinstance(store, ShardStore) else len(data.get("config", {})))
+metrics.gauge("hoshimi_uptime_seconds", "Seconds since start", lambda: time.time() - metrics.started)
+
+instrument_events()
+instrument_http()
+logging.getLogger("discord.http").addHandler(RateLimitCounter())
+
+def _ms(seconds):
+    return f"{seconds * 1000:.1f}ms"
+
+def _top_series(name, label, limit=8):
+    rows = sorted(metrics.series(name).items(), key=lambda kv: -kv[1].count)[:limit]
+    return "\n".join(f"`{dict(labels).get(label, '?')}` {h.count} · p50 {_ms(h.quantile(0.5))} · p99 {_ms(h.quantile(0.99))}"
+                     for labels, h in rows) or "—"
+
+@bot.command(name="stats")
+@commands.has_permissions(administrator=True)
+async def stats_cmd(ctx):
+    e = discord.Embed(title="📊 Statistiques Hoshimi", color=0xff69b4)
+    e.add_field(name="Événements", value=_top_series("hoshimi_event_seconds", "event"), inline=False)
+    e.add_field(name="Commandes", value=_top_series("hoshimi_command_seconds", "command"), inline=False)
+    count, age = pending_changes()
+    flush = metrics.series("hoshimi_persist_seconds").get((("op", "flush"),), Histogram())
+    e.add_field(name="Sauvegarde", value=f"{persist_stats['flushes']} écritures ({persist_stats['entries']} entrées), {persist_stats['compactions']} compactions\n"
+                f"p50 {_ms(flush.quantile(0.5))} · p99 {_ms(flush.quantile(0.99))} · en attente {count} ({age:.1f}s)"
+                + (f"\n{len(store.last_used)} serveurs en mémoire · {store.loads} chargés · {store.evictions} libérés" if isinstance(store, ShardStore) else ""), inline=False)
+    lag = metrics.series("hoshimi_loop_lag_seconds").get((), Histogram())
+    e.add_field(name="Boucle", value=f"lag {_ms(metrics.last_lag)} · p99 {_ms(lag.quantile(0.99))}\n"
+                f"giveaways {_ms(giveaway_scheduler.lag())} · mutes {_ms(mute_scheduler.lag())}", inline=True)
+    http = metrics.series("hoshimi_http_request_seconds")
+    errors = sum(v for (n, _), v in metrics.counters.items() if n == "hoshimi_http_errors_total")
+    e.add_field(name="API Discord", value=f"{sum(h.count for h in http.values())} requêtes · {errors:g} erreurs · "
+                f"{metrics.counter('hoshimi_http_ratelimited_total'):g} 429", inline=True)
+    e.add_field(name="Files", value=f"logs {log_dispatcher.depth()} ({log_dispatcher.dropped} perdus) · DM {dm_queue.depth()}", inline=True)
+    e.set_footer(text=f"Depuis {datetime.timedelta(seconds=int(time.time() - metrics.started))}")
+    await ctx.send(embed=e)
+
 
 if __name__ == "__main__":
+    if "--export-json" in sys.argv:
+        i = sys.argv.index("--export-json")
+        path = sys.argv[i + 1] if i + 1 < len(sys.argv) else DATA_FILE + ".export.json"
+        export_json(path)
+        print(f"Données exportées dans {path}.")
+        exit(0)
     TOKEN = os.environ.get("DISCORD_TOKEN")
     if not TOKEN:
         print("DISCORD_TOKEN manquant.")
@@ -1144,3 +4514,6 @@ if __name__ == "__main__":
         print("Token invalide.")
     except Exception as e:
         print("Erreur fatale:", e)
+    finally:
+        apply_pending_xp()
+        flush_data()
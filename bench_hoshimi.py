@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Offline micro-benchmarks for Hoshimi's hot paths.
+No Discord connection: guilds, members and messages are small fakes, data
+is synthetic and lives in a temporary directory.
+Run: `python bench_hoshimi.py [--sizes 1000,100000] [--out bench_results.json] [--compare old.json]`
+Each scenario reports ops/sec, p50/p99 latency and peak traced memory.
+"""
+
+import os
+import gc
+import json
+import time
+import asyncio
+import random
+import string
+import inspect
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+import tracemalloc
+
+_tmp = tempfile.mkdtemp(prefix="hoshimi-bench-")
+os.environ.setdefault("HOSHIMI_DATA_FILE", os.path.join(_tmp, "hoshimi_data.json"))
+os.environ.setdefault("HOSHIMI_STORAGE", "json")
+
+import Hoshimi as H  # noqa: E402  (needs the env above)
+
+# -------------------------
+# FAKES
+# -------------------------
+class FakePerms:
+    manage_messages = False
+    administrator = False
+
+class FakeRole:
+    def __init__(self, rid, name="role"):
+        self.id = rid
+        self.name = name
+        self.members = []
+
+class FakeSent:
+    async def edit(self, **kw):
+        pass
+
+class FakeChannel:
+    def __init__(self, cid, name="general"):
+        self.id = cid
+        self.name = name
+        self.mention = f"<#{cid}>"
+        self.sent = 0
+
+    async def send(self, content=None, embed=None, embeds=None, delete_after=None, view=None):
+        self.sent += 1
+        return FakeSent()
+
+class FakeMember:
+    def __init__(self, uid, guild):
+        self.id = uid
+        self.name = f"user{uid}"
+        self.display_name = self.name
+        self.mention = f"<@{uid}>"
+        self.bot = False
+        self.guild = guild
+        self.roles = []
+        self.guild_permissions = FakePerms()
+        self.avatar = None
+        self.created_at = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    async def send(self, content=None, embed=None):
+        return FakeSent()
+
+class FakeGuild:
+    def __init__(self, gid, members=0):
+        self.id = gid
+        self.name = f"guild{gid}"
+        self.members = {uid: FakeMember(uid, self) for uid in range(1, members + 1)}
+        self.channels = {10: FakeChannel(10), 11: FakeChannel(11, "logs")}
+        self.roles = []
+        self.default_role = FakeRole(gid, "@everyone")
+
+    def get_member(self, uid):
+        return self.members.get(uid)
+
+    def get_channel(self, cid):
+        return self.channels.get(cid)
+
+    def get_role(self, rid):
+        return None
+
+    @property
+    def text_channels(self):
+        return list(self.channels.values())
+
+class FakeMessage:
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+        self.raw_mentions = []
+        self.raw_role_mentions = []
+
+    async def delete(self):
+        pass
+
+class FakeCtx:
+    def __init__(self, guild, author, channel):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+
+    async def send(self, content=None, embed=None, **kw):
+        return FakeSent()
+
+# -------------------------
+# HELPERS
+# -------------------------
+def reset_state():
+    H.data.clear()
+    for k in ["config","warnings","levels","economy","backups","premium_users","auto_responses","suggestions","giveaways","giveaway_entrants","reaction_roles","allowed_links","tickets","roles_invites","badges","mutes","user_invites"]:
+        H.data[k] = {}
+    for cache in (H._badword_matchers, H._response_engines, H._level_indexes, H._link_filters, H._spam_states, H._ar_cooldowns, H._entrants):
+        cache.clear()
+    H._take_dirty()
+
+def words(n, k=8, seed=1):
+    rnd = random.Random(seed)
+    return ["".join(rnd.choices(string.ascii_lowercase, k=k)) for _ in range(n)]
+
+def synthetic_levels(gid, users, seed=2):
+    rnd = random.Random(seed)
+    H.data["levels"][str(gid)] = {str(uid): {"xp": rnd.randrange(100), "level": rnd.randrange(1, 60), "messages": rnd.randrange(5000)}
+                                  for uid in range(1, users + 1)}
+    H.columnarize(H.data, [str(gid)])
+
+SAMPLE_TEXT = "salut tout le monde, quelqu'un a vu le dernier épisode ? c'était vraiment pas mal du tout"
+
+def summarize(name, params, samples_ns, total_s, peak):
+    samples_ns.sort()
+    n = len(samples_ns)
+    pick = lambda q: samples_ns[min(n - 1, int(q * n))] / 1000.0
+    return {"name": name, "params": params, "ops": n, "ops_per_sec": n / total_s if total_s else 0.0,
+            "p50_us": pick(0.50), "p99_us": pick(0.99), "peak_kib": peak / 1024.0}
+
+async def measure(name, params, op, n, mem_n=None):
+    """Time `n` calls of op (sync or async), then trace memory over mem_n more calls."""
+    samples = []
+    gc.collect()
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter_ns()
+        r = op(i)
+        if inspect.isawaitable(r):
+            await r
+        samples.append(time.perf_counter_ns() - t)
+    total = time.perf_counter() - start
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    for i in range(mem_n or max(1, n // 10)):
+        r = op(i)
+        if inspect.isawaitable(r):
+            await r
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    res = summarize(name, params, samples, total, peak)
+    print(f"{name:<28} {json.dumps(params):<34} {res['ops_per_sec']:>12.0f} ops/s  p50 {res['p50_us']:>9.1f}µs  p99 {res['p99_us']:>9.1f}µs  peak {res['peak_kib']:>9.1f} KiB")
+    return res
+
+# -------------------------
+# SCENARIOS
+# -------------------------
+async def bench_on_message(sizes, n):
+    out = []
+    H.bot.process_commands = _no_commands  # command dispatch is not what we measure
+    for nwords in (10, 1000, 10000):
+        reset_state()
+        g = FakeGuild(1, members=1000)
+        gid = str(g.id)
+        H.ensure_guild(gid)
+        H.data["config"][gid].update({"automod_enabled": True, "level_system_enabled": True, "antispam_enabled": True,
+                                      "antilink_enabled": True, "bad_words": words(nwords), "antispam": {"max_messages": 1000}})
+        H.data["auto_responses"][gid] = {t: {"response": "ok", "mode": "word"} for t in words(100, seed=3)}
+        ch = g.channels[10]
+        msgs = [FakeMessage(SAMPLE_TEXT, g.members[1 + i % 1000], ch) for i in range(n)]
+        out.append(await measure("on_message", {"bad_words": nwords}, lambda i: H.on_message(msgs[i % n]), n))
+    return out
+
+async def _no_commands(message):
+    return None
+
+async def bench_conf(sizes, n):
+    reset_state()
+    for gid in range(1000):
+        H.ensure_guild(gid)
+        H.set_conf(gid, "level_system_enabled", True)
+    H._take_dirty()
+    return [await measure("get_conf", {"guilds": 1000}, lambda i: H.get_conf(i % 1000, "level_system_enabled"), n * 10),
+            await measure("ensure_guild", {"guilds": 1000}, lambda i: H.ensure_guild(i % 1000), n * 10)]
+
+async def bench_records(sizes, n):
+    """Resident size of the level records and the cost of a row update."""
+    out = []
+    for users in sizes:
+        reset_state()
+        gc.collect()
+        tracemalloc.start()
+        synthetic_levels(1, users)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        levels = H.data["levels"]["1"]
+        def bump(i):
+            u = levels[str(1 + i % users)]
+            u["xp"] += 1
+            u["messages"] += 1
+        res = await measure("level_row_update", {"users": users}, bump, n * 10)
+        res["resident_bytes_per_user"] = size / users
+        print(f"{'':<28} resident {size / users:.0f} B/user")
+        out.append(res)
+    return out
+
+async def bench_persistence(sizes, n):
+    out = []
+    for users in sizes:
+        reset_state()
+        synthetic_levels(1, users)
+        out.append(await measure("save_data", {"users": users}, lambda i: H.save_data(H.data), max(3, min(20, 200000 // users)), 1))
+        def flush(i):
+            for uid in range(1, 101):
+                H.mark_dirty("levels", 1, (uid * 7919 + i) % users + 1)
+            return H.flush_data()
+        out.append(await measure("flush_100_dirty", {"users": users}, flush, max(10, n // 10)))
+    return out
+
+async def bench_leaderboard(sizes, n):
+    out = []
+    for users in sizes:
+        reset_state()
+        g = FakeGuild(1, members=min(users, 1000))
+        synthetic_levels(1, users)
+        ctx = FakeCtx(g, g.members[1], g.channels[10])
+        def build(i):
+            H._level_indexes.clear()
+            H.get_level_index(1)
+        out.append(await measure("leaderboard_index_build", {"users": users}, build, 3, 1))
+        out.append(await measure("leaderboard_cmd", {"users": users}, lambda i: H.leaderboard_cmd.callback(ctx, 1 + i % 5), n))
+        rnd = random.Random(4)
+        levels = H.data["levels"]["1"]
+        def gain(i):
+            uid = str(rnd.randrange(1, users + 1))
+            u = levels[uid]
+            u["xp"] += 15
+            H.level_index_update(1, uid, u)
+        out.append(await measure("leaderboard_update", {"users": users}, gain, n * 10))
+        out.append(await measure("rank_position", {"users": users}, lambda i: H.get_level_index(1).position(str(1 + i % users)), n * 10))
+    return out
+
+async def bench_badwords(sizes, n):
+    out = []
+    for nwords in (10, 1000, 10000):
+        m = H.BadWordMatcher(words(nwords))
+        out.append(await measure("badword_search", {"bad_words": nwords}, lambda i: m.search(SAMPLE_TEXT), n * 10))
+    return out
+
+async def bench_giveaways(sizes, n):
+    out = []
+    reset_state()
+    fired = []
+    async def cb(key):
+        fired.append(time.time() - due[key])
+    sched = H.Scheduler("bench", cb)
+    due = {}
+    now = time.time()
+    for count in (1000, 10000):
+        def push(i):
+            key = f"{count}:{i}"
+            due[key] = now + 3600 + i
+            sched.schedule(key, due[key])
+        out.append(await measure("giveaway_schedule", {"giveaways": count}, push, count, 1))
+    # firing precision: 1000 expiries spread over 0.5s
+    sched.heap.clear()
+    sched.due.clear()
+    sched.start()
+    base = time.time() + 0.2
+    for i in range(1000):
+        key = f"fire:{i}"
+        due[key] = base + i * 0.0005
+        sched.schedule(key, due[key])
+    await asyncio.sleep(1.0)
+    lates = sorted(int(x * 1e9) for x in fired)
+    res = summarize("giveaway_fire_lateness", {"giveaways": 1000}, lates, 1.0, 0)
+    print(f"{res['name']:<28} p50 {res['p50_us']:.1f}µs p99 {res['p99_us']:.1f}µs ({len(lates)} fired)")
+    out.append(res)
+    sched._task.cancel()
+    g = {"guild": "1", "requirements": {}}
+    entrants = list(range(10000))
+    out.append(await measure("giveaway_draw", {"entrants": 10000, "winners": 5}, lambda i: H.draw_winners(None, g, entrants, 5), n))
+    return out
+
+SCENARIOS = {
+    "on_message": bench_on_message,
+    "conf": bench_conf,
+    "persistence": bench_persistence,
+    "leaderboard": bench_leaderboard,
+    "records": bench_records,
+    "badwords": bench_badwords,
+    "giveaways": bench_giveaways,
+}
+
+def git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(results, path):
+    with open(path, "r", encoding="utf-8") as f:
+        old = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in json.load(f)["results"]}
+    print(f"\nComparaison avec {path}:")
+    for r in results:
+        o = old.get((r["name"], json.dumps(r["params"], sort_keys=True)))
+        if o and o["ops_per_sec"]:
+            print(f"{r['name']:<28} {json.dumps(r['params']):<34} x{r['ops_per_sec'] / o['ops_per_sec']:.2f} ops/s  p99 {o['p99_us']:.1f} -> {r['p99_us']:.1f}µs")
+
+async def main(args):
+    sizes = [int(x) for x in args.sizes.split(",")]
+    results = []
+    for name in (args.only.split(",") if args.only else SCENARIOS):
+        results.extend(await SCENARIOS[name](sizes, args.n))
+    doc = {"version": 1, "git": git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+           "date": datetime.datetime.utcnow().isoformat(), "sizes": sizes, "results": results}
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2)
+    print(f"\nRésultats écrits dans {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Hoshimi micro-benchmarks")
+    p.add_argument("--sizes", default="1000,100000", help="user counts for the synthetic datasets (e.g. 1000,100000,1000000)")
+    p.add_argument("--n", type=int, default=2000, help="base iteration count per scenario")
+    p.add_argument("--only", default="", help="comma-separated scenarios: " + ",".join(SCENARIOS))
+    p.add_argument("--out", default="bench_results.json")
+    p.add_argument("--compare", default="", help="previous result file to compare against")
+    asyncio.run(main(p.parse_args()))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+End-to-end load simulator: replays a synthetic gateway event mix (messages,
+joins, reaction adds, voice state changes) across many fake guilds through
+the registered bot event handlers. Every outbound API call made by the fakes
+goes through a stub HTTP layer that records the route and waits a simulated
+latency, so the bot's own queues and locks behave as they would live.
+Run: `python loadsim_hoshimi.py [--guilds 2000] [--rate 2000] [--duration 30] [--out loadsim_results.json]`
+Reports event-loop lag, per-handler latency, requests per route and memory.
+"""
+
+import os
+import gc
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import datetime
+import tracemalloc
+from collections import Counter, defaultdict
+
+import bench_hoshimi as B  # sets HOSHIMI_DATA_FILE to a temp dir before importing Hoshimi
+from bench_hoshimi import H
+
+# -------------------------
+# STUB HTTP LAYER
+# -------------------------
+class FakeHTTP:
+    """Records outbound calls by route template and simulates their latency."""
+    def __init__(self, latency=0.05, jitter=0.5, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rnd = random.Random(seed)
+        self.routes = Counter()
+        self.inflight = 0
+        self.max_inflight = 0
+
+    async def request(self, method, route):
+        self.routes[f"{method} {route}"] += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency * (1 + self.rnd.uniform(-self.jitter, self.jitter)))
+        finally:
+            self.inflight -= 1
+
+http = FakeHTTP()
+
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+class SimChannel(B.FakeChannel):
+    def __init__(self, cid, guild, name="general"):
+        super().__init__(cid, name)
+        self.guild = guild
+        self.category = None
+        self.members = []
+
+    async def send(self, content=None, embed=None, embeds=None, delete_after=None, view=None):
+        self.sent += 1
+        await http.request("POST", "/channels/{channel_id}/messages")
+        return SimSent(self)
+
+    async def delete(self, reason=None):
+        await http.request("DELETE", "/channels/{channel_id}")
+
+class SimSent(B.FakeSent):
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kw):
+        await http.request("PATCH", "/channels/{channel_id}/messages/{message_id}")
+
+    async def delete(self, delay=None):
+        await http.request("DELETE", "/channels/{channel_id}/messages/{message_id}")
+
+class SimMember(B.FakeMember):
+    display_avatar = FakeAsset()
+
+    async def add_roles(self, *roles, reason=None):
+        for _ in roles:
+            await http.request("PUT", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}")
+
+    async def remove_roles(self, *roles, reason=None):
+        for _ in roles:
+            await http.request("DELETE", "/guilds/{guild_id}/members/{user_id}/roles/{role_id}")
+
+    async def edit(self, **kw):
+        await http.request("PATCH", "/guilds/{guild_id}/members/{user_id}")
+
+    async def timeout(self, until, reason=None):
+        await self.edit(timed_out_until=until)
+
+    async def move_to(self, channel, reason=None):
+        await self.edit(voice_channel=channel)
+
+    async def kick(self, reason=None):
+        await http.request("DELETE", "/guilds/{guild_id}/members/{user_id}")
+
+    async def ban(self, reason=None, delete_message_days=0):
+        await http.request("PUT", "/guilds/{guild_id}/bans/{user_id}")
+
+    async def send(self, content=None, embed=None):
+        await http.request("POST", "/users/@me/channels")
+        await http.request("POST", "/channels/{channel_id}/messages")
+
+class SimGuild(B.FakeGuild):
+    def __init__(self, gid, members, sim):
+        self.id = gid
+        self.name = f"guild{gid}"
+        self.sim = sim
+        self.members = {}
+        self.channels = {}
+        self.role_map = {}
+        self.roles = []
+        self.default_role = B.FakeRole(gid, "@everyone")
+        self.verification_level = None
+        self.next_id = gid * 1_000_000
+        for name in ("general", "logs", "welcome", "vocal-trigger"):
+            self._add_channel(name)
+        for _ in range(members):
+            self.new_member()
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _add_channel(self, name):
+        ch = SimChannel(self._id(), self, name)
+        self.channels[ch.id] = ch
+        self.sim.channels[ch.id] = ch
+        return ch
+
+    def channel(self, name):
+        return next(c for c in self.channels.values() if c.name == name)
+
+    def new_member(self):
+        m = SimMember(self._id(), self)
+        self.members[m.id] = m
+        return m
+
+    def get_role(self, rid):
+        return self.role_map.get(rid)
+
+    def add_role(self, name):
+        r = B.FakeRole(self._id(), name)
+        self.role_map[r.id] = r
+        self.roles.append(r)
+        return r
+
+    async def invites(self):
+        await http.request("GET", "/guilds/{guild_id}/invites")
+        return []
+
+    async def edit(self, **kw):
+        await http.request("PATCH", "/guilds/{guild_id}")
+
+    async def create_voice_channel(self, name, category=None, **kw):
+        await http.request("POST", "/guilds/{guild_id}/channels")
+        return self._add_channel(name)
+
+class SimMessage(B.FakeMessage):
+    async def delete(self, delay=None):
+        await http.request("DELETE", "/channels/{channel_id}/messages/{message_id}")
+
+class Emoji(str):
+    pass
+
+class ReactionPayload:
+    def __init__(self, guild, member, message_id, emoji):
+        self.guild_id = guild.id
+        self.user_id = member.id
+        self.member = member
+        self.message_id = message_id
+        self.emoji = Emoji(emoji)
+
+class VoiceState:
+    def __init__(self, channel=None):
+        self.channel = channel
+
+# -------------------------
+# SIMULATION
+# -------------------------
+MESSAGES = [B.SAMPLE_TEXT, "gg", "quelqu'un pour jouer ?", "regardez https://example.com/video",
+            "bonjour", "lol", "trop bien ce serveur", "t'es nul spamword"]
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.channels = {}
+        self.guilds = {}
+        self.latency = defaultdict(list)   # handler -> ns samples
+        self.errors = Counter()
+        self.events = Counter()
+        self.lag = []
+        self.timeline = []
+        self.tasks = set()
+
+    def setup(self):
+        B.reset_state()
+        H._invite_uses.clear()
+        H.bot.process_commands = B._no_commands
+        H.bot.get_guild = self.guilds.get
+        H.bot.get_channel = self.channels.get
+        mix = self.rnd
+        for gid in range(1, self.args.guilds + 1):
+            g = self.guilds[gid] = SimGuild(gid, self.args.members, self)
+            H.ensure_guild(gid)
+            conf = H.data["config"][str(gid)]
+            conf["level_system_enabled"] = True
+            if mix.random() < 0.5:
+                conf["logs_channel"] = g.channel("logs").id
+            if mix.random() < 0.4:
+                conf["welcome_embed_channel"] = g.channel("welcome").id
+                conf["auto_role"] = g.add_role("membre").id
+            if mix.random() < 0.5:
+                conf.update({"automod_enabled": True, "bad_words": ["spamword"] + B.words(50, seed=gid)})
+            if mix.random() < 0.5:
+                H._invite_uses[gid] = {}  # invite tracking on: each join diffs guild.invites()
+            if mix.random() < 0.3:
+                conf["antilink_enabled"] = True
+            if mix.random() < 0.3:
+                conf["antispam_enabled"] = True
+            if mix.random() < 0.2:
+                conf["voc_trigger_channel"] = g.channel("vocal-trigger").id
+            if mix.random() < 0.3:
+                H.data["auto_responses"][str(gid)] = {"bonjour": {"response": "Salut !", "mode": "word"}}
+            if mix.random() < 0.3:
+                role = g.add_role("notifs")
+                H.data["reaction_roles"][str(gid)] = {str(gid * 10): {"roles": {"🔔": role.id}}}
+            if mix.random() < 0.1:
+                # same fields as +giveaway writes
+                H.data["giveaways"][str(gid * 10 + 1)] = {"guild": str(gid), "channel": str(g.channel("general").id),
+                    "end_time": (datetime.datetime.utcnow() + datetime.timedelta(days=1)).isoformat(), "prize": "Nitro",
+                    "winners": 1, "requirements": {}, "entrants_complete": True}
+        H._take_dirty()
+
+    def spawn(self, name, coro):
+        self.events[name] += 1
+        t = asyncio.create_task(self._timed(name, coro))
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+
+    def dispatch(self, name, *args):
+        # through the bot, so the handler runs with its metrics wrapper
+        self.spawn(name, getattr(H.bot, name)(*args))
+
+    async def _timed(self, name, coro):
+        start = time.perf_counter_ns()
+        try:
+            await coro
+        except Exception as e:
+            self.errors[f"{name}: {type(e).__name__}: {e}"] += 1
+        self.latency[name].append(time.perf_counter_ns() - start)
+
+    def next_event(self):
+        g = self.guilds[self.rnd.randrange(1, self.args.guilds + 1)]
+        r = self.rnd.random()
+        members = list(g.members.values())
+        if r < 0.80:
+            ch = g.channel("general")
+            msg = SimMessage(self.rnd.choice(MESSAGES), self.rnd.choice(members), ch)
+            self.dispatch("on_message", msg)
+        elif r < 0.88:
+            rr = H.data["reaction_roles"].get(str(g.id))
+            gw = str(g.id * 10 + 1)
+            if gw in H.data["giveaways"] and self.rnd.random() < 0.5:
+                p = ReactionPayload(g, self.rnd.choice(members), int(gw), H.GIVEAWAY_EMOJI)
+            else:
+                p = ReactionPayload(g, self.rnd.choice(members), int(next(iter(rr))) if rr else 1, "🔔")
+            self.dispatch("on_raw_reaction_add", p)
+        elif r < 0.93:
+            self.dispatch("on_member_join", g.new_member())
+        else:
+            m = self.rnd.choice(members)
+            trigger = g.channel("vocal-trigger")
+            temp = [self.channels[int(c)] for c, v in H.data.get("temp_vocs", {}).items() if v["guild"] == str(g.id)]
+            if temp and self.rnd.random() < 0.5:
+                before, after = VoiceState(temp[0]), VoiceState(None)
+            else:
+                before, after = VoiceState(None), VoiceState(trigger)
+            self.dispatch("on_voice_state_update", m, before, after)
+
+    async def lag_monitor(self, interval=0.05):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append(time.perf_counter() - t - interval)
+
+    async def flusher(self):
+        while True:
+            await asyncio.sleep(H.FLUSH_INTERVAL)
+            await H.flush_data_async()
+
+    def memory(self):
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[0]
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    async def run(self):
+        self.setup()
+        gc.collect()
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        mem0 = self.memory()
+        aux = [asyncio.create_task(self.lag_monitor()), asyncio.create_task(self.flusher())]
+        start = time.perf_counter()
+        sent = 0
+        next_sample = start + 1
+        while (now := time.perf_counter()) - start < self.args.duration:
+            # open-loop arrivals: catch up to the target rate regardless of handler speed
+            due = int((now - start) * self.args.rate)
+            while sent < due:
+                self.next_event()
+                sent += 1
+            if now >= next_sample:
+                self.sample(now - start, mem0)
+                next_sample += 1
+            await asyncio.sleep(0.005)
+        await asyncio.wait(self.tasks, timeout=10) if self.tasks else None
+        self.sample(time.perf_counter() - start, mem0)
+        for t in aux:
+            t.cancel()
+        H.flush_data()
+        return self.report(time.perf_counter() - start, mem0)
+
+    def sample(self, t, mem0):
+        recent = self.lag[-20:]
+        self.timeline.append({"t": round(t, 2), "events": sum(self.events.values()), "inflight_handlers": len(self.tasks),
+                              "http_inflight": http.inflight, "lag_max_ms": max(recent, default=0) * 1000,
+                              "log_queue": H.log_dispatcher.depth(), "mem_growth_kib": (self.memory() - mem0) / 1024})
+        s = self.timeline[-1]
+        print(f"t={s['t']:>6.1f}s  events {s['events']:>8}  handlers {s['inflight_handlers']:>6}  http {s['http_inflight']:>5}  "
+              f"lag {s['lag_max_ms']:>7.1f}ms  logq {s['log_queue']:>5}  mem +{s['mem_growth_kib']:.0f} KiB")
+
+    def report(self, elapsed, mem0):
+        handlers = [B.summarize(name, {}, list(v), elapsed, 0) for name, v in sorted(self.latency.items())]
+        lag = sorted(int(x * 1e9) for x in self.lag) or [0]
+        return {
+            "version": 1, "git": B.git_rev(), "python": platform.python_version(),
+            "date": datetime.datetime.utcnow().isoformat(),
+            "config": vars(self.args), "elapsed_s": elapsed,
+            "events": dict(self.events), "errors": dict(self.errors.most_common(20)),
+            "handlers": handlers,
+            "loop_lag": B.summarize("loop_lag", {}, lag, elapsed, 0),
+            "http": {"total": sum(http.routes.values()), "max_inflight": http.max_inflight,
+                     "routes": dict(http.routes.most_common())},
+            "log_dispatcher": {"sent_messages": H.log_dispatcher.sent_messages, "sent_embeds": H.log_dispatcher.sent_embeds,
+                               "dropped": H.log_dispatcher.dropped},
+            "persistence": dict(H.persist_stats),
+            "memory_growth_kib": (self.memory() - mem0) / 1024,
+            "timeline": self.timeline,
+        }
+
+def print_report(r):
+    print(f"\n{sum(r['events'].values())} events in {r['elapsed_s']:.1f}s")
+    for h in r["handlers"]:
+        print(f"  {h['name']:<24} {h['ops']:>8}  p50 {h['p50_us'] / 1000:>8.2f}ms  p99 {h['p99_us'] / 1000:>8.2f}ms")
+    lag = r["loop_lag"]
+    print(f"  loop lag                 p50 {lag['p50_us'] / 1000:.2f}ms  p99 {lag['p99_us'] / 1000:.2f}ms")
+    print(f"HTTP: {r['http']['total']} requests (max {r['http']['max_inflight']} in flight)")
+    for route, n in r["http"]["routes"].items():
+        print(f"  {n:>8}  {route}")
+    if r["errors"]:
+        print("Erreurs:")
+        for e, n in r["errors"].items():
+            print(f"  {n:>8}  {e}")
+    print(f"Mémoire: +{r['memory_growth_kib']:.0f} KiB")
+
+async def main(args):
+    http.latency = args.latency / 1000
+    http.rnd.seed(args.seed)
+    r = await Simulation(args).run()
+    print_report(r)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(r, f, indent=2, default=str)
+    print(f"\nRésultats écrits dans {args.out}")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Hoshimi load simulator")
+    p.add_argument("--guilds", type=int, default=2000)
+    p.add_argument("--members", type=int, default=50, help="initial members per guild")
+    p.add_argument("--rate", type=float, default=2000, help="events per second")
+    p.add_argument("--duration", type=float, default=30, help="seconds")
+    p.add_argument("--latency", type=float, default=50, help="simulated API latency in ms")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--tracemalloc", action="store_true", help="measure memory with tracemalloc (slower) instead of RSS")
+    p.add_argument("--out", default="loadsim_results.json")
+    asyncio.run(main(p.parse_args()))
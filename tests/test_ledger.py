@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import tempfile
+
+os.environ.setdefault("HOSHIMI_DATA_FILE", os.path.join(tempfile.mkdtemp(), "hoshimi_data.json"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import Hoshimi as H
+
+
+@pytest.fixture
+def path(tmp_path, monkeypatch):
+    monkeypatch.setattr(H, "data", {"economy": {}, "ledger": {}})
+    monkeypatch.setattr(H, "ledger", H.Ledger(str(tmp_path / "ledger")))
+    yield H.ledger.path
+    H._take_dirty()
+
+
+def saved():
+    """What a flush would have committed: a plain copy of H.data."""
+    return json.loads(json.dumps(H.data, default=H._plain))
+
+
+def restart(monkeypatch, d, path):
+    H.columnarize(d)
+    monkeypatch.setattr(H, "data", d)
+    lg = H.Ledger(path)
+    return lg, lg.load(d)
+
+
+def money(uid):
+    return H.balance(1, uid)
+
+
+def test_replay_is_idempotent(path, monkeypatch):
+    before = saved()
+    H.ledger.record(1, "daily", 100, dst="10")
+    H.ledger.record(1, "pay", 30, src="10", dst="20")
+    H.ledger.append(H.ledger.take())
+    # crashed before the data flush: both transactions are replayed
+    lg, replayed = restart(monkeypatch, before, path)
+    assert replayed == 2
+    assert (money("10"), money("20")) == (70, 30)
+    assert lg.seq == 2 and H.data["ledger"]["seq"] == 2
+    # replaying the same lines again changes nothing
+    assert lg.load(H.data) == 0
+    assert (money("10"), money("20")) == (70, 30)
+    # nor does a restart from the state the replay produced
+    lg, replayed = restart(monkeypatch, saved(), path)
+    assert replayed == 0 and lg.durable == 2
+    assert (money("10"), money("20")) == (70, 30)
+
+
+def test_replay_skips_rows_already_saved(path, monkeypatch):
+    H.ledger.record(1, "daily", 100, dst="10")
+    first = saved()
+    H.ledger.record(1, "pay", 30, src="10", dst="20")
+    H.ledger.append(H.ledger.take())
+    final = saved()
+    # the flush committed the payer's row but not the payee's nor the ledger seq
+    mixed = {"economy": {"1": {"10": final["economy"]["1"]["10"]}}, "ledger": first["ledger"]}
+    lg, replayed = restart(monkeypatch, mixed, path)
+    assert replayed == 1
+    assert (money("10"), money("20")) == (70, 30)
+    assert H.account(1, "10")["seq"] == 2
+
+
+def test_legacy_rows_use_the_saved_seq(path, monkeypatch):
+    txs = [{"seq": 1, "t": 0, "g": "1", "kind": "daily", "amount": 100, "from": None, "to": "10"},
+           {"seq": 2, "t": 0, "g": "1", "kind": "pay", "amount": 30, "from": "10", "to": "20"}]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(tx) + "\n" for tx in txs))
+    # saved before accounts had a seq, after the first transaction
+    legacy = {"economy": {"1": {"10": {"money": 100, "last_daily": 0}}}, "ledger": {"seq": 1}}
+    lg, replayed = restart(monkeypatch, legacy, path)
+    assert replayed == 1
+    assert (money("10"), money("20")) == (70, 30)
+    assert lg.load(H.data) == 0
+    assert (money("10"), money("20")) == (70, 30)
+
+
+def test_torn_ledger_line_is_dropped(path, monkeypatch):
+    before = saved()
+    H.ledger.record(1, "daily", 100, dst="10")
+    H.ledger.append(H.ledger.take())
+    size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b'{"seq": 2, "g": "1", "kind": "pa')
+    lg, replayed = restart(monkeypatch, before, path)
+    assert replayed == 1 and money("10") == 100
+    assert os.path.getsize(path) == size
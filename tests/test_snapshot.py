@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import pickle
+import tempfile
+
+os.environ.setdefault("HOSHIMI_DATA_FILE", os.path.join(tempfile.mkdtemp(), "hoshimi_data.json"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import Hoshimi as H
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.json")
+    monkeypatch.setattr(H, "DATA_FILE", path)
+    monkeypatch.setattr(H, "JOURNAL_FILE", path + ".log")
+    return path
+
+
+def sample():
+    d = {
+        "config": {"1": {"logs_channel": 42, "bad_words": ["é", "ß"], "xp_cooldown": 2.5}},
+        "levels": {"1": {str(1000 + i): {"xp": i, "level": 1 + i % 7, "messages": i * 3} for i in range(40)}},
+        "economy": {"1": {str(i): {"money": i * 10, "last_daily": None, "seq": 0} for i in range(12)}},
+        "giveaways": {"99": {"guild": "1", "entrants": [1, 2, 3], "requirements": {}}},
+        "roles_invites": {"1": {"5": 77}},
+        "user_invites": {"1": {"0123": {"count": 1}}},
+    }
+    H.columnarize(d)
+    return d
+
+
+def plain(d):
+    return json.loads(json.dumps(d, default=H._plain, sort_keys=True))
+
+
+def test_snapshot_round_trip(files):
+    d = sample()
+    store = H.JournalStore()
+    store.commit(store.prepare(d, None))
+    loaded, seq, stale = H._load_journaled()
+    assert plain(loaded) == plain(d)
+    assert not stale
+    assert isinstance(loaded["levels"]["1"], H.RecordTable)
+    assert loaded["user_invites"]["1"]["0123"] == {"count": 1}
+
+
+def test_journal_replay_and_torn_tail(files):
+    d = sample()
+    store = H.JournalStore()
+    store.commit(store.prepare(d, None))
+    d["levels"]["1"]["1003"]["xp"] = 999
+    d["config"]["1"]["logs_channel"] = 7
+    del d["giveaways"]["99"]
+    store.commit(store.prepare(d, {("levels", "1", "1003"), ("config", "1", "logs_channel"), ("giveaways", None, "99")}))
+    size = os.path.getsize(H.JOURNAL_FILE)
+    with open(H.JOURNAL_FILE, "ab") as f:
+        f.write(b'{"n": 999, "s": "config", "g"')
+    loaded, seq, stale = H._load_journaled()
+    assert plain(loaded) == plain(d)
+    assert os.path.getsize(H.JOURNAL_FILE) == size
+
+
+def test_journal_only_is_current_schema(files, capsys):
+    d = sample()
+    store = H.JournalStore()
+    store.commit(store.prepare(d, {("roles_invites", "1", "5")}))
+    assert not os.path.exists(H.DATA_FILE)
+    loaded, seq, stale = H._load_journaled()
+    assert not stale
+    assert loaded["roles_invites"]["1"] == {"5": 77}
+    assert "schéma" not in capsys.readouterr().out
+
+
+def test_legacy_files_are_migrated_once(files, capsys):
+    with open(H.DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump({"roles_invites": {"1": {"invites": 3, "role": 55}}}, f, indent=2)
+    with open(H.JOURNAL_FILE, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"n": 1, "s": "config", "g": "1", "k": "logs_channel", "v": 9}) + "\n")
+    store = H.JournalStore()
+    loaded = store.load()
+    assert loaded["roles_invites"]["1"] == {"3": 55}
+    assert loaded["config"]["1"]["logs_channel"] == 9
+    assert "schéma 2" in capsys.readouterr().out
+    loaded, seq, stale = H._load_journaled()
+    assert not stale and loaded["roles_invites"]["1"] == {"3": 55}
+    assert "schéma" not in capsys.readouterr().out
+
+
+def test_damaged_snapshot_falls_back_to_backup(files):
+    store = H.JournalStore()
+    store.commit(store.prepare({"config": {"1": {"a": 1}}}, None))
+    store.commit(store.prepare({"config": {"1": {"a": 2}}}, None))
+    with open(H.DATA_FILE, "r+b") as f:
+        f.seek(-3, os.SEEK_END)
+        f.write(b"xyz")
+    loaded, seq, stale = H._load_journaled()
+    assert loaded["config"]["1"]["a"] == 1
+
+
+def test_snapshot_refuses_classes(files):
+    payload = pickle.dumps(H.Path("x"), protocol=5)
+    header = {"format": H.SNAPSHOT_FORMAT, "version": 2, "schema": H.SCHEMA_VERSION, "seq": 0,
+              "length": len(payload), "sha256": H.hashlib.sha256(payload).hexdigest()}
+    with open(H.DATA_FILE, "wb") as f:
+        f.write(json.dumps(header).encode("utf-8") + b"\n" + payload)
+    with pytest.raises(ValueError):
+        H._read_snapshot(H.DATA_FILE)
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import tempfile
+
+os.environ.setdefault("HOSHIMI_DATA_FILE", os.path.join(tempfile.mkdtemp(), "hoshimi_data.json"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import Hoshimi as H
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.json")
+    monkeypatch.setattr(H, "DATA_FILE", path)
+    monkeypatch.setattr(H, "JOURNAL_FILE", path + ".log")
+    monkeypatch.setattr(H, "SQLITE_FILE", str(tmp_path / "data.db"))
+    monkeypatch.setattr(H, "SHARD_DIR", str(tmp_path / "shards"))
+    return path
+
+
+def sample():
+    d = {
+        "config": {"1": {"logs_channel": 42, "bad_words": ["é", "ß"]}, "2": {"xp_cooldown": 2.5}},
+        "levels": {"1": {str(1000 + i): {"xp": i, "level": 1 + i % 7, "messages": i * 3} for i in range(30)}},
+        "economy": {"1": {str(i): {"money": i * 10, "last_daily": None, "seq": i} for i in range(8)}},
+        "giveaways": {"99": {"guild": "1", "channel": "5", "end_time": "2030-01-01T00:00:00", "prize": "Nitro",
+                             "winners": 1, "requirements": {}, "entrants_complete": True}},
+        "giveaway_entrants": {"1": {"99:7": 1, "99:8": 1}},
+        "mutes": {"2": {"3": {"until": 1900000000.0, "renew": 1899990000.0}}},
+        "ledger": {"seq": 7},
+    }
+    H.columnarize(d)
+    return d
+
+
+def keys(d):
+    """Every entry of d as the (section, gid, key) mark_dirty would use."""
+    out = set()
+    for section, per in d.items():
+        layout = H.SQL_SECTIONS.get(section, ("flat", None))[0]
+        for k, v in per.items():
+            if layout == "flat":
+                out.add((section, None, k))
+            else:
+                out.update((section, k, key) for key in v)
+    return out
+
+
+def contents(d, like):
+    # looked up one by one: a sharded store only loads the guilds asked for
+    return json.loads(json.dumps({s: {k: d[s][k] for k in per} for s, per in like.items()},
+                                 default=H._plain, sort_keys=True))
+
+
+def open_backend(monkeypatch, backend):
+    monkeypatch.setattr(H, "STORAGE_BACKEND", backend)
+    store = H.open_store()
+    d = store.load()
+    H.columnarize(d)
+    return store, d
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "shards"])
+def test_round_trip(files, monkeypatch, backend):
+    expected = sample()
+    store, d = open_backend(monkeypatch, backend)
+    for section, per in expected.items():
+        for k, v in per.items():
+            d.setdefault(section, {})[k] = v
+    store.commit(store.prepare(d, None))
+    store, loaded = open_backend(monkeypatch, backend)
+    assert contents(loaded, expected) == contents(expected, expected)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "shards"])
+def test_single_entries_round_trip(files, monkeypatch, backend):
+    expected = sample()
+    store, d = open_backend(monkeypatch, backend)
+    for section, per in expected.items():
+        for k, v in per.items():
+            d.setdefault(section, {})[k] = v
+    store.commit(store.prepare(d, None))
+    d["levels"]["1"]["1003"]["xp"] = 999
+    d["giveaway_entrants"]["1"].pop("99:7")
+    d["giveaway_entrants"]["1"]["99:9"] = 1
+    d["mutes"]["2"].pop("3")
+    store.commit(store.prepare(d, {("levels", "1", "1003"), ("giveaway_entrants", "1", "99:7"),
+                                   ("giveaway_entrants", "1", "99:9"), ("mutes", "2", "3")}))
+    store, loaded = open_backend(monkeypatch, backend)
+    assert loaded["levels"]["1"]["1003"]["xp"] == 999
+    assert dict(loaded["giveaway_entrants"]["1"]) == {"99:8": 1, "99:9": 1}
+    assert not loaded["mutes"].get("2")
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "shards"])
+def test_journal_only_install_is_migrated(files, monkeypatch, backend):
+    expected = sample()
+    journal = H.JournalStore()
+    journal.commit(journal.prepare(expected, keys(expected)))
+    assert not os.path.exists(H.DATA_FILE)
+    store, loaded = open_backend(monkeypatch, backend)
+    assert contents(loaded, expected) == contents(expected, expected)
+    assert not os.path.exists(H.JOURNAL_FILE)
+    assert os.path.exists(H.JOURNAL_FILE + ".migrated")
+    # the next start reads the new store only
+    store, loaded = open_backend(monkeypatch, backend)
+    assert contents(loaded, expected) == contents(expected, expected)